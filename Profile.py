@@ -4,7 +4,8 @@
 # ryanyz@uci.edu, pathaky@uci.edu
 # 20907746, 51317074
 
-import json, time, os
+import json, time, os, hashlib, heapq, atexit, threading
+from operator import itemgetter
 from pathlib import Path
 from ds_messenger import User, DirectMessage
 
@@ -26,60 +27,250 @@ class DsuProfileError(Exception):
     pass
 
 class Profile:
-    def __init__(self, dsuserver="168.235.86.101", username="3245", password="mypass"):
+    """
+    Profile holds the users and messages of the local user and saves them to a DSU file.
+
+    In journal mode, save_profile appends only the users and messages added since the last save to a journal file
+    next to the DSU file (path + '.journal') instead of rewriting the whole file. Once the journal grows past
+    journal_threshold bytes it is compacted back into a fresh DSU file. load_profile always replays a journal it finds.
+
+    With search=True a full-text index of the messages is kept up to date as they are added, see search. After
+    load_profile it is rebuilt by the first search, so a lazy load does not read every conversation up front. With
+    persist_search=True it is also written next to the DSU file (path + '.search') whenever the file is compacted,
+    so loading does not have to rebuild it.
+
+    dsu_version picks the format DSU files are written in: 1 is plain json, 2 the compressed format of dsu_format with
+    one block per user, compressed with compression ("zlib" or "lzma"). load_profile reads either and switches
+    dsu_version to the version of the file, so a profile is saved in the format it was loaded from.
+    """
+    def __init__(self, dsuserver="168.235.86.101", username="3245", password="mypass", journal: bool = False,
+                 journal_threshold: int = 1024 * 1024, search: bool = False, persist_search: bool = False,
+                 dsu_version: int = 1, compression: str = "zlib"):
         self.dsuserver = dsuserver
         self.username = username
         self.password = password
         self._users = []
+        # Maps each user name to its User object in self._users, not saved to the dsu file
+        self._user_index = {}
+
+        self.journal = journal
+        self.journal_threshold = journal_threshold
+        self.dsu_version = dsu_version
+        self.compression = compression
+        # Users and messages added since the last save, as (user, message index) pairs, index None for a new user
+        self._pending = []
+        # (path, sha1) of the file this profile was last loaded from or saved to, sha1 is None for databases
+        self._snapshot = None
+        # Storage backends opened by this profile, by path
+        self._storages = {}
+        # Counters for save_stats
+        self._save_stats = {"saves": 0, "journal_appends": 0, "compactions": 0, "bytes_written": 0}
 
-    def add_user(self, user_name: str) -> None:
+        self.persist_search = persist_search
+        # Full-text index of the messages, None until search is enabled or first used
+        self._search = None
+        if search or persist_search:
+            from ds_search import SearchIndex
+            self._search = SearchIndex()
+
+    def add_user(self, user_name: str) -> User:
         """
-        Adds a user to the profile
+        Adds a user to the profile. If a user with this name already exists, it is returned instead.
 
         :param user_name: name of user
+
+        :return: the User object stored under the name
+        """
+        user = self._user_index.get(user_name)
+        if user is None:
+            user = User(user_name)
+            self._users.append(user)
+            self._user_index[user_name] = user
+            self._pending.append((user, None))
+
+        return user
+
+    def get_user(self, user_name: str) -> User:
+        """
+        Gets a user stored in the profile by name
+
+        :param user_name: name of user
+
+        :return: the User object, or None if there is no user with this name
         """
-        user = User(user_name)
-        self._users.append(user)
+        return self._user_index.get(user_name)
 
-    def add_message(self, new_messages: list = None, our_message: DirectMessage = None) -> None:
+    def add_message(self, new_messages: list = None, our_message: DirectMessage = None, our_messages: list = None,
+                    pending: bool = False) -> None:
         """
         Adds a message to the profile
 
         :param new_messages: list of new messages to be added into profile
+        :param our_message: a message sent by the local user
+        :param our_messages: list of messages sent by the local user
+        :param pending: marks our messages as still waiting to be delivered, see set_pending
         """
+        # (user, start, end) range of the messages added to each user
+        added = []
+
         # Message is a dictionary in format: {"message": x, "from": y, "timestamp": z}
-        # Runs through every message
+        # Groups the messages by sender, creating the user if the message is from an unknown user
         if new_messages:
+            by_user = {}
             for message in new_messages:
-                # Iterates through every user to see if the message is from a known user
-                found = False
-                for user in self._users:
-                    if message["from"] == user.name:
-                        user.add_message(message["message"], message["timestamp"])
-                        found = True
-                        break
-
-                # If no user found, create a new user
-                if not found:
-                    user = User(message["from"])
-                    user.add_message(message["message"], message["timestamp"])
-                    self._users.append(user)
-
-        # Adds our own message instead
+                batch = by_user.get(message["from"])
+                if batch is None:
+                    batch = by_user[message["from"]] = []
+                batch.append(message)
+
+            for name, batch in by_user.items():
+                user = self.add_user(name)
+                user.add_messages(batch)
+                end = len(user._texts)
+                self._pending += [(user, i) for i in range(end - len(batch), end)]
+                added.append((user, end - len(batch), end))
+
+        # Adds our own messages instead
         if our_message:
-            # Iterates through every user to see if the message sent is to a known user
-            found = False
-            for user in self._users:
-                if our_message.recipient == user.name:
-                    user.add_message(our_message.message, our_message.timestamp, True)
-                    found = True
-                    break
-
-            # If no user found, create a new user
-            if not found:
-                user = User(message.recipient)
-                user.add_message(our_message.message, our_message.timestamp, True)
-                self._users.append(user)
+            our_messages = [our_message] + list(our_messages or [])
+
+        for sent_message in our_messages or []:
+            user = self.add_user(sent_message.recipient)
+            user.add_message(sent_message.message, sent_message.timestamp, True)
+            if pending:
+                user.set_pending(sent_message.message, sent_message.timestamp, True)
+            self._pending.append((user, len(user._texts) - 1))
+            added.append((user, len(user._texts) - 1, len(user._texts)))
+
+        if self._search is not None and added:
+            self._search.add_ranges(added)
+
+    def _pending_records(self):
+        """
+        Yields the users and messages added since the last save as journal records, {"user": name} for a new user
+        and {"user": name, "message": x, "timestamp": y, "sent by user": z} for a message.
+        """
+        for user, i in self._pending:
+            record = {"user": user.name}
+            if i is not None:
+                record.update(user._message(i))
+                # Whether a message is still waiting to be delivered is up to the outbox
+                record.pop("pending", None)
+            yield record
+
+    def set_pending(self, message: DirectMessage, pending: bool) -> bool:
+        """
+        Marks a message sent by the local user as waiting to be delivered, or as delivered. Pending messages
+        are saved like any other message, only the mark is not.
+
+        :return: True if the message was found in the profile
+        """
+        user = self._user_index.get(message.recipient)
+        return user is not None and user.set_pending(message.message, message.timestamp, pending)
+
+    def search(self, query: str, limit: int = 50, user_name: str = None) -> list:
+        """
+        Searches every conversation for a word or phrase, case insensitively. The first search of a profile
+        created without search=True, or loaded without a saved index, builds the index, which is kept up to date from
+        then on.
+
+        :param query: word or phrase to look for
+        :param limit: the most hits returned
+        :param user_name: only searches the conversation with this user
+
+        :return: list of (user name, message, timestamp) tuples, most recent first
+        """
+        if self._search is None:
+            from ds_search import SearchIndex
+            self._search = SearchIndex.build(self._users)
+
+        return self._search.search(query, limit, user_name)
+
+    def messages_between(self, start, end, user_name: str = None) -> list:
+        """
+        Gets the messages with start <= timestamp < end in timestamp order
+
+        :param start: earliest timestamp, as a float or a string
+        :param end: timestamp after the latest message, as a float or a string
+        :param user_name: only returns the messages of this user
+
+        :return: list of message dicts, each with a "user" key holding the name of the other user
+        """
+        start, end = float(start), float(end)
+
+        # Conversations whose time bounds lie outside the range are skipped without reading them from disk
+        users = []
+        for user in self._users_for(user_name):
+            bounds = user.time_bounds()
+            if bounds is not None and bounds[0] < end and bounds[1] >= start:
+                users.append(user)
+
+        return self._merge(lambda user: user._between(start, end), users)
+
+    def latest(self, n: int, user_name: str = None) -> list:
+        """
+        Gets the n latest messages, oldest first
+
+        :param user_name: only returns the messages of this user
+
+        :return: list of message dicts, each with a "user" key holding the name of the other user
+        """
+        if n <= 0:
+            return []
+
+        # Visits the conversations latest message first and stops at the first one whose latest message is older
+        # than the n latest collected so far, so only the conversations that hold one of them are read from disk
+        users = [user for user in self._users_for(user_name) if user.time_bounds() is not None]
+        by_latest = sorted(range(len(users)), key=lambda i: users[i].time_bounds()[1], reverse=True)
+        newest = []
+        selected = []
+        for i in by_latest:
+            user = users[i]
+            if len(newest) == n and user.time_bounds()[1] < newest[0]:
+                break
+            user._ensure_loaded()
+            selected.append(i)
+            count = user.message_count()
+            for position in range(max(0, count - n), count):
+                timestamp = user._times[user._index(position)]
+                if len(newest) < n:
+                    heapq.heappush(newest, timestamp)
+                elif timestamp > newest[0]:
+                    heapq.heapreplace(newest, timestamp)
+
+        # Merged in profile order, so equal timestamps come out in the same order as from the whole profile
+        users = [users[i] for i in sorted(selected)]
+        messages = self._merge(lambda user: range(max(0, user.message_count() - n), user.message_count()), users)
+        return messages[-n:]
+
+    def _users_for(self, user_name: str = None) -> list:
+        """
+        Returns every user, or only the user named user_name.
+        """
+        if user_name is None:
+            return self._users
+        user = self.get_user(user_name)
+        return [user] if user is not None else []
+
+    def _merge(self, positions, users: list) -> list:
+        """
+        Merges a run of messages from each of the users in timestamp order.
+
+        :param positions: callable returning the range of a user's message positions in timestamp order to merge
+        """
+        runs = []
+        for user in users:
+            # Loads the messages first, message_count does not
+            user._ensure_loaded()
+            indices = [user._index(position) for position in positions(user)]
+            runs.append([(user._times[i], user, i) for i in indices])
+
+        messages = []
+        for _, user, i in heapq.merge(*runs, key=itemgetter(0)):
+            message = {"user": user.name}
+            message.update(user._message(i))
+            messages.append(message)
+        return messages
 
     def get_users(self) -> list:
         """
@@ -91,47 +282,608 @@ class Profile:
 
     def save_profile(self, path: str) -> None:
         """
-        Saves current Profile instace to the file system
+        Saves current Profile instace to the file system. The file suffix picks the storage backend, see
+        STORAGE_BACKENDS.
         """
         p = Path(path)
 
-        # Creates path if it doesn't exist
-        if not os.path.exists(p) and p.suffix == '.dsu':
-            p.touch()
+        storage = self._storage_for(p)
+        if storage is None:
+            raise DsuFileError("Invalid DSU file path or type")
+
+        try:
+            storage.save(self)
+        except Exception as ex:
+            raise DsuFileError("An error occurred while attempting to process the DSU file.", ex)
+        self._save_stats["saves"] += 1
+
+    def is_dirty(self) -> bool:
+        """
+        Returns True if users or messages were added since the profile was last saved.
+        """
+        return bool(self._pending)
+
+    def save_stats(self) -> dict:
+        """
+        Returns the number of saves, journal appends and compactions, and the bytes written to DSU files, their
+        journals and indexes.
+        """
+        return dict(self._save_stats)
+
+    def _storage_for(self, p: Path):
+        """
+        Returns the storage backend for a path, reusing the one already opened for it.
+
+        :return: the backend, or None if no backend handles the file suffix
+        """
+        storage = self._storages.get(str(p))
+        if storage is None:
+            backend = STORAGE_BACKENDS.get(p.suffix)
+            if backend is None:
+                return None
+            storage = self._storages[str(p)] = backend(p)
+
+        return storage
+
+    def _save_dsu(self, p: Path) -> None:
+        """
+        Saves the profile to a DSU file, through the journal in journal mode.
+        """
+        if self.journal:
+            self._save_journal(p)
+        else:
+            # Writes all the data into the dsu file
+            self.compact(p)
+
+    def _save_journal(self, p: Path) -> None:
+        """
+        Appends the pending records to the journal, compacting it into the DSU file when it grows too large or when
+        this profile was not loaded from or saved to this path.
+        """
+        journal_path = Path(str(p) + '.journal')
+
+        if self._snapshot is None or self._snapshot[0] != str(p) or not p.exists():
+            self.compact(p)
+            return
 
-        if os.path.exists(p) and p.suffix == '.dsu':
-            # Tries to open the dsu file and dump all the data into it
+        if self._pending:
+            # The header ties the journal to the DSU file it extends, so a journal that was already compacted
+            # into the file is never replayed twice
+            records = "".join(json.dumps(record) + "\n" for record in self._pending_records())
+
+            # A crash mid-append leaves a torn last line behind, new records start on a line of their own. A journal
+            # that does not even hold a whole header line is started over
             try:
-                f = open(p, 'w')
-                json.dump(self.__dict__, f)
-                f.close()
-            except Exception as ex:
-                raise DsuFileError("An error occurred while attempting to process the DSU file.", ex)
+                with open(journal_path, 'rb') as f:
+                    has_header = f.readline().endswith(b"\n")
+                    if has_header:
+                        f.seek(-1, os.SEEK_END)
+                        torn = f.read(1) != b"\n"
+            except FileNotFoundError:
+                has_header = False
+            if not has_header:
+                records = json.dumps({"snapshot": self._snapshot[1]}) + "\n" + records
+            elif torn:
+                records = "\n" + records
+
+            with open(journal_path, 'a' if has_header else 'w') as f:
+                f.write(records)
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending = []
+            # json.dumps only writes ascii, so every character is a byte
+            self._save_stats["bytes_written"] += len(records)
+            self._save_stats["journal_appends"] += 1
+
+        if journal_path.exists() and journal_path.stat().st_size > self.journal_threshold:
+            self.compact(p)
+
+    def compact(self, path: str) -> None:
+        """
+        Writes the whole profile to the DSU file and removes its journal. The file is written to a temporary file
+        first and renamed over the old one, so a crash never leaves a partially written profile behind.
+
+        For version 1 files an index of where each user's messages start in the file is written next to it
+        (path + '.index'), which load_profile uses to open the profile lazily. Version 2 files hold their own index.
+        """
+        import dsu_format
+
+        p = Path(path)
+        # Saved with the file, so range queries of a lazily loaded profile skip the users they cannot match
+        bounds = [user.time_bounds() if user.is_loaded() else user._saved_bounds for user in self._users]
+        if self.dsu_version == 2:
+            data, sha1, entries = self._serialize_v2(bounds)
         else:
-            raise DsuFileError("Invalid DSU file path or type")
+            data, entries = self._serialize()
+            sha1 = hashlib.sha1(data).hexdigest()
+
+        tmp_path = Path(str(p) + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, p)
+        _fsync_dir(p)
+
+        self._snapshot = (str(p), sha1)
+        self._pending = []
+
+        journal_path = Path(str(p) + '.journal')
+        if journal_path.exists():
+            journal_path.unlink()
+
+        if self._search is not None and self.persist_search:
+            self._search.save(str(p) + '.search', self._snapshot[1])
+
+        # Everything is saved now, so every user can read its messages back from the new file
+        for user, (name, offset, length, count), user_bounds in zip(self._users, entries, bounds):
+            if self.dsu_version == 2:
+                loader = dsu_format.BlockLoader(p, offset, length, self.compression)
+            else:
+                loader = _MessageLoader(p, offset, length)
+            user._bind_loader(loader, count, user.is_loaded(), user_bounds)
+
+        index_path = Path(str(p) + '.index')
+        if self.dsu_version == 2:
+            if index_path.exists():
+                index_path.unlink()
+            self._save_stats["compactions"] += 1
+            self._save_stats["bytes_written"] += len(data)
+            return
+
+        # The credentials stay in the DSU file only, _load_lazy reads them from its head
+        stat = p.stat()
+        index = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": self._snapshot[1], "users": entries,
+                 "bounds": bounds}
+        tmp_path = Path(str(p) + '.index.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+            index_size = f.tell()
+        os.replace(tmp_path, index_path)
+
+        self._save_stats["compactions"] += 1
+        self._save_stats["bytes_written"] += len(data) + index_size
+
+    def _serialize(self) -> tuple:
+        """
+        Encodes the profile as the json dump of its attributes, recording where each user's messages are.
+        Messages of users that are not loaded are copied from the current DSU file without being parsed.
+
+        :return: the encoded profile and a list of [name, offset, length, message count] for every user
+        """
+        head = json.dumps({"dsuserver": self.dsuserver, "username": self.username, "password": self.password})
+        parts = [(head[:-1] + ', "_users": [').encode()]
+        offset = len(parts[0])
+        entries = []
+
+        for i, user in enumerate(self._users):
+            prefix = ((", " if i else "") + '{"name": ' + json.dumps(user.name) + ', "messages": ').encode()
+            if user.is_loaded():
+                messages = user._to_json()
+                count = user.message_count()
+            else:
+                messages = user._loader.read()
+                count = user._saved_count
+            offset += len(prefix)
+            entries.append([user.name, offset, len(messages), count])
+            parts += [prefix, messages, b"}"]
+            offset += len(messages) + 1
 
-    def load_profile(self, path: str) -> None:
+        parts.append(b"]}")
+        return b"".join(parts), entries
+
+    def _serialize_v2(self, bounds: list) -> tuple:
+        """
+        Encodes the profile in the version 2 format. Blocks of users that are not loaded are copied from the current
+        file without being inflated when it uses the same compression.
+
+        :param bounds: the earliest and latest timestamp of every user, or None, stored in the header
+
+        :return: the encoded profile, its sha1 and a list of [name, offset, length, message count] for every user
         """
-        Populates the current instance of Profile with data stored in a DSU file
+        import dsu_format
+
+        blocks = []
+        for user in self._users:
+            if user.is_loaded():
+                block = dsu_format.compress(user._to_json(), self.compression)
+                count = user.message_count()
+            else:
+                loader = user._loader
+                if isinstance(loader, dsu_format.BlockLoader) and loader.compression == self.compression:
+                    block = loader.read_block()
+                else:
+                    block = dsu_format.compress(loader.read(), self.compression)
+                count = user._saved_count
+            blocks.append((user.name, block, count))
+
+        attributes = {"dsuserver": self.dsuserver, "username": self.username, "password": self.password,
+                      "bounds": bounds}
+        return dsu_format.encode(attributes, blocks, self.compression)
+
+    def release_idle(self, max_idle: float = 300.0) -> int:
+        """
+        Drops the messages of users that have not been accessed for max_idle seconds and are fully saved, so they
+        are read back from the DSU file when next needed.
+
+        :return: the number of users released
+        """
+        released = 0
+        for user in self._users:
+            if user.is_loaded() and user.idle_time() > max_idle and user.release():
+                released += 1
+
+        return released
+
+    def load_profile(self, path: str, lazy: bool = False) -> None:
+        """
+        Populates the current instance of Profile with data stored in a DSU file and its journal, if there is one.
+        The file suffix picks the storage backend, see STORAGE_BACKENDS.
+
+        :param lazy: only reads the user names, each user's messages are read when first accessed. Falls back to
+            loading everything if the file has no up to date index.
         """
         p = Path(path)
 
-        if os.path.exists(p) and p.suffix == '.dsu':
+        storage = self._storage_for(p)
+        if os.path.exists(p) and storage is not None:
             try:
-                f = open(p, 'r')
-                obj = json.load(f)
-                
-                # Set instance attributes to ones loadede from dsu file
-                self.username = obj['username']
-                self.password = obj['password']
-                self.dsuserver = obj['dsuserver']
-                for user_obj in obj['_users']:
-                    user = User(user_obj["name"])
-                    for message in user_obj["messages"]:
-                        user.add_message(message["message"], message["timestamp"], message["sent by user"])
-                    self._users.append(user)
-                f.close()
+                storage.load(self, lazy)
             except Exception as ex:
                 raise DsuProfileError(ex)
         else:
             raise DsuFileError()
+
+        if self._search is not None:
+            self._load_search(p)
+
+    def _load_search(self, p: Path) -> None:
+        """
+        Reads the search index for the loaded messages from the file next to the DSU file if it was written for
+        it. Otherwise the index is left for the first search to build, as building it reads every message.
+        """
+        self._search = None
+        if self.persist_search and self._snapshot[1] is not None:
+            from ds_search import SearchIndex
+            self._search = SearchIndex.load(str(p) + '.search', self, self._snapshot[1])
+
+    def _load_dsu(self, p: Path, lazy: bool = False) -> None:
+        """
+        Populates the profile from a DSU file and replays its journal.
+        """
+        import dsu_format
+
+        self.dsu_version = dsu_format.detect_version(p)
+        if self.dsu_version == 2:
+            self._load_v2(p, lazy)
+        elif not (lazy and self._load_lazy(p)):
+            f = open(p, 'rb')
+            data = f.read()
+            f.close()
+            obj = json.loads(data)
+
+            # Set instance attributes to ones loadede from dsu file
+            self.username = obj['username']
+            self.password = obj['password']
+            self.dsuserver = obj['dsuserver']
+            for user_obj in obj['_users']:
+                self.add_user(user_obj["name"])._extend(user_obj["messages"])
+
+            self._snapshot = (str(p), hashlib.sha1(data).hexdigest())
+
+        self._replay_journal(Path(str(p) + '.journal'))
+        self._pending = []
+
+    def _load_v2(self, p: Path, lazy: bool = False) -> None:
+        """
+        Populates the profile from a version 2 DSU file. Lazily, only the header is read.
+        """
+        import dsu_format
+
+        header, self.compression = dsu_format.read_header(p)
+
+        self.username = header['username']
+        self.password = header['password']
+        self.dsuserver = header['dsuserver']
+        # Files written before time bounds were saved have none
+        bounds = header.get("bounds") or [None] * len(header["users"])
+        for (name, offset, length, count), user_bounds in zip(header["users"], bounds):
+            user = self.add_user(name)
+            loader = dsu_format.BlockLoader(p, offset, length, self.compression)
+            if lazy:
+                user._bind_loader(loader, count, False, user_bounds)
+            else:
+                user._extend(loader())
+                user._bind_loader(loader, count, True, user_bounds)
+
+        self._snapshot = (str(p), header["sha1"])
+
+    def _load_lazy(self, p: Path) -> bool:
+        """
+        Reads the user roster from the index next to the DSU file, and the profile attributes from the head of the
+        file, without reading any messages.
+
+        :return: False if there is no index or it does not match the DSU file
+        """
+        try:
+            with open(Path(str(p) + '.index'), 'r') as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False
+
+        stat = p.stat()
+        if index.get("size") != stat.st_size or index.get("mtime_ns") != stat.st_mtime_ns:
+            return False
+
+        # The attributes come before the first user's messages, or fill the whole file if there are no users
+        end = index["users"][0][1] if index["users"] else stat.st_size
+        with open(p, 'rb') as f:
+            head = f.read(end).decode()
+        try:
+            attributes = json.loads(head[:head.rindex(', "_users": [')] + "}")
+        except ValueError:
+            return False
+
+        self.username = attributes['username']
+        self.password = attributes['password']
+        self.dsuserver = attributes['dsuserver']
+        bounds = index.get("bounds") or [None] * len(index["users"])
+        for (name, offset, length, count), user_bounds in zip(index["users"], bounds):
+            user = self.add_user(name)
+            user._bind_loader(_MessageLoader(p, offset, length), count, False, user_bounds)
+
+        self._snapshot = (str(p), index["sha1"])
+        return True
+
+    def _replay_journal(self, journal_path: Path) -> None:
+        """
+        Applies the records of a journal written for the loaded DSU file. Records torn by a crash mid-append are
+        skipped, the records appended after them are still applied.
+        """
+        if not journal_path.exists():
+            return
+
+        with open(journal_path, 'r') as f:
+            lines = f.read().split("\n")
+
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            return
+
+        # The journal was already compacted into the DSU file
+        if header.get("snapshot") != self._snapshot[1]:
+            return
+
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            user = self.add_user(record["user"])
+            if "message" in record:
+                user.add_message(record["message"], record["timestamp"], record["sent by user"])
+
+
+class DsuStorage:
+    """
+    Profile storage backend for the JSON DSU file format.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def save(self, profile: Profile) -> None:
+        profile._save_dsu(self.path)
+
+    def load(self, profile: Profile, lazy: bool = False) -> None:
+        profile._load_dsu(self.path, lazy)
+
+
+def _sqlite_storage(path):
+    """
+    Creates a SqliteStorage backend. sqlite3 is only imported once a database is opened.
+    """
+    from sqlite_storage import SqliteStorage
+    return SqliteStorage(path)
+
+
+# Storage backend for each supported file suffix. A backend is created with the file path and provides
+# save(profile) and load(profile, lazy).
+STORAGE_BACKENDS = {'.dsu': DsuStorage, '.sqlite': _sqlite_storage, '.db': _sqlite_storage}
+
+
+def migrate_profile(src: str, dst: str) -> Profile:
+    """
+    Copies a profile from one storage backend to another, for example from a DSU file to a SQLite database.
+
+    :param src: path of the profile to read
+    :param dst: path of the profile to write, its suffix picks the backend
+
+    :return: the migrated profile
+    """
+    profile = Profile()
+    profile.load_profile(src)
+    profile.save_profile(dst)
+
+    return profile
+
+
+class SaveScheduler:
+    """
+    Coalesces the saves of a profile. Callers request a save whenever they change the profile, and a background
+    thread saves it once no request came for delay seconds, but at most max_delay seconds after the first unsaved
+    request, so a busy conversation is still saved regularly. Requests that arrive while a save is waiting are
+    merged into it.
+
+    Pending changes are saved by flush, by close and when the program exits. Saves hold lock, which should be the
+    lock held while the profile is changed, and call on_save, if given, after every successful save. Failed saves
+    are counted in errors and passed to on_error, if given, with the exception that stopped them. Delays are
+    measured with clock, time.monotonic unless given.
+    """
+    def __init__(self, profile: Profile, path: str, delay: float = 1.0, max_delay: float = 5.0, lock=None,
+                 on_save=None, on_error=None, clock=time.monotonic):
+        self.profile = profile
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.lock = lock if lock is not None else threading.RLock()
+        self.on_save = on_save
+        self.on_error = on_error
+        self._clock = clock
+
+        self.requests = 0
+        self.saves = 0
+        self.errors = 0
+
+        # Times of the first and the latest request since the last save, None while there is nothing to save
+        self._first = None
+        self._last = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+        atexit.register(self.close)
+
+    def request(self) -> None:
+        """
+        Schedules a save of the profile.
+        """
+        with self._condition:
+            now = self._clock()
+            if self._first is None:
+                self._first = now
+            self._last = now
+            self.requests += 1
+
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _due(self) -> float:
+        return min(self._last + self.delay, self._first + self.max_delay)
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed and (self._first is None or self._due() > self._clock()):
+                        self._condition.wait(None if self._first is None else self._due() - self._clock())
+                    if self._closed:
+                        return
+                    self._first = self._last = None
+
+                self._save()
+        finally:
+            # The next request starts a new thread should this one ever stop
+            with self._condition:
+                self._thread = None
+
+    def _save(self) -> bool:
+        try:
+            with self.lock:
+                self.profile.save_profile(self.path)
+                if self.on_save is not None:
+                    self.on_save()
+                self.saves += 1
+            return True
+        except Exception as ex:
+            self.errors += 1
+            # Keeps the changes scheduled, they are saved with the next request or flush
+            with self._condition:
+                if self._first is None:
+                    self._first = self._last = self._clock()
+            if self.on_error is not None:
+                self.on_error(ex)
+            return False
+
+    def flush(self) -> bool:
+        """
+        Saves the profile now if a save was requested and has not happened yet, or if it has unsaved changes.
+
+        :return: False if the profile could not be saved, in which case the changes stay scheduled, otherwise True
+        """
+        with self._condition:
+            scheduled = self._first is not None or self.profile.is_dirty()
+            self._first = self._last = None
+
+        return self._save() if scheduled else True
+
+    def close(self) -> None:
+        """
+        Stops the background thread and saves any pending changes. Closing it again only saves changes made since.
+        """
+        # Unregistered first, so the exit handler never keeps a closed scheduler and its profile alive
+        atexit.unregister(self.close)
+        with self._condition:
+            self._closed = True
+            thread = self._thread
+            self._condition.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+        self.flush()
+
+    def stats(self) -> dict:
+        """
+        Returns the save requests, the saves they were coalesced into and failed saves, along with the profile's
+        save_stats.
+        """
+        stats = {"requests": self.requests, "saves": self.saves, "errors": self.errors}
+        stats.update({"profile_" + name: value for name, value in self.profile.save_stats().items()})
+        return stats
+
+
+def convert_profile(src: str, dst: str = None, version: int = 2, compression: str = "zlib") -> Profile:
+    """
+    Rewrites a DSU file in another format version, for example to compress a version 1 file.
+
+    :param src: path of the DSU file to read, along with its journal
+    :param dst: path to write, by default src itself
+    :param version: format version to write
+    :param compression: compression of version 2 files, "zlib" or "lzma"
+
+    :return: the converted profile
+    """
+    profile = Profile()
+    profile.load_profile(src, lazy=True)
+    profile.dsu_version = version
+    profile.compression = compression
+    profile.compact(dst or src)
+
+    return profile
+
+
+class _MessageLoader:
+    """
+    Reads one user's message list from a known position in a DSU file.
+    """
+    def __init__(self, path: Path, offset: int, length: int):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def __call__(self) -> list:
+        return json.loads(self.read())
+
+
+def _fsync_dir(p: Path) -> None:
+    """
+    Flushes a directory entry change, such as a rename, to disk where the platform supports it.
+    """
+    try:
+        fd = os.open(p.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
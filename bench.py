@@ -0,0 +1,248 @@
+# bench.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+"""
+Benchmarks for the protocol, profile, persistence and search hot paths.
+
+    python bench.py --out results.json
+    python bench.py --compare results.json --tolerance 0.25
+
+Every result is a cost, lower is better: seconds per operation, seconds per run or bytes. With --compare the
+exit code is 1 if any result grew by more than the tolerance over the baseline file.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import accumulate
+import ds_protocol
+from ds_messenger import User
+from Profile import Profile
+
+
+
+def _best(function, repeat: int = 3) -> float:
+    """
+    Returns the fastest of repeat runs of function, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _per_op(function, number: int) -> float:
+    """
+    Returns the seconds per call of function, best of three runs of number calls.
+    """
+    def run():
+        for _ in range(number):
+            function()
+    return _best(run) / number
+
+
+def _server_messages(count: int, contacts: int = 100) -> list:
+    return [{"message": f"message number {i} with some text", "from": f"contact{i % contacts}",
+             "timestamp": str(1647149883.77518 + i)} for i in range(count)]
+
+
+def _search_messages(count: int, contacts: int = 100) -> list:
+    # Words are drawn with Zipf weights, so common words and pairs have long lists as in real conversations
+    rng = random.Random(count)
+    words = "i you the a to see at lunch dinner tomorrow meet later".split() + [f"word{i}" for i in range(2000)]
+    weights = list(accumulate(1.0 / rank for rank in range(1, len(words) + 1)))
+    return [{"message": " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(2, 10))),
+             "from": f"contact{i % contacts}", "timestamp": str(1647149883.77518 + i)} for i in range(count)]
+
+
+def _profile(count: int) -> Profile:
+    profile = Profile("bench", "bench", "bench")
+    messages = _server_messages(count)
+    for start in range(0, count, 1000):
+        profile.add_message(new_messages=messages[start:start + 1000])
+    return profile
+
+
+def bench_protocol(results: dict, scale: float) -> None:
+    number = max(1000, int(20000 * scale))
+    ok = json.dumps({"response": {"type": "ok", "message": "Direct message sent"}})
+    many = json.dumps({"response": {"type": "ok", "messages": _server_messages(50)}})
+    directmessage = {"entry": "Hello World!", "recipient": "ohhimark", "timestamp": 1603167689.3928561}
+
+    results["protocol.encode_directmessage"] = _per_op(
+        lambda: ds_protocol.encode_json("directmessage", token="token", directmessage=directmessage), number)
+    results["protocol.encode_new"] = _per_op(
+        lambda: ds_protocol.encode_json("directmessage", token="token", directmessage="new"), number)
+    results["protocol.extract_ok"] = _per_op(lambda: ds_protocol.extract_json(ok), number)
+    results["protocol.extract_50_messages"] = _per_op(lambda: ds_protocol.extract_json(many), number // 10)
+
+
+def bench_ingest(results: dict, sizes: list) -> None:
+    for size in sizes:
+        messages = _server_messages(size)
+
+        def ingest():
+            profile = Profile()
+            for start in range(0, size, 1000):
+                profile.add_message(new_messages=messages[start:start + 1000])
+
+        results[f"profile.add_message.{size}"] = _best(ingest, repeat=1 if size >= 1000000 else 3)
+
+
+def bench_persistence(results: dict, sizes: list, directory: str) -> None:
+    for size in sizes:
+        profile = _profile(size)
+        path = os.path.join(directory, f"bench_{size}.dsu")
+
+        results[f"profile.save_profile.{size}"] = _best(lambda: profile.save_profile(path))
+        results[f"profile.file_bytes.{size}"] = os.path.getsize(path)
+        results[f"profile.load_profile.{size}"] = _best(lambda: Profile().load_profile(path))
+        results[f"profile.load_profile_lazy.{size}"] = _best(lambda: Profile().load_profile(path, lazy=True))
+
+        # The same profile in the compressed version 2 format
+        path_v2 = os.path.join(directory, f"bench_{size}_v2.dsu")
+        profile.dsu_version = 2
+        results[f"profile.save_profile_v2.{size}"] = _best(lambda: profile.compact(path_v2))
+        results[f"profile.file_bytes_v2.{size}"] = os.path.getsize(path_v2)
+        results[f"profile.load_profile_v2.{size}"] = _best(lambda: Profile().load_profile(path_v2))
+        results[f"profile.load_profile_lazy_v2.{size}"] = _best(lambda: Profile().load_profile(path_v2, lazy=True))
+
+        # Saving after a few new messages, the cost that the GUI pays on every poll
+        journal = Profile(journal=True)
+        journal.load_profile(path)
+
+        def save_new():
+            journal.add_message(new_messages=_server_messages(10))
+            journal.save_profile(path)
+        results[f"profile.save_10_new.{size}"] = _best(save_new)
+
+
+def bench_search(results: dict, sizes: list, directory: str) -> None:
+    queries = {"word": "lunch", "phrase": "see you at lunch", "rare_phrase": "word7 word8",
+               "missing": "lunch dinner lunch"}
+    for size in sizes:
+        messages = _search_messages(size)
+
+        # The last profile indexed is kept for the queries
+        indexed = []
+
+        def index():
+            indexed[:] = [Profile(search=True)]
+            for start in range(0, size, 1000):
+                indexed[0].add_message(new_messages=messages[start:start + 1000])
+        results[f"search.add_message.{size}"] = _best(index, repeat=1 if size >= 1000000 else 3)
+
+        profile = indexed[0]
+        for name, query in queries.items():
+            results[f"search.{name}.{size}"] = _per_op(lambda: profile.search(query), 20)
+
+        if size > 100000:
+            continue
+
+        # Opening a profile for search must stay lazy, the index is read from its file or built by the first search
+        path = os.path.join(directory, f"search_{size}.dsu")
+        profile.persist_search = True
+        profile.compact(path)
+        results[f"search.load_profile_lazy.{size}"] = _best(
+            lambda: Profile(search=True).load_profile(path, lazy=True))
+        results[f"search.load_profile_lazy_persisted.{size}"] = _best(
+            lambda: Profile(search=True, persist_search=True).load_profile(path, lazy=True))
+
+        def first_search():
+            loaded = Profile(search=True)
+            loaded.load_profile(path, lazy=True)
+            loaded.search(queries["phrase"])
+        results[f"search.first_search.{size}"] = _best(first_search)
+
+
+def bench_memory(results: dict, sizes: list) -> None:
+    for size in sizes:
+        gc.collect()
+        tracemalloc.start()
+        user = User("contact")
+        for i in range(size):
+            user.add_message(f"message number {i} with some text", str(1647149883.77518 + i))
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[f"user.bytes_per_message.{size}"] = current / size
+        del user
+
+
+def run(sizes: list, scale: float) -> dict:
+    results = {}
+    bench_protocol(results, scale)
+    bench_ingest(results, sizes)
+    with tempfile.TemporaryDirectory() as directory:
+        bench_persistence(results, [size for size in sizes if size <= 100000], directory)
+        bench_search(results, sizes, directory)
+    bench_memory(results, sizes)
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "json_backend": ds_protocol.JSON_BACKEND,
+        "time": time.time(),
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns a line for every result that grew by more than tolerance over the baseline.
+    """
+    regressions = []
+    for name, value in current["results"].items():
+        old = baseline["results"].get(name)
+        if old and value > old * (1 + tolerance):
+            regressions.append(f"{name}: {old:.6g} -> {value:.6g} (+{(value / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the protocol, profile, persistence and search hot paths.")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated message counts for the profile benchmarks")
+    parser.add_argument("--quick", action="store_true", help="small sizes for a fast smoke run")
+    parser.add_argument("--out", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline json file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed growth over the baseline, 0.25 = 25%%")
+    args = parser.parse_args(argv)
+
+    sizes = [1000, 10000] if args.quick else [int(size) for size in args.sizes.split(",")]
+    current = run(sizes, 0.1 if args.quick else 1.0)
+
+    for name, value in current["results"].items():
+        print(f"{name:40} {value:.6g}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# convert_dsu.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+"""
+Converts DSU files between format versions.
+
+    python convert_dsu.py profile.dsu                     compress a json profile into the version 2 format
+    python convert_dsu.py profile.dsu --compression lzma  smaller files, slower saves
+    python convert_dsu.py profile.dsu plain.dsu --to 1    write a plain json copy
+
+Any journal next to the source file is folded into the converted file.
+"""
+
+import argparse
+import os
+import sys
+import dsu_format
+from Profile import convert_profile, DsuFileError, DsuProfileError
+
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Convert DSU files between format versions.")
+    parser.add_argument("src", help="DSU file to read")
+    parser.add_argument("dst", nargs="?", help="DSU file to write, by default src is converted in place")
+    parser.add_argument("--to", type=int, choices=(1, 2), default=2, help="format version to write")
+    parser.add_argument("--compression", choices=sorted(dsu_format.COMPRESSIONS), default="zlib",
+                        help="compression of version 2 files")
+    args = parser.parse_args(argv)
+
+    dst = args.dst or args.src
+    try:
+        before = os.path.getsize(args.src)
+        version = dsu_format.detect_version(args.src)
+        convert_profile(args.src, dst, args.to, args.compression)
+    except (OSError, DsuFileError, DsuProfileError, dsu_format.DsuFormatError) as ex:
+        print("Could not convert the DSU file.", ex)
+        return 1
+
+    after = os.path.getsize(dst)
+    print(f"{args.src} (version {version}, {before} bytes) -> {dst} (version {args.to}, {after} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# ds_async_messenger.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import asyncio
+import time
+import ds_protocol
+from ds_messenger import DirectMessage, TokenCache, TOKEN_CACHE
+
+
+
+class AsyncDirectMessenger:
+    """
+    asyncio counterpart of DirectMessenger. Keeps one stream connection to the server open and runs requests as
+    coroutines, so many accounts can be served from a single event loop.
+    """
+    def __init__(self, dsuserver: str = "168.235.86.101", port: int = 3021, username: str = None, password: str = None,
+                 timeout: float = None, token_cache: TokenCache = TOKEN_CACHE):
+        self.dsuserver = dsuserver
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.token = None
+
+        self._token_cache = token_cache
+        self._reader = None
+        self._writer = None
+        # Requests share one stream, so only one may be in flight at a time
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Closes the connection to the server. The messenger reconnects if it is used again.
+        """
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _exchange(self, data: str) -> bytes:
+        """
+        Writes one request and reads one response line, opening the connection first if needed. A connection the
+        server closed while it sat idle has already seen the end of its stream, and is replaced before anything is
+        written to it.
+        """
+        if self._writer is not None and (self._reader.at_eof() or self._writer.is_closing()):
+            await self.close()
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.dsuserver, self.port)
+
+        self._writer.write((data + "\r\n").encode())
+        await self._writer.drain()
+
+        srv_msg = await self._reader.readline()
+
+        # A read that is empty or ends without a newline means the server closed the connection on us
+        if not srv_msg.endswith(b"\n"):
+            raise EOFError("Server closed the connection.")
+
+        return srv_msg
+
+    async def _request(self, data: str, error_msg: str, timeout: float = None) -> bytes:
+        """
+        Sends a request to the server and returns its response line. Once the request was handed to the stream it
+        is never sent again: whether the write fails or the reply never comes, the server may have acted on it.
+
+        :param data: json request to be sent
+        :param error_msg: message printed if the request could not be completed
+        :param timeout: seconds to wait for the whole request, defaults to the messenger's timeout
+
+        :return: the raw server response, or None if the request failed or timed out
+        """
+        timeout = self.timeout if timeout is None else timeout
+
+        async with self._lock:
+            try:
+                return await asyncio.wait_for(self._exchange(data), timeout)
+            except asyncio.TimeoutError:
+                # The reply may still arrive later and would be read as the answer to the next request
+                await self.close()
+                print("The server did not respond in time.")
+                return None
+            except asyncio.CancelledError:
+                await self.close()
+                raise
+            except (OSError, EOFError):
+                await self.close()
+                print(error_msg)
+                return None
+
+    async def join(self, refresh: bool = False, timeout: float = None) -> bool:
+        """
+        Retrieves the unique user token from the server, reusing a cached token when there is one.
+
+        :param refresh: ignores the cached token and always joins the server
+        :param timeout: seconds to wait for the server
+
+        :return: True if token was successfully retrieved, False otherwise
+        """
+        if not refresh and self._token_cache is not None:
+            token = self._token_cache.get(self.dsuserver, self.port, self.username, self.password)
+            if token is not None:
+                self.token = token
+                return True
+
+        try:
+            data = ds_protocol.encode_json("join", self.username, self.password, '')
+        except:
+            print("Join data could not be encoded to json.")
+            return False
+
+        srv_msg = await self._request(data, "An error occurred while trying to join the server.", timeout)
+        if srv_msg is None:
+            return False
+
+        srv_data = ds_protocol.extract_json(srv_msg)
+        if not srv_data:
+            return False
+
+        if srv_data.response_type == "error":
+            print("Invalid password or username already taken.")
+            return False
+
+        self.token = srv_data.token
+        if self._token_cache is not None:
+            self._token_cache.set(self.dsuserver, self.port, self.username, self.password, self.token)
+
+        return True
+
+    async def _token_request(self, directmessage, error_msg: str, timeout: float = None) -> ds_protocol.DataTuple:
+        """
+        Sends a directmessage request authorized by the session token, joining first if needed. If the server
+        rejects the request, joins again once and retries with the new token.
+
+        :return: the decoded server response, or None if the request failed
+        """
+        if self.token is None and not await self.join(timeout=timeout):
+            return None
+
+        for attempt in range(2):
+            try:
+                data = ds_protocol.encode_json("directmessage", token=self.token, directmessage=directmessage)
+            except:
+                print("Direct message could not be encoded to json.")
+                return None
+
+            srv_msg = await self._request(data, error_msg, timeout)
+            if srv_msg is None:
+                return None
+
+            srv_data = ds_protocol.extract_json(srv_msg)
+            if not srv_data:
+                return None
+
+            if srv_data.response_type != "error" or attempt == 1:
+                return srv_data
+
+            # The token may have expired, join again and only retry if the server handed out a different token
+            old_token = self.token
+            if self._token_cache is not None:
+                self._token_cache.invalidate(self.dsuserver, self.port, self.username, old_token)
+            if not await self.join(refresh=True, timeout=timeout) or self.token == old_token:
+                return srv_data
+
+        return srv_data
+
+    async def send(self, recipient: str, message: str, profile = None, timeout: float = None) -> bool:
+        """
+        Sends a message to a recipient through the DSU server
+
+        :param recipient: the recipient of the message
+        :param message: the message to be sent
+        :param profile: profile the sent message is recorded into, if given
+        :param timeout: seconds to wait for the server
+
+        :return: True if the message was successfully sent, False otherwise
+        """
+        message_obj = DirectMessage(recipient, message, time.time())
+        message_dict = {"entry": message_obj.message, "recipient": message_obj.recipient, "timestamp": message_obj.timestamp}
+
+        srv_data = await self._token_request(message_dict, "An error occurred while sending the message to the server.", timeout)
+        if not srv_data:
+            return False
+
+        if srv_data.response_type == "error":
+            print("Message could not be sent.")
+            return False
+
+        if profile is not None:
+            profile.add_message(our_message=message_obj)
+
+        return True
+
+    async def retrieve_new(self, to_retrieve: str = "new", timeout: float = None) -> list:
+        """
+        Retrieves all new messages from the server.
+
+        :param to_retrieve: "new" or "all", retrieve_all calls this method with "all"
+        :param timeout: seconds to wait for the server
+
+        :return: list of new messages, or None if the request failed
+        """
+        srv_data = await self._token_request(to_retrieve, "An error occurred while sending the message to the server.", timeout)
+        if not srv_data:
+            return None
+
+        if srv_data.response_type == "error":
+            print("Message could not be sent.")
+            return None
+
+        return srv_data.response_message
+
+    async def retrieve_all(self, timeout: float = None) -> list:
+        """
+        Retrieves all messages from the server.
+
+        :param timeout: seconds to wait for the server
+
+        :return: list of all messages, or None if the request failed
+        """
+        return await self.retrieve_new("all", timeout)
@@ -1,176 +1,1169 @@
+import math
 import time
+import select
 import socket
+import threading
 import ds_protocol
 import json
+from array import array
+from bisect import bisect_left, insort
+from collections.abc import Sequence
+from contextlib import contextmanager
+from ds_metrics import METRICS, Metrics, error_kind
 
 
 
-class DirectMessage(dict):
+class DirectMessage:
     """
-    Class to hold direct message information. Inherits from dict to support saving to local device.
+    Class to hold direct message information.
     """
+    __slots__ = ("recipient", "message", "timestamp")
+
     def __init__(self, recipient: str = None, message: str = None, timestamp: str = time.time()):
         self.recipient = recipient
         self.message = message
         self.timestamp = timestamp
-        
-        # Subclass dict to enable serialization
-        dict.__init__(self, recipient=self.recipient, message=self.message, timestamp=self.timestamp)
 
-class User(dict):
+    def __getitem__(self, key: str):
+        # Read access by key, as when this was a dict
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self) -> str:
+        return repr({"recipient": self.recipient, "message": self.message, "timestamp": self.timestamp})
+
+
+# Bits of User._flags
+_SENT_BY_USER = 1
+# The timestamp was given as a string that float() and repr() round trip, so it is restored as that string
+_STR_TIMESTAMP = 2
+# Sent by the user but still waiting in the outbox, never saved to the DSU file
+_PENDING = 4
+
+_encode_str = json.encoder.encode_basestring_ascii
+
+
+class User:
     """
-    Class to hold information on messages sent to and from a specific user. Inherits from dict to support saving to local device.
+    Class to hold information on messages sent to and from a specific user.
+
+    Messages are stored in columns rather than as a dict each: the texts in a list, the timestamps in an array of
+    floats and the sent by user bit in a bytearray. get_messages returns a MessageList that builds the familiar
+    {"message", "timestamp", "sent by user"} dicts on access. Timestamps come back exactly as they were given,
+    strings as strings and floats as floats.
+
+    The columns are append-only, which is the order messages are saved in. get_messages, messages_between and latest
+    present them in timestamp order: as long as messages arrive in order that is the same thing, otherwise a sorted
+    array of message indices is kept, so time ranges are found by binary search.
+
+    A user loaded lazily from a DSU file only knows how to read its messages back, and the time bounds of its messages
+    if they were saved with the file. They are read on the first call to get_messages or add_message, and can be
+    released again with release once they are all saved to the file.
+
+    Messages sent by the user can be marked pending while they wait in the outbox. Their dicts then carry
+    "pending": True, which is not saved, and the user keeps its messages in memory until they are delivered.
     """
+    __slots__ = ("name", "_texts", "_times", "_flags", "_raw_times", "_order", "_reorders", "_undelivered", "_loader",
+                 "_saved_count", "_saved_bounds", "_last_access", "__weakref__")
+
     def __init__(self, name):
         self.name = name
-        self._messages = []
+        self._texts = []
+        self._times = array('d')
+        self._flags = bytearray()
+        # Timestamps that a float cannot reproduce, such as "1.50", by message index
+        self._raw_times = None
+        # Message indices in timestamp order, None while that is the order they were added in
+        self._order = None
+        # Number of times messages were added before ones already there in timestamp order
+        self._reorders = 0
+        # Number of messages marked pending
+        self._undelivered = 0
+
+        # Reads the messages saved in the DSU file, set by Profile when the user is backed by a file
+        self._loader = None
+        # Number of messages already saved in the DSU file, and their earliest and latest timestamp if known
+        self._saved_count = 0
+        self._saved_bounds = None
+        self._last_access = time.monotonic()
+
+    def __getitem__(self, key: str):
+        # Read access to "name" and "messages", as when this was a dict
+        if key == "name":
+            return self.name
+        if key == "messages":
+            return self.get_messages()
+        raise KeyError(key)
+
+    def _bind_loader(self, loader, saved_count: int, loaded: bool = True, bounds=None) -> None:
+        """
+        Backs the user with messages saved in a DSU file.
+
+        :param loader: callable returning the list of message dicts saved in the file
+        :param saved_count: number of messages saved in the file
+        :param loaded: False drops the messages in memory, they are read from the file when next needed
+        :param bounds: earliest and latest timestamp of the saved messages, if known
+        """
+        self._loader = loader
+        self._saved_count = saved_count
+        self._saved_bounds = bounds
+        if not loaded:
+            self._set_messages(None)
+
+    def _set_messages(self, messages) -> None:
+        """
+        Replaces the messages with a list of message dicts, or drops them from memory if messages is None.
+        """
+        if messages is None:
+            self._texts = self._times = self._flags = self._raw_times = self._order = None
+            return
+
+        self._texts = []
+        self._times = array('d')
+        self._flags = bytearray()
+        self._raw_times = None
+        self._order = None
+        self._undelivered = 0
+        self._extend(messages)
+
+    def _extend(self, messages: list, sent_by_user: bool = None) -> bool:
+        """
+        Appends a list of message dicts.
+
+        :param sent_by_user: sent by user for every message, if None it is read from each dict
+
+        :return: True if any of the messages sorts before a message that was already there
+        """
+        stamps = [message["timestamp"] for message in messages]
+        try:
+            values = list(map(float, stamps))
+        except (TypeError, ValueError):
+            reordered = False
+            for message in messages:
+                reordered |= self._append(message["message"], message["timestamp"],
+                                          message["sent by user"] if sent_by_user is None else sent_by_user)
+            return reordered
+
+        # Converting column by column keeps the per message work in C. Usually every timestamp is a string that
+        # round trips, as sent by the server, or every timestamp is a float, as sent by us
+        base = len(self._texts)
+        texts = list(map(repr, values))
+        if texts == stamps:
+            flags = bytearray([_STR_TIMESTAMP]) * len(stamps)
+            raw = None
+        elif values == stamps and all(stamp.__class__ is float for stamp in stamps):
+            flags = bytearray(len(stamps))
+            raw = None
+        else:
+            flags = bytearray([_STR_TIMESTAMP if stamp.__class__ is str and text == stamp else 0
+                               for stamp, text in zip(stamps, texts)])
+            raw = [i for i, (flag, stamp) in enumerate(zip(flags, stamps)) if not flag and stamp.__class__ is not float]
+        if raw:
+            if self._raw_times is None:
+                self._raw_times = {}
+            for i in raw:
+                self._raw_times[base + i] = stamps[i]
+
+        if sent_by_user is None:
+            flags = bytearray([flag | _SENT_BY_USER if message["sent by user"] else flag
+                               for flag, message in zip(flags, messages)])
+        elif sent_by_user:
+            flags = bytearray([flag | _SENT_BY_USER for flag in flags])
+
+        self._texts += [message["message"] for message in messages]
+        self._times.extend(values)
+        self._flags += flags
+        return self._sort_from(base)
+
+    def _append(self, message: str, timestamp, sent_by_user: bool) -> bool:
+        flags = _SENT_BY_USER if sent_by_user else 0
+        if timestamp.__class__ is float:
+            value = timestamp
+        else:
+            try:
+                value = float(timestamp)
+            except (TypeError, ValueError):
+                value = 0.0
+            if timestamp.__class__ is str and repr(value) == timestamp:
+                flags |= _STR_TIMESTAMP
+            else:
+                if self._raw_times is None:
+                    self._raw_times = {}
+                self._raw_times[len(self._texts)] = timestamp
+
+        self._texts.append(message)
+        self._times.append(value)
+        self._flags.append(flags)
+        return self._sort_from(len(self._texts) - 1)
+
+    def _sort_from(self, base: int) -> bool:
+        """
+        Places the messages from index base on in timestamp order. Messages with equal timestamps stay in the order
+        they were added in.
+
+        :return: True if any of them sorts before a message that was already there
+        """
+        times = self._times
+        count = len(times)
+        if self._order is None:
+            new = times[max(base - 1, 0):].tolist()
+            if new == sorted(new):
+                return False
+            self._order = array('Q', range(base))
+
+        if count - base <= 64:
+            key = times.__getitem__
+            for i in range(base, count):
+                insort(self._order, i, key=key)
+        else:
+            self._order = array('Q', sorted(range(count), key=times.__getitem__))
+
+        # The new messages all sort after the old ones if they fill the end of the order
+        return any(i < base for i in self._order[base:])
+
+    def _ensure_loaded(self) -> None:
+        if self._texts is None:
+            self._set_messages(self._loader())
+        self._last_access = time.monotonic()
+
+    def _index(self, position: int) -> int:
+        """
+        Returns the index of the message at a position in timestamp order.
+        """
+        return position if self._order is None else self._order[position]
 
-        # Subclass dict to enable serialization
-        dict.__init__(self, name=self.name, messages=self._messages)
+    def _message(self, i: int) -> dict:
+        """
+        Returns message i as a message dict.
+        """
+        flags = self._flags[i]
+        if flags & _STR_TIMESTAMP:
+            timestamp = repr(self._times[i])
+        elif self._raw_times is not None and i in self._raw_times:
+            timestamp = self._raw_times[i]
+        else:
+            timestamp = self._times[i]
+
+        message = {"message": self._texts[i], "timestamp": timestamp, "sent by user": bool(flags & _SENT_BY_USER)}
+        if flags & _PENDING:
+            message["pending"] = True
+        return message
+
+    def _rows(self):
+        """
+        Yields (message, timestamp, sent by user) for every message.
+        """
+        self._ensure_loaded()
+        for i in range(len(self._texts)):
+            message = self._message(i)
+            yield message["message"], message["timestamp"], message["sent by user"]
+
+    def _to_json(self) -> bytes:
+        """
+        Encodes the messages exactly as json.dumps encodes the list of message dicts.
+        """
+        self._ensure_loaded()
+        raw_times = self._raw_times or {}
+        parts = []
+        for i, (text, value, flags) in enumerate(zip(self._texts, self._times, self._flags)):
+            if flags & _STR_TIMESTAMP:
+                timestamp = '"%r"' % value
+            elif i in raw_times:
+                timestamp = json.dumps(raw_times[i])
+            else:
+                timestamp = json.dumps(value)
+            parts.append('{"message": %s, "timestamp": %s, "sent by user": %s}' % (
+                _encode_str(text) if text.__class__ is str else json.dumps(text), timestamp,
+                "true" if flags & _SENT_BY_USER else "false"))
+
+        return ("[" + ", ".join(parts) + "]").encode()
+
+    def is_loaded(self) -> bool:
+        """
+        Returns True if the user's messages are held in memory.
+        """
+        return self._texts is not None
+
+    def message_count(self) -> int:
+        """
+        Returns the number of messages, without reading them from the file if they are not loaded.
+        """
+        return self._saved_count if self._texts is None else len(self._texts)
+
+    def time_bounds(self):
+        """
+        Returns the earliest and the latest timestamp of the messages as floats, or None if there are no messages.
+        A user that is not loaded answers from the bounds saved with its file without reading it, or with
+        (-inf, inf) if none were saved.
+        """
+        if self._texts is None:
+            if not self._saved_count:
+                return None
+            return tuple(self._saved_bounds) if self._saved_bounds else (-math.inf, math.inf)
+
+        if not self._texts:
+            return None
+        if self._order is None:
+            return self._times[0], self._times[-1]
+        return self._times[self._order[0]], self._times[self._order[-1]]
+
+    def reorder_count(self) -> int:
+        """
+        Returns the number of times messages were added before messages already there in timestamp order, so a
+        view that shows messages by position knows when it has to be redrawn instead of extended.
+        """
+        return self._reorders
+
+    def pending_count(self) -> int:
+        """
+        Returns the number of messages marked pending.
+        """
+        return self._undelivered
+
+    def set_pending(self, message: str, timestamp, pending: bool) -> bool:
+        """
+        Marks a message sent by the user as waiting to be delivered, or as delivered.
+
+        :param message: text of the message
+        :param timestamp: timestamp of the message, as a float or a string
+
+        :return: True if the message was found
+        """
+        try:
+            value = float(timestamp)
+        except (TypeError, ValueError):
+            value = 0.0
+
+        found = False
+        for position in self._between(value, math.nextafter(value, math.inf)):
+            i = self._index(position)
+            if self._texts[i] != message or not self._flags[i] & _SENT_BY_USER:
+                continue
+            if bool(self._flags[i] & _PENDING) == pending:
+                found = True
+                continue
+
+            # Identical messages sent at the same time are marked one at a time
+            self._flags[i] ^= _PENDING
+            self._undelivered += 1 if pending else -1
+            return True
+
+        return found
+
+    def release(self) -> bool:
+        """
+        Drops the messages from memory if they can be read back from the DSU file and none of them is pending.
+
+        :return: True if the messages were released
+        """
+        if (self._loader is None or self._texts is None or len(self._texts) != self._saved_count
+                or self._undelivered):
+            return False
+
+        self._saved_bounds = self.time_bounds()
+        self._set_messages(None)
+        return True
+
+    def idle_time(self) -> float:
+        """
+        Returns the number of seconds since the messages were last accessed.
+        """
+        return time.monotonic() - self._last_access
 
     def add_message(self, message: str, timestamp: str = time.time(), sent_by_user: bool = False) -> None:
         """
-        Adds a message into the user message list as a dict
+        Adds a message into the user message list
 
         :param message: message to be stored
         :param timestamp: timestamp of the message
         """
-        self._messages.append({"message": message, "timestamp": timestamp, "sent by user": sent_by_user})
+        self._ensure_loaded()
+        if self._append(message, timestamp, sent_by_user):
+            self._reorders += 1
 
-        # Subclass dict to enable serialization
-        dict.__setitem__(self, 'messages', self._messages)
+    def add_messages(self, messages: list, sent_by_user: bool = False) -> None:
+        """
+        Adds many messages at once
+
+        :param messages: list of dicts with at least "message" and "timestamp" keys, such as received messages
+        :param sent_by_user: whether the messages were sent by the local user
+        """
+        self._ensure_loaded()
+        if self._extend(messages, sent_by_user):
+            self._reorders += 1
+
+    def get_messages(self) -> "MessageList":
+        """
+        Returns the messages of the user as a sequence of message dicts in timestamp order
+
+        :return: MessageList of message dicts
+        """
+        self._ensure_loaded()
+        return MessageList(self)
+
+    def _between(self, start: float, end: float) -> range:
+        """
+        Returns the range of positions in timestamp order of the messages with start <= timestamp < end.
+        """
+        self._ensure_loaded()
+        if self._order is None:
+            lo = bisect_left(self._times, start)
+            return range(lo, bisect_left(self._times, end, lo))
+
+        key = self._times.__getitem__
+        lo = bisect_left(self._order, start, key=key)
+        return range(lo, bisect_left(self._order, end, lo, key=key))
 
-    def get_messages(self) -> list[dict]:
+    def messages_between(self, start, end) -> list[dict]:
         """
-        Returns a list of message dicts from user
+        Returns the messages with start <= timestamp < end in timestamp order
+
+        :param start: earliest timestamp, as a float or a string
+        :param end: timestamp after the latest message, as a float or a string
+
+        :return: list of message dicts
+        """
+        return [self._message(self._index(position)) for position in self._between(float(start), float(end))]
+
+    def latest(self, n: int) -> list[dict]:
+        """
+        Returns the n latest messages, oldest first
 
         :return: list of message dicts
         """
-        return self._messages
+        return self.get_messages()[-n:] if n > 0 else []
+
+
+class MessageList(Sequence):
+    """
+    Read only view of a user's messages in timestamp order that builds each message dict when it is accessed. The
+    view is live, messages added to the user later show up in it, so a view shared with a thread that changes the
+    user must only be read while holding the lock that thread changes it under. Slices are plain lists.
+    """
+    __slots__ = ("_user",)
+
+    def __init__(self, user: User):
+        self._user = user
+
+    def __len__(self) -> int:
+        self._user._ensure_loaded()
+        return len(self._user._texts)
+
+    def __getitem__(self, i):
+        user = self._user
+        user._ensure_loaded()
+        if isinstance(i, slice):
+            return [user._message(user._index(j)) for j in range(*i.indices(len(user._texts)))]
+        if i < 0:
+            i += len(user._texts)
+        if not 0 <= i < len(user._texts):
+            raise IndexError("message index out of range")
+        return user._message(user._index(i))
+
+    def __iter__(self):
+        user = self._user
+        user._ensure_loaded()
+        for i in (range(len(user._texts)) if user._order is None else user._order):
+            yield user._message(i)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (MessageList, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+class DsuConnection:
+    """
+    Class to hold a single connection to the DSU server. The connection can be kept open and reused for many requests.
+    """
+    def __init__(self, dsuserver: str = "168.235.86.101", port: int = 3021, timeout: float = None):
+        self.dsuserver = dsuserver
+        self.port = port
+        self.timeout = timeout
+
+        self._client = None
+        self._send = None
+        self._recv = None
+        # True until the first request over a newly opened socket has completed
+        self._fresh = True
+
+    def is_open(self) -> bool:
+        """
+        Returns True if the connection currently holds an open socket.
+        """
+        return self._client is not None
+
+    def connect(self) -> None:
+        """
+        Opens the socket to the server if it is not already open.
+
+        Raises socket.error if the server could not be reached.
+        """
+        if self.is_open():
+            return
+
+        client = socket.create_connection((self.dsuserver, self.port), timeout=self.timeout)
+
+        # Create the abstraction files
+        self._client = client
+        self._send = client.makefile('w', encoding='utf-8')
+        # Responses are read as bytes, ds_protocol decodes them without an extra str copy
+        self._recv = client.makefile('rb')
+        self._fresh = True
+
+    def request(self, data: str, timings: dict = None) -> bytes:
+        """
+        Sends a single request to the server and waits for its one line response. A reused connection the server
+        dropped is reopened as long as the request has not reached it, see _open and _write. Once the request was
+        written a failure is raised instead of sending it again, as the server may already have acted on it.
+
+        :param data: json request to be sent
+        :param timings: if given, the seconds spent on "write" and "reply" are stored in it
+
+        :return: the raw response line from the server
+        """
+        try:
+            return self._exchange(data, timings)
+        except (OSError, EOFError):
+            self.close()
+            raise
+
+    def _exchange(self, data: str, timings: dict = None) -> bytes:
+        """
+        Writes one request and reads one response line over the connection, opening it first if needed.
+        """
+        reused = self._open()
+
+        started = time.perf_counter() if timings is not None else None
+        self._write(data, reused)
+
+        if started is not None:
+            written = time.perf_counter()
+            timings["write"] = written - started
+        srv_msg = self._recv.readline()
+        if started is not None:
+            timings["reply"] = time.perf_counter() - written
+
+        # A read that is empty or ends without a newline means the server closed the connection on us
+        if not srv_msg.endswith(b"\n"):
+            raise EOFError("Server closed the connection.")
+
+        self._fresh = False
+        return srv_msg
+
+    def _open(self) -> bool:
+        """
+        Opens the connection for the next request. Between requests the server has nothing to send, so a reused
+        socket that is readable was closed by the server while it sat idle, and is replaced before anything is
+        written to it.
+
+        :return: True if the request goes over a socket that already carried a request
+        """
+        if self.is_open() and not self._fresh:
+            try:
+                readable = select.select([self._client], [], [], 0)[0]
+            except (OSError, ValueError):
+                readable = True
+            if readable:
+                self.close()
+
+        reused = self.is_open() and not self._fresh
+        self.connect()
+        return reused
+
+    def _write(self, data: str, reused: bool) -> None:
+        """
+        Writes one request line. If the write fails over a reused socket it is repeated once on a new connection:
+        the line never reached the server whole, so the server cannot have acted on it.
+        """
+        line = data if data.endswith("\r\n") else data + "\r\n"
+        try:
+            self._send.write(line)
+            self._send.flush()
+        except OSError:
+            self.close()
+            if not reused:
+                raise
+            self.connect()
+            self._send.write(line)
+            self._send.flush()
+
+    def stream(self, data: str, chunk_size: int = 65536):
+        """
+        Sends one request and yields its response line in chunks of at most chunk_size bytes, for responses too
+        large to read at once. If the caller stops before the end of the response, the connection is closed so the
+        rest of it is never read as the answer to a later request. Like request, it is only sent again if it never
+        reached the server.
+
+        :param data: json request to be sent
+        :param chunk_size: maximum number of bytes per chunk
+
+        :return: generator of byte chunks, the last one ends with the newline
+        """
+        complete = False
+        try:
+            reused = self._open()
+            self._write(data, reused)
+            chunk = self._recv.readline(chunk_size)
+            while True:
+                if not chunk:
+                    raise EOFError("Server closed the connection.")
+                yield chunk
+                if chunk.endswith(b"\n"):
+                    break
+                chunk = self._recv.readline(chunk_size)
+            complete = True
+            self._fresh = False
+        finally:
+            if not complete:
+                self.close()
+
+    def request_many(self, requests: list, window: int = 64, timings: dict = None) -> list:
+        """
+        Pipelines several requests over the connection: a window of requests is written without waiting, then their
+        response lines are read back in order. Windows keep both sides from blocking on full socket buffers.
+
+        A reused connection the server dropped while idle is reopened before anything is written. Requests are never
+        sent again once writing has started, since some of them may have reached the server.
+
+        :param requests: json requests to be sent
+        :param window: maximum number of requests written before reading their responses
+        :param timings: if given, the seconds spent on "write" and "reply", summed over all windows, are stored in it
+
+        :return: list of raw response lines in request order, None for requests that got no response
+        """
+        try:
+            return self._exchange_many(requests, window, timings)
+        except (OSError, EOFError):
+            self.close()
+            raise
+
+    def _exchange_many(self, requests: list, window: int, timings: dict = None) -> list:
+        """
+        Writes and reads a batch of requests window by window. Raises if the connection fails before the first
+        response, otherwise the unanswered requests are returned as None.
+        """
+        self._open()
+
+        write = reply = 0.0
+        responses = []
+        try:
+            for start in range(0, len(requests), window):
+                chunk = requests[start:start + window]
+                started = time.perf_counter() if timings is not None else None
+                self._send.write("".join(data if data.endswith("\r\n") else data + "\r\n" for data in chunk))
+                self._send.flush()
+                if started is not None:
+                    written = time.perf_counter()
+                    write += written - started
+
+                for _ in chunk:
+                    srv_msg = self._recv.readline()
+                    if not srv_msg.endswith(b"\n"):
+                        raise EOFError("Server closed the connection.")
+                    responses.append(srv_msg)
+                    self._fresh = False
+                if started is not None:
+                    reply += time.perf_counter() - written
+        except (OSError, EOFError):
+            if not responses:
+                raise
+            self.close()
+            responses.extend([None] * (len(requests) - len(responses)))
+
+        if timings is not None:
+            timings["write"] = write
+            timings["reply"] = reply
+        return responses
+
+    def close(self) -> None:
+        """
+        Closes the socket and its abstraction files. Safe to call more than once.
+        """
+        for f in (self._send, self._recv, self._client):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+        self._client = None
+        self._send = None
+        self._recv = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Class to share open connections to one DSU server between many threads.
+    """
+    def __init__(self, dsuserver: str = "168.235.86.101", port: int = 3021, max_size: int = 8, timeout: float = None):
+        self.dsuserver = dsuserver
+        self.port = port
+        self.timeout = timeout
+
+        self._idle = []
+        self._lock = threading.Lock()
+        # Limits how many connections can be checked out at the same time
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+
+    def acquire(self) -> DsuConnection:
+        """
+        Checks out a connection from the pool. Blocks while max_size connections are already in use.
+
+        :return: an idle connection if one is available, otherwise a new unopened one
+        """
+        if self._closed:
+            raise RuntimeError("Connection pool has been closed.")
+
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        return DsuConnection(self.dsuserver, self.port, self.timeout)
+
+    def release(self, connection: DsuConnection, discard: bool = False) -> None:
+        """
+        Returns a connection to the pool.
+
+        :param connection: connection previously returned by acquire
+        :param discard: closes the connection instead of keeping it for reuse
+        """
+        if discard or self._closed or not connection.is_open():
+            connection.close()
+        else:
+            with self._lock:
+                self._idle.append(connection)
+
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks a connection out of the pool and returns it afterwards.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self) -> None:
+        """
+        Closes all idle connections. Connections still checked out are closed when they are released.
+        """
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TokenCache:
+    """
+    Class to hold session tokens shared by every DirectMessenger in the process, keyed by (server, port, username).
+    """
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, dsuserver: str, port: int, username: str, password: str) -> str:
+        """
+        Returns the cached token for the account, or None if there is none or it was joined with another password.
+        """
+        with self._lock:
+            entry = self._tokens.get((dsuserver, port, username))
+
+        if entry is None or entry[0] != password:
+            return None
+
+        return entry[1]
+
+    def set(self, dsuserver: str, port: int, username: str, password: str, token: str) -> None:
+        """
+        Stores the token returned by joining the server.
+        """
+        with self._lock:
+            self._tokens[(dsuserver, port, username)] = (password, token)
+
+    def invalidate(self, dsuserver: str, port: int, username: str, token: str = None) -> None:
+        """
+        Drops the cached token for the account. If token is given, it is only dropped if it is still the cached one,
+        so a token another thread just refreshed is kept.
+        """
+        key = (dsuserver, port, username)
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is not None and (token is None or entry[1] == token):
+                del self._tokens[key]
+
+    def clear(self) -> None:
+        """
+        Drops every cached token.
+        """
+        with self._lock:
+            self._tokens.clear()
+
+
+# Process wide token cache used by default by every DirectMessenger
+TOKEN_CACHE = TokenCache()
+
+
+class IncompleteStreamError(Exception):
+    """
+    Raised by DirectMessenger.iter_all(strict=True) when the messages could not be retrieved in full, so the
+    caller does not mistake the messages it got so far for the whole history.
+    """
+    pass
 
 
 class DirectMessenger:
     """
     Class to support sending messages to and from a remote server.
+
+    By default every request opens its own connection. Pass persistent=True to keep one connection open for the
+    lifetime of the messenger, or pass a ConnectionPool to share connections with other messengers. Session tokens are
+    shared through TOKEN_CACHE unless token_cache=None is passed.
+
+    Latencies and errors are recorded into metrics, the process wide ds_metrics.METRICS by default, which collects
+    nothing until it is enabled.
     """
-    def __init__(self, dsuserver: str = "168.235.86.101", port: int = 3021, username: str = None, password: str = None):
+    def __init__(self, dsuserver: str = "168.235.86.101", port: int = 3021, username: str = None, password: str = None,
+                 persistent: bool = False, pool: ConnectionPool = None, timeout: float = None,
+                 token_cache: TokenCache = TOKEN_CACHE, metrics: Metrics = METRICS):
         self.dsuserver = dsuserver
         self.port = port
         self.username = username
         self.password = password
+        self.token = None
+
+        self._pool = pool
+        self._connection = DsuConnection(dsuserver, port, timeout) if persistent and pool is None else None
+        self._timeout = timeout
+        self._token_cache = token_cache
+        self._metrics = metrics
 
         if not self.get_token():
             print("Token was unable to be retrieved.")
 
-    def get_token(self) -> bool:
+    def close(self) -> None:
+        """
+        Closes the persistent connection, if there is one. The messenger reconnects if it is used again.
+        """
+        if self._connection is not None:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self) -> dict:
+        """
+        Returns the latency histograms and error counters collected so far, see ds_metrics.Metrics.stats. Messengers
+        sharing a Metrics object share their stats.
         """
-        Retrieves the unique user token from the server.
+        return self._metrics.stats()
 
-        :return: True if token was successfully retrieved, False otherwise
+    @contextmanager
+    def _checkout(self):
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+        Context manager that provides the connection for one request. Pooled connections are returned to the pool
+        afterwards and per-request connections are closed.
+        """
+        if self._pool is not None:
+            connection = self._pool.acquire()
+        elif self._connection is not None:
+            connection = self._connection
+        else:
+            connection = DsuConnection(self.dsuserver, self.port, self._timeout)
+
+        failed = True
+        try:
+            yield connection
+            failed = False
+        finally:
+            if self._pool is not None:
+                self._pool.release(connection, discard=failed)
+            elif connection is not self._connection:
+                connection.close()
+
+    def _request(self, data, error_msg: str, operation: str = "request"):
+        """
+        Sends a request over the connection used by this messenger and returns the server's response line.
+
+        :param data: json request to be sent, or a list of requests to pipeline
+        :param error_msg: message printed if the request could not be completed
+        :param operation: name the connect, write and reply timings and errors are recorded under
+
+        :return: the raw server response (a list of them for a list of requests), or None if the request failed
+        """
+        metrics = self._metrics if self._metrics is not None and self._metrics.enabled else None
+
+        with self._checkout() as connection:
             # Try to connect to the provided server IP and port
+            started = metrics.start() if metrics is not None and not connection.is_open() else None
             try:
-                client.connect((self.dsuserver, self.port))
+                connection.connect()
             except socket.error:
+                if metrics is not None:
+                    metrics.error(operation, "connect")
                 print("Could not connect to server. Check your IP and Port.")
-                return False
-
-            # Create the abstraction files
-            send = client.makefile('w')
-            recv = client.makefile('r')
+                return None
+            if started is not None:
+                metrics.observe_since(operation, "connect", started)
 
-            # Join the server with username and password
-            # Encode the data
+            # Send the data and wait for the reply
+            timings = {} if metrics is not None else None
             try:
-                data = ds_protocol.encode_json("join", self.username, self.password, '')
-            except:
-                print("Join data could not be encoded to json.")
-                return False
+                if isinstance(data, list):
+                    srv_msg = connection.request_many(data, timings=timings)
+                else:
+                    srv_msg = connection.request(data, timings)
+            except (OSError, EOFError) as e:
+                connection.close()
+                if metrics is not None:
+                    metrics.error(operation, error_kind(e))
+                print(error_msg)
+                return None
+
+            if metrics is not None:
+                for phase, seconds in timings.items():
+                    metrics.observe(operation, phase, seconds)
+            return srv_msg
+
+    def _decode(self, srv_msg, operation: str) -> ds_protocol.DataTuple:
+        """
+        Decodes a server response, timing it and counting it as an error if it cannot be decoded or is an error
+        response.
+        """
+        metrics = self._metrics if self._metrics is not None and self._metrics.enabled else None
+        if metrics is None:
+            return ds_protocol.extract_json(srv_msg)
+
+        started = metrics.start()
+        srv_data = ds_protocol.extract_json(srv_msg)
+        metrics.observe_since(operation, "decode", started)
+
+        if not srv_data:
+            metrics.error(operation, "decode")
+        elif srv_data.response_type == "error":
+            metrics.error(operation, "server")
+        return srv_data
+
+    def get_token(self, refresh: bool = False) -> bool:
+        """
+        Retrieves the unique user token from the server. A token cached by an earlier messenger for the same server
+        and username is reused instead of joining again.
+
+        :param refresh: ignores the cached token and always joins the server
+
+        :return: True if token was successfully retrieved, False otherwise
+        """
+        if not refresh and self._token_cache is not None:
+            token = self._token_cache.get(self.dsuserver, self.port, self.username, self.password)
+            if token is not None:
+                self.token = token
+                return True
 
-            # Send the data
+        metrics = self._metrics
+        started = metrics.start() if metrics is not None else None
+
+        # Join the server with username and password
+        # Encode the data
+        try:
+            data = ds_protocol.encode_json("join", self.username, self.password, '')
+        except:
+            if started is not None:
+                metrics.error("join", "encode")
+            print("Join data could not be encoded to json.")
+            return False
+
+        # Send the data and receive server response
+        srv_msg = self._request(data, "An error occurred while trying to join the server.", "join")
+        if srv_msg is None:
+            return False
+
+        srv_data = self._decode(srv_msg, "join")
+        if started is not None:
+            metrics.observe_since("join", "total", started)
+
+        # Will evaluate true if extracting encountered a JSONDecodeError
+        if not srv_data:
+            return False
+
+        # If server responds with an error then print error and return False
+        if srv_data.response_type == "error":
+            print("Invalid password or username already taken.")
+            return False
+
+        self.token = srv_data.token
+        if self._token_cache is not None:
+            self._token_cache.set(self.dsuserver, self.port, self.username, self.password, self.token)
+
+        return True
+
+    def _token_request(self, directmessage, error_msg: str, operation: str) -> ds_protocol.DataTuple:
+        """
+        Sends a directmessage request that is authorized by the session token. If the server rejects the request,
+        the messenger joins again once and retries with the new token.
+
+        :param directmessage: the directmessage payload, either a message dict or "new"/"all"
+        :param error_msg: message printed if the request could not be completed
+        :param operation: name the timings and errors are recorded under
+
+        :return: the decoded server response, or None if the request failed
+        """
+        for attempt in range(2):
+            # Encode the message and recipient
             try:
-                send.write(data)
-                send.flush()
+                data = ds_protocol.encode_json("directmessage", token=self.token, directmessage=directmessage)
             except:
-                print("An error occurred while trying to join the server.")
-                return False
+                if self._metrics is not None:
+                    self._metrics.error(operation, "encode")
+                print("Direct message could not be encoded to json.")
+                return None
 
-            # Receive server response and extract token
-            srv_msg = recv.readline()
-            srv_data = ds_protocol.extract_json(srv_msg)
+            # Send the data and receive server response
+            srv_msg = self._request(data, error_msg, operation)
+            if srv_msg is None:
+                return None
+
+            srv_data = self._decode(srv_msg, operation)
 
             # Will evaluate true if extracting encountered a JSONDecodeError
             if not srv_data:
-                return False
+                return None
 
-            # If server responds with an error then print error and return False
-            if srv_data.response_type == "error":
-                print("Invalid password or username already taken.")
-                return False
+            if srv_data.response_type != "error" or attempt == 1:
+                return srv_data
 
-            self.token = srv_data.token
+            # The token may have expired, join again and only retry if the server handed out a different token
+            old_token = self.token
+            if self._token_cache is not None:
+                self._token_cache.invalidate(self.dsuserver, self.port, self.username, old_token)
+            if not self.get_token(refresh=True) or self.token == old_token:
+                return srv_data
+
+        return srv_data
 
-        return True
-		
     def send(self, recipient:str, message:str, profile = None) -> bool:
         """
         Sends a message to a recipient through the DSU server
 
         :param message: the message to be sent
         :param recipient: the recipient of the message
+        :param profile: profile the sent message is recorded into, if given
 
         :return: True if the message was successfully sent, False otherwise
         """
-        message_obj = DirectMessage(recipient, message)
+        started = self._metrics.start() if self._metrics is not None else None
+        message_obj = DirectMessage(recipient, message, time.time())
         message_dict = {"entry": message_obj.message, "recipient": message_obj.recipient, "timestamp": message_obj.timestamp}
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-            # Try to connect to the provided server IP and port
-            try:
-                client.connect((self.dsuserver, self.port))
-            except socket.error:
-                print("Could not connect to server. Check your IP and Port.")
-                return False
+        srv_data = self._token_request(message_dict, "An error occurred while sending the message to the server.", "send")
+        if started is not None:
+            self._metrics.observe_since("send", "total", started)
+        if not srv_data:
+            return False
 
-            # Create the abstraction files
-            send = client.makefile('w')
-            recv = client.makefile('r')
+        # If server responds with an error then print error and return False
+        if srv_data.response_type == "error":
+            print("Message could not be sent.")
+            return False
 
-            # Encode the message and recipient
+        # Add our sent message into our profile object
+        if profile is not None:
+            profile.add_message(our_message=message_obj)
+
+        # Return True if no operation failed
+        return True
+
+    def send_many(self, messages: list, profile = None) -> list:
+        """
+        Sends many messages over one connection without waiting for each reply in turn.
+
+        :param messages: list of (recipient, message) pairs, or (recipient, message, timestamp) triples to send
+                         messages with the time they were written instead of now
+        :param profile: profile every successfully sent message is recorded into, if given
+
+        :return: list of booleans, True for each message that was successfully sent
+        """
+        started = self._metrics.start() if self._metrics is not None else None
+        message_objs = [DirectMessage(message[0], message[1], message[2] if len(message) > 2 else time.time())
+                        for message in messages]
+        results = [False] * len(message_objs)
+        pending = list(range(len(message_objs)))
+
+        for attempt in range(2):
+            # Encode every message that still has to be sent
             try:
-                data = ds_protocol.encode_json("directmessage", token=self.token, directmessage=message_dict)
+                data = [ds_protocol.encode_json("directmessage", token=self.token, directmessage={
+                            "entry": message_objs[i].message, "recipient": message_objs[i].recipient,
+                            "timestamp": message_objs[i].timestamp}) for i in pending]
             except:
+                if self._metrics is not None:
+                    self._metrics.error("send_many", "encode")
                 print("Direct message could not be encoded to json.")
-                return False
+                break
 
-            # Send the data
-            try:
-                send.write(data)
-                send.flush()
-            except:
-                print("An error occurred while sending the message to the server.")
-                return False
+            srv_msgs = self._request(data, "An error occurred while sending the messages to the server.", "send_many")
+            if srv_msgs is None:
+                break
 
-            # Receive server response
-            srv_msg = recv.readline()
-            srv_data = ds_protocol.extract_json(srv_msg)
+            rejected = []
+            for i, srv_msg in zip(pending, srv_msgs):
+                srv_data = self._decode(srv_msg, "send_many") if srv_msg else None
+                if srv_data and srv_data.response_type != "error":
+                    results[i] = True
+                elif srv_data:
+                    rejected.append(i)
 
-            # Will evaluate true if extracting encountered a JSONDecodeError
-            if not srv_data:
-                return False
+            # Only resend rejected messages if joining again gives us a different token
+            if not rejected or attempt == 1:
+                break
+            old_token = self.token
+            if self._token_cache is not None:
+                self._token_cache.invalidate(self.dsuserver, self.port, self.username, old_token)
+            if not self.get_token(refresh=True) or self.token == old_token:
+                break
+            pending = rejected
 
-            # If server responds with an error then print error and return False
-            if srv_data.response_type == "error":
-                print("Message could not be sent.")
-                return False
+        if started is not None:
+            self._metrics.observe_since("send_many", "total", started)
+        if not all(results):
+            print(f"{results.count(False)} of {len(results)} messages could not be sent.")
 
-        # Add our sent message into our profile object
-        profile.add_message(our_message=message_obj)
+        # Add every sent message into our profile object at once
+        if profile is not None:
+            sent = [message_obj for message_obj, ok in zip(message_objs, results) if ok]
+            if sent:
+                profile.add_message(our_messages=sent)
+
+        return results
 
-        # Return True if no operation failed
-        return True
-		
     def retrieve_new(self, to_retrieve: str = "new") -> list:
         """
         Retrieves all new messages from the server.
@@ -179,49 +1172,116 @@ class DirectMessenger:
 
         :return: list of new messages
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-            # Try to connect to the provided server IP and port
-            try:
-                client.connect((self.dsuserver, self.port))
-            except socket.error:
-                print("Could not connect to server. Check your IP and Port.")
-                return None
+        operation = "retrieve_new" if to_retrieve == "new" else "retrieve_all"
+        started = self._metrics.start() if self._metrics is not None else None
 
-            # Create the abstraction files
-            send = client.makefile('w')
-            recv = client.makefile('r')
+        srv_data = self._token_request(to_retrieve, "An error occurred while sending the message to the server.", operation)
+        if started is not None:
+            self._metrics.observe_since(operation, "total", started)
+        if not srv_data:
+            return None
 
-            # Encode the message and recipient
+        # If server responds with an error then print error and return False
+        if srv_data.response_type == "error":
+            print("Message could not be sent.")
+            return None
+
+        # Return True if no operation failed
+        return srv_data.response_message
+ 
+    def iter_all(self, chunk_size: int = 65536, to_retrieve: str = "all", strict: bool = False):
+        """
+        Retrieves messages from the server, yielding each message dict as soon as it is decoded off the socket
+        instead of reading and parsing the whole response first.
+
+        :param chunk_size: maximum number of bytes read from the socket at a time
+        :param to_retrieve: "all" or "new"
+        :param strict: raise IncompleteStreamError when the messages cannot be retrieved in full, instead of
+                       printing the error and ending the stream early
+
+        :return: generator of message dicts in the format {"message": x, "from": y, "timestamp": z}
+        """
+        def fail(error: str):
+            if strict:
+                raise IncompleteStreamError(error)
+            print(error)
+
+        for attempt in range(2):
             try:
                 data = ds_protocol.encode_json("directmessage", token=self.token, directmessage=to_retrieve)
             except:
-                print("Direct message could not be encoded to json.")
-                return None
+                return fail("Direct message could not be encoded to json.")
 
-            # Send the data
-            try:
-                send.write(data)
-                send.flush()
-            except:
-                print("An error occurred while sending the message to the server.")
-                return None
+            parser = ds_protocol.MessageStreamParser()
+            metrics = self._metrics if self._metrics is not None and self._metrics.enabled else None
+            with self._checkout() as connection:
+                started = metrics.start() if metrics is not None and not connection.is_open() else None
+                try:
+                    connection.connect()
+                except socket.error:
+                    if metrics is not None:
+                        metrics.error("iter_all", "connect")
+                    return fail("Could not connect to server. Check your IP and Port.")
+                if started is not None:
+                    metrics.observe_since("iter_all", "connect", started)
 
-            # Receive server response
-            srv_msg = recv.readline()
-            srv_data = ds_protocol.extract_json(srv_msg)
+                try:
+                    for chunk in connection.stream(data, chunk_size):
+                        yield from parser.feed(chunk)
+                except (OSError, EOFError) as e:
+                    if metrics is not None:
+                        metrics.error("iter_all", error_kind(e))
+                    return fail("An error occurred while retrieving messages from the server.")
+                except ValueError:
+                    if metrics is not None:
+                        metrics.error("iter_all", "decode")
+                    return fail("Json cannot be decoded.")
 
-            # Will evaluate true if extracting encountered a JSONDecodeError
-            if not srv_data:
-                return None
+            if parser.found:
+                # A response line that ends before the list is closed is cut off as well
+                if not parser.done:
+                    return fail("Json cannot be decoded.")
+                return
 
-            # If server responds with an error then print error and return False
-            if srv_data.response_type == "error":
-                print("Message could not be sent.")
-                return None
+            # Not a list of messages, most likely an error response
+            srv_data = ds_protocol.extract_json(parser.text)
+            if not srv_data or srv_data.response_type != "error":
+                if strict:
+                    raise IncompleteStreamError("The server did not send a list of messages.")
+                return
+
+            # The token may have expired, join again and only retry if the server handed out a different token
+            old_token = self.token
+            if self._token_cache is not None:
+                self._token_cache.invalidate(self.dsuserver, self.port, self.username, old_token)
+            if attempt == 1 or not self.get_token(refresh=True) or self.token == old_token:
+                return fail("Message could not be sent.")
+
+    def retrieve_all_into(self, profile, chunk_size: int = 1000) -> int:
+        """
+        Streams all messages from the server into a profile, adding them chunk_size messages at a time so memory
+        use stays bounded however long the history is.
+
+        :param profile: profile the messages are added to
+        :param chunk_size: number of messages passed to each add_message call
+
+        :return: the number of messages added
+        """
+        count = 0
+        chunk = []
+        for message in self.iter_all():
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                profile.add_message(new_messages=chunk)
+                count += len(chunk)
+                chunk = []
+
+        if chunk:
+            profile.add_message(new_messages=chunk)
+            count += len(chunk)
+
+        return count
 
-        # Return True if no operation failed
-        return srv_data.response_message
- 
     def retrieve_all(self) -> list:
         """
         Retrieves all messages from the server.
@@ -229,4 +1289,4 @@ class DirectMessenger:
         :return: list of all messages
         """
         # Calls the retreive_new method with agument "all" instead of default "new"
-        return self.retrieve_new(to_retrieve="all")
\ No newline at end of file
+        return self.retrieve_new(to_retrieve="all")
@@ -0,0 +1,168 @@
+# ds_metrics.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import socket
+import threading
+import time
+from bisect import bisect_left
+
+
+
+# Upper bounds in seconds of the histogram buckets, doubling from 50 microseconds to about 100 seconds
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(22))
+
+
+class Histogram:
+    """
+    Latency histogram with fixed, exponentially growing buckets. Percentiles are estimated as the upper bound of the
+    bucket they fall in.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = percent / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min or 0.0,
+            "max": self.max or 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {("%g" % bound if i < len(BUCKETS) else "inf"): count
+                        for i, (bound, count) in enumerate(zip(BUCKETS + (None,), self.counts)) if count},
+        }
+
+
+def error_kind(error: BaseException) -> str:
+    """
+    Returns the error counter name for an exception raised while talking to the server.
+    """
+    if isinstance(error, socket.timeout):
+        return "timeout"
+    if isinstance(error, EOFError):
+        return "closed"
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, socket.gaierror):
+        return "dns"
+    return "io"
+
+
+class Metrics:
+    """
+    Per-operation latency histograms and error counters for DirectMessenger.
+
+    Operations are "join", "send", "send_many", "retrieve_new", "retrieve_all" and "iter_all". Each is timed in the
+    phases "connect" (opening a socket, only when a new one is opened), "write", "reply" (waiting for and reading the
+    response), "decode" and "total". Errors are counted by kind: "connect", "timeout", "closed", "refused", "dns",
+    "io", "encode", "decode" and "server" for error responses.
+
+    While disabled, start returns None and every other call returns at once, so instrumented code pays one
+    attribute check per operation. Hooks are called as hook(event, operation, name, value) with event "timing" (name
+    is the phase, value the seconds) or "error" (name is the kind, value 1), on the thread that made the request.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._timings = {}
+        self._errors = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def add_hook(self, hook) -> None:
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook) -> None:
+        if hook in self._hooks:
+            self._hooks.remove(hook)
+
+    def start(self):
+        """
+        Returns a start time for observe_since, or None while disabled.
+        """
+        return time.perf_counter() if self.enabled else None
+
+    def observe_since(self, operation: str, phase: str, started: float) -> None:
+        if started is not None:
+            self.observe(operation, phase, time.perf_counter() - started)
+
+    def observe(self, operation: str, phase: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+
+        with self._lock:
+            phases = self._timings.setdefault(operation, {})
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = Histogram()
+            histogram.observe(seconds)
+
+        for hook in self._hooks:
+            hook("timing", operation, phase, seconds)
+
+    def error(self, operation: str, kind: str) -> None:
+        if not self.enabled:
+            return
+
+        with self._lock:
+            errors = self._errors.setdefault(operation, {})
+            errors[kind] = errors.get(kind, 0) + 1
+
+        for hook in self._hooks:
+            hook("error", operation, kind, 1)
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the collected metrics:
+        {"timings": {operation: {phase: histogram dict}}, "errors": {operation: {kind: count}}}
+        """
+        with self._lock:
+            return {
+                "timings": {operation: {phase: histogram.to_dict() for phase, histogram in phases.items()}
+                            for operation, phases in self._timings.items()},
+                "errors": {operation: dict(errors) for operation, errors in self._errors.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._timings = {}
+            self._errors = {}
+
+
+# Process wide metrics used by default by every DirectMessenger, disabled until METRICS.enable() is called
+METRICS = Metrics()
@@ -0,0 +1,144 @@
+# ds_outbox.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from ds_messenger import DirectMessage
+
+
+
+class Outbox:
+    """
+    Messages waiting to be sent, kept in a file so they survive a restart. By convention the file is the profile path
+    with '.outbox' appended.
+
+    The file is a log of json lines, {"id": n, "recipient": x, "message": y, "timestamp": z} when a message is queued
+    and {"delivered": [ids]} once messages were sent. It is removed once every queued message is delivered, and
+    rewritten with only the waiting messages once it holds compact_after delivered records.
+
+    put is called from the GUI thread and the other methods from the sync worker, so they all hold a lock.
+    """
+    def __init__(self, path: str, compact_after: int = 256):
+        self.path = Path(path)
+        self.compact_after = compact_after
+
+        # Message id -> DirectMessage, in the order they were queued
+        self._queue = {}
+        self._next_id = 1
+        self._delivered_records = 0
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash while appending leaves a partial last line
+                continue
+
+            if "delivered" in record:
+                for message_id in record["delivered"]:
+                    self._queue.pop(message_id, None)
+                self._delivered_records += 1
+            else:
+                self._queue[record["id"]] = DirectMessage(record["recipient"], record["message"], record["timestamp"])
+                self._next_id = max(self._next_id, record["id"] + 1)
+
+        # Records appended after a partial line would be joined to it, so start over from a clean file
+        if lines and not lines[-1].endswith("\n"):
+            self._rewrite()
+
+    def _append(self, record: dict) -> None:
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self) -> None:
+        """
+        Replaces the file with one holding only the waiting messages, atomically.
+        """
+        tmp_path = Path(str(self.path) + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write("".join(json.dumps(_record(message_id, message_obj)) + "\n"
+                            for message_id, message_obj in self._queue.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._delivered_records = 0
+
+    def put(self, recipient: str, message: str, timestamp: float = None) -> DirectMessage:
+        """
+        Queues a message, returning once it is written to the file.
+
+        :param timestamp: time the message was written, by default now
+
+        :return: the queued message
+        """
+        message_obj = DirectMessage(recipient, message, time.time() if timestamp is None else timestamp)
+        with self._lock:
+            self._append(_record(self._next_id, message_obj))
+            self._queue[self._next_id] = message_obj
+            self._next_id += 1
+
+        return message_obj
+
+    def pending(self) -> list:
+        """
+        Returns the waiting messages as (message id, DirectMessage) pairs, in the order they were queued.
+        """
+        with self._lock:
+            return list(self._queue.items())
+
+    def mark_delivered(self, message_ids: list) -> None:
+        """
+        Removes delivered messages from the outbox.
+        """
+        with self._lock:
+            message_ids = [message_id for message_id in message_ids if message_id in self._queue]
+            if not message_ids:
+                return
+
+            for message_id in message_ids:
+                del self._queue[message_id]
+
+            if not self._queue:
+                if self.path.exists():
+                    self.path.unlink()
+                self._delivered_records = 0
+            elif self._delivered_records >= self.compact_after:
+                self._rewrite()
+            else:
+                self._append({"delivered": message_ids})
+                self._delivered_records += 1
+
+    def restore(self, profile) -> None:
+        """
+        Shows the waiting messages as pending in a profile. Messages the profile does not have, because it was not
+        saved after they were queued, are added to it.
+        """
+        for _, message_obj in self.pending():
+            if not profile.set_pending(message_obj, True):
+                profile.add_message(our_message=message_obj, pending=True)
+
+
+def _record(message_id: int, message_obj: DirectMessage) -> dict:
+    return {"id": message_id, "recipient": message_obj.recipient, "message": message_obj.message,
+            "timestamp": message_obj.timestamp}
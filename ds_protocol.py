@@ -4,46 +4,218 @@
 # ryanyz@uci.edu, pathaky@uci.edu
 # 20907746, 51317074
 
+import codecs
 import json
+import re
 from collections import namedtuple
+from functools import lru_cache
+from typing import TypedDict
+from json.encoder import encode_basestring_ascii
 import time
 
+# Use the fastest json library that is installed, the standard json module is the fallback. Like json.dumps, every
+# backend only writes ascii, non-ascii text is sent as \u escapes
+try:
+    import orjson
+
+    def _loads(data):
+        return orjson.loads(data)
+
+    def _dumps(obj) -> str:
+        # orjson cannot escape non-ascii text, so strings, where that text is, go straight to json's C escaper, which
+        # is faster than either for them. Anything else orjson writes with non-ascii text is encoded by json instead
+        if type(obj) is str:
+            return encode_basestring_ascii(obj)
+        data = orjson.dumps(obj)
+        return data.decode() if data.isascii() else json.dumps(obj)
+
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import ujson
+
+        def _loads(data):
+            return ujson.loads(data)
+
+        def _dumps(obj) -> str:
+            return ujson.dumps(obj, escape_forward_slashes=False)
+
+        JSON_BACKEND = "ujson"
+    except ImportError:
+        _loads = json.loads
+
+        def _dumps(obj) -> str:
+            if type(obj) is str:
+                return encode_basestring_ascii(obj)
+            return json.dumps(obj)
+
+        JSON_BACKEND = "json"
+
 
 
 # Namedtuple to hold the values retrieved from json messages.
 DataTuple = namedtuple('DataTuple', ['command', 'username', 'password', 'token', 'entry', 'timestamp', 'response_type', 'response_message'])
 
+# A message returned by the server for a "new" or "all" request, response_message holds a list of these.
+# Timestamps arrive as strings.
+ServerMessage = TypedDict('ServerMessage', {'message': str, 'from': str, 'timestamp': str})
+
+
+def _decode_join(json_obj: dict) -> DataTuple:
+    join = json_obj["join"]
+    return DataTuple("join", join["username"], join["password"], join["token"], None, None, None, None)
+
+
+def _decode_post(json_obj: dict) -> DataTuple:
+    return DataTuple("post", None, None, json_obj["token"], json_obj["post"]["entry"], json_obj["post"]["timestamp"], None, None)
+
 
-def extract_json(json_msg: str) -> DataTuple:
+def _decode_bio(json_obj: dict) -> DataTuple:
+    return DataTuple("bio", None, None, json_obj["token"], json_obj["bio"]["entry"], json_obj["bio"]["timestamp"], None, None)
+
+
+def _decode_response(json_obj: dict) -> DataTuple:
+    response = json_obj["response"]
+
+    # "new" and "all" requests are answered with a list of ServerMessage dicts instead of a message string
+    if "message" in response:
+        message = response["message"]
+    else:
+        message = response["messages"]
+        if not isinstance(message, list):
+            raise ValueError("Response messages is not a list.")
+
+    return DataTuple("response", None, None, response.get("token"), None, None, response["type"], message)
+
+
+# Decoder for each kind of json message, keyed by the key that identifies the kind
+_DECODERS = {"join": _decode_join, "post": _decode_post, "bio": _decode_bio, "response": _decode_response}
+
+
+def extract_json(json_msg) -> DataTuple:
     '''
     Call the json.loads function on a json string and convert it to a DataTuple object
-    :param json_msg: json to be loaded into a DataTuple namedtuple
+    :param json_msg: json to be loaded into a DataTuple namedtuple, as str or as bytes read off the socket
 
     :return: DataTuple namedtuple
     '''
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = _loads(json_msg)
 
         # Convert json object into a Data tuple depending on the type of command being issued
-        if "join" in json_obj:
-            data = DataTuple("join", json_obj["join"]["username"], json_obj["join"]["password"], json_obj["join"]["token"], None, None, None, None)
-
-        elif "post" in json_obj:
-            data = DataTuple("post", None, None, json_obj["token"], json_obj["post"]["entry"], json_obj["post"]["timestamp"], None, None)
+        for key in json_obj:
+            decoder = _DECODERS.get(key)
+            if decoder is not None:
+                return decoder(json_obj)
 
-        elif "bio" in json_obj:
-            data = DataTuple("bio", None, None, json_obj["token"], json_obj["bio"]["entry"], json_obj["bio"]["timestamp"], None, None)
-
-        elif "response" in json_obj:
-            data = DataTuple("response", None, None, json_obj["response"]["token"] if "token" in json_obj["response"] else None, None, None, json_obj["response"]["type"], json_obj["response"]["message"] if "message" in json_obj["response"] else json_obj["response"]["messages"])
-        
-        return data
+        print("Json is not a known message.")
+        return False
 
-    except json.JSONDecodeError:
+    except (ValueError, KeyError, TypeError):
         print("Json cannot be decoded.")
         return False
 
 
+class MessageStreamParser:
+    """
+    Incrementally parses the "messages" list of a server response as it arrives in chunks, so each message can be
+    used as soon as it is decoded and the whole response never has to be held in memory.
+
+    If the response has no "messages" list, such as an error response, text holds the whole response once the last
+    chunk has been fed.
+    """
+    _MESSAGES_START = re.compile(r'"messages"\s*:\s*\[')
+
+    def __init__(self):
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        # True once the start of the messages list was found, and once its end was found
+        self.found = False
+        self.done = False
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    def feed(self, chunk: bytes, final: bool = None) -> list:
+        """
+        Adds the next chunk of the response.
+
+        :param chunk: the next bytes of the response line
+        :param final: whether this is the last chunk, defaults to whether it ends the line
+
+        :return: list of ServerMessage dicts completed by this chunk
+        """
+        final = chunk.endswith(b"\n") if final is None else final
+        self._buffer += self._utf8.decode(chunk, final)
+
+        if not self.found:
+            match = self._MESSAGES_START.search(self._buffer)
+            if match is None:
+                return []
+            self.found = True
+            self._buffer = self._buffer[match.end():]
+
+        messages = []
+        buffer = self._buffer
+        pos = 0
+        while not self.done:
+            # Skip the separators between messages
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == "]":
+                self.done = True
+                pos += 1
+                break
+
+            try:
+                message, pos = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The message is cut off at the end of the chunk, unless there is nothing more to come
+                if final:
+                    raise
+                break
+            messages.append(message)
+
+        self._buffer = buffer[pos:]
+        return messages
+
+
+def _encode_join(username: str, password: str, token: str, **_) -> str:
+    return '{"join": {"username": %s, "password": %s, "token": %s}}' % (_dumps(username), _dumps(password), _dumps(token))
+
+
+def _encode_post(command: str, token: str, entry: str, **_) -> str:
+    return '{"token": %s, "%s": {"entry": %s, "timestamp": %s}}' % (_dumps(token), command, _dumps(entry), _dumps(time.time()))
+
+
+@lru_cache(maxsize=256)
+def _encode_retrieve(token: str, directmessage: str) -> str:
+    # Polls send the same few requests over and over, so they are only encoded once per token
+    return '{"token": %s, "directmessage": %s}' % (_dumps(token), _dumps(directmessage))
+
+
+def _encode_directmessage(token: str, directmessage, **_) -> str:
+    if isinstance(directmessage, str):
+        return _encode_retrieve(token, directmessage)
+    # Encoded field by field, so the message text is escaped once, by the fast path for strings
+    return '{"token": %s, "directmessage": {"entry": %s, "recipient": %s, "timestamp": %s}}' % (
+        _dumps(token), _dumps(directmessage["entry"]), _dumps(directmessage["recipient"]),
+        _dumps(directmessage["timestamp"]))
+
+
+# Encoder for each command
+_ENCODERS = {
+    "join": _encode_join,
+    "post": lambda **kwargs: _encode_post("post", **kwargs),
+    "bio": lambda **kwargs: _encode_post("bio", **kwargs),
+    "directmessage": _encode_directmessage,
+}
+
+
 def encode_json(command: str, username: str = None, password: str = None, token: str = None, entry: str = None, directmessage: dict = None) -> json:
     '''
     Call the json.dumps function on a dict to convert it to a json object
@@ -57,14 +229,8 @@ def encode_json(command: str, username: str = None, password: str = None, token:
     :return: json with information wrapped to be sent to DS server
     '''
     # Encode information given in parameters into a json depending on the type of command
-    if command == "join":
-        data = {"join": {"username": username,"password": password, "token": token}}
-        return json.dumps(data)
-
-    elif command in ["post", "bio"]:
-        data = {"token": token, command: {"entry": entry, "timestamp": time.time()}}
-        return json.dumps(data)
+    encoder = _ENCODERS.get(command)
+    if encoder is None:
+        return None
 
-    elif command == "directmessage":
-        data = {"token": token, "directmessage": directmessage}
-        return json.dumps(data)
+    return encoder(username=username, password=password, token=token, entry=entry, directmessage=directmessage)
@@ -0,0 +1,360 @@
+# ds_search.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import base64
+import heapq
+import json
+import os
+import re
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from pathlib import Path
+from zlib import crc32
+
+
+
+_WORD = re.compile(r"\w+")
+
+# Number of documents indexed before their words are merged into the word lists
+FLUSH_SIZE = 65536
+# Pairs of adjacent words are hashed into this many lists, which bounds the memory they take
+PAIR_BUCKETS = 1 << 16
+
+
+def tokenize(text: str) -> list:
+    """
+    Returns the lowercase words of a text, in order.
+    """
+    return _WORD.findall(text.lower()) if text.__class__ is str else []
+
+
+class SearchIndex:
+    """
+    Inverted index over the messages of a profile. Every indexed message is a document, identified by its position
+    in the index, pointing at a user and the index of the message in that user's columns. Each word maps to the
+    documents that contain it, sorted by timestamp, so the most recent matches are read off the end of a list.
+
+    A query matches the messages that contain all of its words next to each other, in order. Pairs of adjacent
+    words are indexed too, hashed into PAIR_BUCKETS lists shared by the pairs that collide. A phrase intersects the
+    lists of its pairs, newest first and walking the shortest list, and only the documents in all of them are
+    checked against the message text, so a query stops as soon as it has limit hits.
+    """
+    def __init__(self):
+        # User objects by slot, and the slot of each user name
+        self._users = []
+        self._slots = {}
+        # Columns of the documents
+        self._doc_user = array('I')
+        self._doc_message = array('I')
+        self._times = array('d')
+        # Word -> array of documents containing it, in timestamp order
+        self._postings = {}
+        # Bucket of a pair of adjacent words -> array of documents containing a pair hashed to it, in timestamp order
+        self._pairs = {}
+
+    def __len__(self) -> int:
+        return len(self._doc_user)
+
+    def _slot(self, user) -> int:
+        slot = self._slots.get(user.name)
+        if slot is None:
+            slot = self._slots[user.name] = len(self._users)
+            self._users.append(user)
+        return slot
+
+    def add(self, user, start: int, end: int = None) -> None:
+        """
+        Indexes the messages of a user from index start up to end, by default only message start.
+        """
+        self.add_ranges([(user, start, start + 1 if end is None else end)])
+
+    def add_ranges(self, ranges: list) -> None:
+        """
+        Indexes messages of several users at once.
+
+        :param ranges: list of (user, start, end) tuples, each covering the user's messages from index start up to end
+        """
+        docs = sorted((user._times[i], self._slot(user), i) for user, start, end in ranges for i in range(start, end))
+        self._add_docs(docs)
+
+    def _add_docs(self, docs) -> None:
+        """
+        Indexes (timestamp, user slot, message index) triples. Given in timestamp order, every word list is only
+        appended to.
+        """
+        users = self._users
+        findall = _WORD.findall
+        new = defaultdict(list)
+        new_pairs = defaultdict(list)
+        slots, indices, stamps = [], [], []
+        doc = len(self._doc_user)
+
+        for timestamp, slot, i in docs:
+            text = users[slot]._texts[i]
+            if text.__class__ is str:
+                words = findall(text.lower())
+                for word in set(words):
+                    new[word].append(doc)
+                for bucket in _pair_buckets(words):
+                    new_pairs[bucket].append(doc)
+            slots.append(slot)
+            indices.append(i)
+            stamps.append(timestamp)
+            doc += 1
+
+            if len(slots) == FLUSH_SIZE:
+                self._flush(new, new_pairs, slots, indices, stamps)
+                new = defaultdict(list)
+                new_pairs = defaultdict(list)
+                slots, indices, stamps = [], [], []
+
+        self._flush(new, new_pairs, slots, indices, stamps)
+
+    def _flush(self, new: dict, new_pairs: dict, slots: list, indices: list, stamps: list) -> None:
+        """
+        Adds the collected documents to the document columns and to the word and pair lists.
+        """
+        self._doc_user.extend(slots)
+        self._doc_message.extend(indices)
+        self._times.extend(stamps)
+        self._merge(self._postings, new)
+        self._merge(self._pairs, new_pairs)
+
+    def _merge(self, lists: dict, new: dict) -> None:
+        """
+        Adds the documents collected for each key to its list, keeping the list in timestamp order.
+        """
+        times = self._times
+        for key, docs in new.items():
+            postings = lists.get(key)
+            if postings is None:
+                lists[key] = array('I', docs)
+            elif times[postings[-1]] <= times[docs[0]]:
+                postings.extend(docs)
+            else:
+                for doc in docs:
+                    insort(postings, doc, key=times.__getitem__)
+
+    @classmethod
+    def build(cls, users: list):
+        """
+        Returns an index of every message of users. Users that had their messages released are released again
+        afterwards.
+        """
+        index = cls()
+        runs = []
+        released = []
+        for user in users:
+            if not user.is_loaded():
+                released.append(user)
+            user._ensure_loaded()
+            runs.append(_timeline(user, index._slot(user)))
+
+        # Merging the users' messages, each already in timestamp order, indexes them in timestamp order
+        index._add_docs(heapq.merge(*runs))
+
+        for user in released:
+            user.release()
+
+        return index
+
+    def search(self, query: str, limit: int = 50, user_name: str = None) -> list:
+        """
+        Finds the messages containing a word or phrase.
+
+        :param query: words to look for, matched case insensitively as a phrase
+        :param limit: the most hits returned
+        :param user_name: only searches the conversation with this user
+
+        :return: list of (user name, message, timestamp) tuples, most recent first
+        """
+        words = tokenize(query)
+        if not words or limit <= 0:
+            return []
+
+        lists = [self._postings.get(word) for word in set(words)]
+        if len(words) > 1:
+            pairs = [self._pairs.get(bucket) for bucket in _pair_buckets(words)]
+            if not all(pairs):
+                return []
+            # The lists of the pairs are shorter than the ones of their words, unless a pair shares its bucket with
+            # a common one, and a word rarer than every pair narrows the candidates down best
+            shortest = min(map(len, pairs))
+            lists = pairs + [postings for postings in lists if postings is None or len(postings) < shortest]
+        if not all(lists):
+            return []
+
+        slot = None
+        if user_name is not None:
+            slot = self._slots.get(user_name)
+            if slot is None:
+                return []
+
+        # A single word needs no check, the posting list holds exactly the messages containing it
+        phrase = " %s " % " ".join(words) if len(words) > 1 else None
+
+        hits = []
+        for doc in self._newest_common(sorted(lists, key=len)):
+            if self._hit(doc, slot, phrase, hits) and len(hits) >= limit:
+                break
+        return hits
+
+    def _newest_common(self, lists: list):
+        """
+        Yields the documents found in every one of lists, newest first. The documents of the first list are
+        looked up in the others by bisection, each search starting below the previous one, so the first list
+        should be the shortest.
+        """
+        first = lists[0]
+        others = lists[1:]
+        if not others:
+            for position in range(len(first) - 1, -1, -1):
+                yield first[position]
+            return
+
+        times = self._times
+        key = times.__getitem__
+        ends = [len(postings) for postings in others]
+        for position in range(len(first) - 1, -1, -1):
+            doc = first[position]
+            timestamp = times[doc]
+            for n, postings in enumerate(others):
+                # Documents with the same timestamp are in the order they were indexed
+                end = bisect_left(postings, timestamp, 0, ends[n], key=key)
+                while end < ends[n] and postings[end] < doc and times[postings[end]] == timestamp:
+                    end += 1
+                found = end < ends[n] and postings[end] == doc
+                ends[n] = end
+                if not found:
+                    break
+            else:
+                yield doc
+                continue
+            if not end:
+                # A list has nothing older left
+                return
+
+    def _hit(self, doc: int, slot: int, phrase: str, hits: list) -> bool:
+        """
+        Adds a document to hits if it is in the user slot, when given, and contains the phrase, when given.
+
+        :return: True if the document was added
+        """
+        if slot is not None and self._doc_user[doc] != slot:
+            return False
+
+        user = self._users[self._doc_user[doc]]
+        user._ensure_loaded()
+        i = self._doc_message[doc]
+        if phrase is not None and phrase not in " %s " % " ".join(tokenize(user._texts[i])):
+            return False
+
+        message = user._message(i)
+        hits.append((user.name, message["message"], message["timestamp"]))
+        return True
+
+    def save(self, path: str, snapshot: str) -> None:
+        """
+        Writes the index to a file, replacing the old one atomically.
+
+        :param snapshot: sha1 of the DSU file the index was built for
+        """
+        counts = [0] * len(self._users)
+        for slot in self._doc_user:
+            counts[slot] += 1
+
+        obj = {
+            "snapshot": snapshot,
+            "users": [[user.name, count] for user, count in zip(self._users, counts)],
+            "doc_user": _encode(self._doc_user),
+            "doc_message": _encode(self._doc_message),
+            "times": _encode(self._times),
+            "postings": {word: _encode(postings) for word, postings in self._postings.items()},
+            "pairs": {bucket: _encode(postings) for bucket, postings in self._pairs.items()},
+        }
+
+        p = Path(path)
+        tmp_path = Path(str(p) + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, p)
+
+    @classmethod
+    def load(cls, path: str, profile, snapshot: str):
+        """
+        Reads an index written by save and indexes the messages the profile gained since, such as the ones
+        replayed from its journal.
+
+        :param snapshot: sha1 of the DSU file the profile was loaded from
+
+        :return: the index, or None if the file does not exist, cannot be read or belongs to another DSU file
+        """
+        try:
+            with open(path, 'r') as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if obj.get("snapshot") != snapshot:
+            return None
+
+        index = cls()
+        counts = []
+        for name, count in obj["users"]:
+            user = profile.get_user(name)
+            if user is None or user.message_count() < count:
+                return None
+            index._slot(user)
+            counts.append(count)
+
+        index._doc_user = _decode('I', obj["doc_user"])
+        index._doc_message = _decode('I', obj["doc_message"])
+        index._times = _decode('d', obj["times"])
+        index._postings = {word: _decode('I', postings) for word, postings in obj["postings"].items()}
+        index._pairs = {int(bucket): _decode('I', postings) for bucket, postings in obj["pairs"].items()}
+
+        ranges = []
+        for user, count in zip(list(index._users), counts):
+            if user.message_count() > count:
+                user._ensure_loaded()
+                ranges.append((user, count, len(user._texts)))
+        for user in profile.get_users():
+            if user.name not in index._slots and user.message_count():
+                user._ensure_loaded()
+                ranges.append((user, 0, len(user._texts)))
+        index.add_ranges(ranges)
+
+        return index
+
+
+def _timeline(user, slot: int):
+    """
+    Yields (timestamp, slot, message index) for every message of a user, in timestamp order.
+    """
+    times = user._times
+    for position in range(len(user._texts)):
+        i = user._index(position)
+        yield times[i], slot, i
+
+
+def _pair_buckets(words: list) -> set:
+    """
+    Returns the buckets of the pairs of adjacent words in a list of words.
+    """
+    return {crc32(("%s %s" % pair).encode()) % PAIR_BUCKETS for pair in zip(words, words[1:])}
+
+
+def _encode(values: array) -> str:
+    return base64.b64encode(values.tobytes()).decode()
+
+
+def _decode(typecode: str, data: str) -> array:
+    values = array(typecode)
+    values.frombytes(base64.b64decode(data))
+    return values
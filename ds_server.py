@@ -0,0 +1,353 @@
+# ds_server.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+"""
+Local stand-in for the DSU server and a load generator to benchmark the client against it.
+
+    python ds_server.py serve --port 3021 --latency 0.005 --error-rate 0.01
+    python ds_server.py loadgen --clients 20 --messages 200 --latency 0.002
+
+loadgen starts its own in-process server unless --host is given.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+import ds_protocol
+from ds_messenger import DirectMessenger, TokenCache
+
+
+
+class DsuServer:
+    """
+    asyncio server implementing the join and directmessage (send, "new", "all") commands of the DSU protocol, with
+    in-memory mailboxes. Each request can be delayed by latency plus up to jitter seconds, and answered with an
+    error response with probability error_rate. With probability drop_rate the connection is closed halfway through
+    writing the response instead. Connections that send no request for idle_timeout seconds are closed.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 3021, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: int = None, drop_rate: float = 0.0, idle_timeout: float = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.idle_timeout = idle_timeout
+
+        self._random = random.Random(seed)
+        # username -> password, token -> username, username -> token
+        self._passwords = {}
+        self._users = {}
+        self._tokens = {}
+        # username -> every message received, and the ones not retrieved with "new" yet
+        self._all = {}
+        self._new = {}
+
+        self._server = None
+        self._loop = None
+        self._thread = None
+        # Open client connections and their handler tasks
+        self._writers = set()
+        self._handlers = set()
+
+    async def start(self) -> None:
+        """
+        Starts listening. With port 0 a free port is picked and stored in self.port.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=2 ** 24)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_in_thread(self) -> int:
+        """
+        Runs the server on an event loop in a background thread.
+
+        :return: the port the server listens on
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self) -> None:
+        """
+        Stops a server started with start_in_thread.
+        """
+        if self._loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    async def _shutdown(self) -> None:
+        """
+        Stops listening and closes every open client connection.
+        """
+        self._server.close()
+        # Closing the streams makes every handler see the end of its connection and return
+        for writer in list(self._writers):
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                if self.idle_timeout is None:
+                    line = await reader.readline()
+                else:
+                    try:
+                        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if not line:
+                    break
+
+                delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0.0)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                if self.error_rate and self._random.random() < self.error_rate:
+                    response = _error("Injected error.")
+                else:
+                    response = self.respond(line)
+
+                data = ds_protocol._dumps(response).encode() + b"\r\n"
+                if self.drop_rate and self._random.random() < self.drop_rate:
+                    writer.write(data[:len(data) // 2])
+                    await writer.drain()
+                    break
+
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    def respond(self, line: bytes) -> dict:
+        """
+        Returns the response to one request line.
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return _error("Invalid json.")
+
+        if "join" in request:
+            return self._join(request["join"])
+
+        username = self._users.get(request.get("token"))
+        if username is None:
+            return _error("Invalid user token.")
+
+        directmessage = request.get("directmessage")
+        if isinstance(directmessage, dict):
+            return self._send(username, directmessage)
+        if directmessage == "new":
+            messages, self._new[username] = self._new[username], []
+            return {"response": {"type": "ok", "messages": messages}}
+        if directmessage == "all":
+            return {"response": {"type": "ok", "messages": self._all[username]}}
+
+        return _error("Unknown command.")
+
+    def _join(self, join: dict) -> dict:
+        username = join.get("username")
+        password = join.get("password")
+        if not username or not password:
+            return _error("Username and password are required.")
+
+        if username in self._passwords:
+            if self._passwords[username] != password:
+                return _error("Invalid password or username already taken.")
+            message = "Welcome back, " + username
+        else:
+            self._passwords[username] = password
+            self._tokens[username] = str(uuid.uuid4())
+            self._users[self._tokens[username]] = username
+            self._all.setdefault(username, [])
+            self._new.setdefault(username, [])
+            message = "Welcome to the ICS 32 Distributed Social!"
+
+        return {"response": {"type": "ok", "message": message, "token": self._tokens[username]}}
+
+    def _send(self, username: str, directmessage: dict) -> dict:
+        recipient = directmessage.get("recipient")
+        entry = directmessage.get("entry")
+        if not recipient or entry is None:
+            return _error("Direct message needs an entry and a recipient.")
+
+        # Messages to users that never joined are kept until they do
+        if recipient not in self._all:
+            self._all[recipient] = []
+            self._new[recipient] = []
+
+        message = {"message": entry, "from": username, "timestamp": str(directmessage.get("timestamp", time.time()))}
+        self._all[recipient].append(message)
+        self._new[recipient].append(message)
+        return {"response": {"type": "ok", "message": "Direct message sent"}}
+
+
+def _error(message: str) -> dict:
+    return {"response": {"type": "error", "message": message}}
+
+
+def _percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def run_load(host: str, port: int, clients: int = 10, messages: int = 100, batch: int = 1,
+             persistent: bool = True) -> dict:
+    """
+    Drives simulated DirectMessenger clients against a server. Every client joins, sends its messages to random
+    other clients and then retrieves its new messages.
+
+    :param clients: number of clients, each on its own thread
+    :param messages: number of messages sent by each client
+    :param batch: messages per request, more than 1 uses send_many
+    :param persistent: keeps one connection per client instead of connecting per request
+
+    :return: dict with the message count, errors, elapsed seconds, messages per second and latency percentiles
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client(i: int):
+        rng = random.Random(i)
+        messenger = DirectMessenger(host, port, f"loadgen{i}", "loadgen", persistent=persistent,
+                                    token_cache=TokenCache())
+        barrier.wait()
+
+        local_latencies = []
+        local_errors = 0
+        for start in range(0, messages, batch):
+            pairs = [(f"loadgen{rng.randrange(clients)}", f"message {start + j} from {i}")
+                     for j in range(min(batch, messages - start))]
+            began = time.perf_counter()
+            if batch > 1:
+                results = messenger.send_many(pairs)
+            else:
+                results = [messenger.send(*pairs[0])]
+            elapsed = time.perf_counter() - began
+            local_latencies += [elapsed / len(pairs)] * len(pairs)
+            local_errors += results.count(False)
+
+        messenger.retrieve_new()
+        messenger.close()
+
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    sent = clients * messages
+    return {
+        "messages": sent,
+        "errors": errors[0],
+        "seconds": elapsed,
+        "messages_per_second": sent / elapsed if elapsed else 0.0,
+        "latency_ms": {name: _percentile(latencies, percent) * 1000
+                       for name, percent in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))},
+    }
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Local DSU server and load generator.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("serve", "loadgen"):
+        command = commands.add_parser(name)
+        command.add_argument("--host", default=None if name == "loadgen" else "127.0.0.1")
+        command.add_argument("--port", type=int, default=3021 if name == "serve" else 0)
+        command.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+        command.add_argument("--jitter", type=float, default=0.0, help="up to this many extra random seconds")
+        command.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with an error")
+        command.add_argument("--drop-rate", type=float, default=0.0,
+                             help="share of responses cut off by closing the connection")
+        command.add_argument("--idle-timeout", type=float, default=None,
+                             help="seconds after which idle connections are closed")
+        command.add_argument("--seed", type=int, default=None)
+
+    loadgen = commands.choices["loadgen"]
+    loadgen.add_argument("--clients", type=int, default=10)
+    loadgen.add_argument("--messages", type=int, default=100, help="messages sent by each client")
+    loadgen.add_argument("--batch", type=int, default=1, help="messages per send_many call")
+    loadgen.add_argument("--per-request", action="store_true", help="open a new connection for every request")
+    loadgen.add_argument("--json", action="store_true", help="print the results as json")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        server = DsuServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.seed,
+                           args.drop_rate, args.idle_timeout)
+        print(f"Serving DSU protocol on {args.host}:{args.port}")
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    server = None
+    host, port = args.host, args.port
+    if host is None:
+        server = DsuServer("127.0.0.1", 0, args.latency, args.jitter, args.error_rate, args.seed,
+                           args.drop_rate, args.idle_timeout)
+        host, port = "127.0.0.1", server.start_in_thread()
+
+    try:
+        results = run_load(host, port, args.clients, args.messages, args.batch, not args.per_request)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['messages']} messages in {results['seconds']:.2f} s, "
+              f"{results['messages_per_second']:.0f} messages/s, {results['errors']} errors")
+        print("latency ms: " + ", ".join(f"{name} {value:.2f}" for name, value in results["latency_ms"].items()))
+
+
+if __name__ == "__main__":
+    main()
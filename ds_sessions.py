@@ -0,0 +1,507 @@
+# ds_sessions.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import errno
+import heapq
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+import ds_protocol
+from ds_messenger import DirectMessage, TokenCache, TOKEN_CACHE
+
+
+
+class Session:
+    """
+    One account of a SessionManager: its credentials, token and profile, the callbacks its events are delivered to
+    and the state of its connection.
+
+    on_messages(session, messages) is called with every non empty list of new messages, after they were added to
+    the profile, if there is one. on_sent(session, message, success) is called once for every message sent through
+    the manager, with the DirectMessage.
+    """
+    def __init__(self, username: str, password: str, profile=None, on_messages=None, on_sent=None):
+        self.username = username
+        self.password = password
+        self.profile = profile
+        self.on_messages = on_messages
+        self.on_sent = on_sent
+        self.token = None
+
+        # Counters
+        self.received = 0
+        self.sent = 0
+        self.errors = 0
+
+        self.interval = 0.0
+        self._sock = None
+        self._connected = False
+        self._out = bytearray()
+        self._in = bytearray()
+        # Requests in flight in the order they were written: ("join",), ("new",) or ("send", DirectMessage, attempt)
+        self._expected = deque()
+        # Messages waiting to be sent, as (DirectMessage, attempt)
+        self._outgoing = deque()
+        # Set when the server rejected a request, so the session joins again before its next requests
+        self._rejoin = False
+        self._active = False
+        self._deadline = 0.0
+        # Time of the session's entry in the poll schedule, other entries for it are stale
+        self._due = None
+        self._retry_delay = 0.0
+        self._removed = False
+
+    def pending(self) -> int:
+        """
+        Returns the number of messages waiting to be sent or waiting for their reply.
+        """
+        return len(self._outgoing) + sum(1 for request in self._expected if request[0] == "send")
+
+
+class SessionManager:
+    """
+    Runs many accounts on one thread. Every session keeps one non blocking connection to the server, and a single
+    selectors loop multiplexes all of them.
+
+    Each session polls for new messages on its own schedule: every min_interval seconds while messages keep
+    arriving, backing off by backoff after each empty poll up to max_interval. Due sessions are served in the order
+    they became due, and at most max_in_flight of them have requests in flight at once, so no account can starve the
+    others. A poll cycle writes a join request if the session has no token yet, then the session's queued messages,
+    at most batch_size of them, and a "new" request in one go, and reads the replies as they arrive.
+
+    A connection that fails, times out after timeout seconds or sends a line longer than max_line bytes is closed,
+    and the session retries after a delay that doubles from min_interval up to max_interval. Messages that were
+    in flight are queued again. Memory per session is bounded by its queued messages and max_line.
+
+    run, or start for a background thread, drives the loop. add_account, remove_account and send may be called from
+    any thread.
+    """
+    def __init__(self, dsuserver: str = "168.235.86.101", port: int = 3021, min_interval: float = 1.0,
+                 max_interval: float = 30.0, backoff: float = 1.5, max_in_flight: int = 128, batch_size: int = 64,
+                 timeout: float = 10.0, max_line: int = 16 * 1024 * 1024, token_cache: TokenCache = TOKEN_CACHE):
+        self.dsuserver = dsuserver
+        self.port = port
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_line = max_line
+
+        self._token_cache = token_cache
+        self._address = None
+        self._sessions = {}
+        # Heap of (due time, sequence number, session)
+        self._schedule = []
+        self._sequence = 0
+        self._in_flight = 0
+
+        self._lock = threading.RLock()
+        self._selector = selectors.DefaultSelector()
+        # Written to by other threads to wake the loop up from select
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_account(self, username: str, password: str, profile=None, on_messages=None, on_sent=None) -> Session:
+        """
+        Adds an account, which is polled right away. See Session for the callbacks.
+
+        :return: the new session, or the existing one if the account was already added
+        """
+        with self._lock:
+            session = self._sessions.get(username)
+            if session is None:
+                session = self._sessions[username] = Session(username, password, profile, on_messages, on_sent)
+                session.interval = self.min_interval
+                if self._token_cache is not None:
+                    session.token = self._token_cache.get(self.dsuserver, self.port, username, password)
+                self._schedule_at(session, time.monotonic())
+        self._wake()
+        return session
+
+    def remove_account(self, username: str) -> None:
+        """
+        Closes an account's connection and stops polling it. Messages not sent yet are dropped.
+        """
+        with self._lock:
+            session = self._sessions.pop(username, None)
+            if session is not None:
+                session._removed = True
+                if session._active:
+                    session._active = False
+                    self._in_flight -= 1
+                self._close(session)
+
+    def get_session(self, username: str) -> Session:
+        return self._sessions.get(username)
+
+    def send(self, username: str, recipient: str, message: str) -> DirectMessage:
+        """
+        Queues a message from an account. Its result is reported to the session's on_sent callback.
+
+        :return: the queued message, or None if there is no such account
+        """
+        with self._lock:
+            session = self._sessions.get(username)
+            if session is None:
+                return None
+
+            message_obj = DirectMessage(recipient, message, time.time())
+            session._outgoing.append((message_obj, 0))
+            if not session._active:
+                self._schedule_at(session, time.monotonic())
+        self._wake()
+        return message_obj
+
+    def stats(self) -> dict:
+        """
+        Returns the number of sessions, open connections, sessions with requests in flight, and the messages
+        received, sent and errors of all sessions.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+            return {
+                "sessions": len(sessions),
+                "connected": sum(1 for session in sessions if session._connected),
+                "in_flight": self._in_flight,
+                "received": sum(session.received for session in sessions),
+                "sent": sum(session.sent for session in sessions),
+                "errors": sum(session.errors for session in sessions),
+            }
+
+    def start(self) -> None:
+        """
+        Runs the loop on a background thread until stop is called.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        self._stopped.set()
+        self._wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self) -> None:
+        """
+        Runs the loop on the calling thread until stop is called.
+        """
+        while not self._stopped.is_set():
+            self.run_once(1.0)
+
+    def close(self) -> None:
+        """
+        Stops the loop and closes every connection.
+        """
+        self.stop()
+        with self._lock:
+            for session in self._sessions.values():
+                self._close(session)
+            self._selector.close()
+            self._wake_r.close()
+            self._wake_w.close()
+
+    def run_once(self, timeout: float = None) -> None:
+        """
+        Starts the poll cycles that are due, waits up to timeout seconds for connection events and handles them.
+        """
+        with self._lock:
+            self._start_due(time.monotonic())
+            wait = self._next_wait(time.monotonic(), timeout)
+
+        events = self._selector.select(wait)
+
+        with self._lock:
+            for key, mask in events:
+                session = key.data
+                if session is None:
+                    self._drain_wake()
+                    continue
+                # The session may have failed or been removed by an earlier event
+                if session._sock is None or session._sock is not key.fileobj:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._on_writable(session)
+                if mask & selectors.EVENT_READ and session._sock is not None:
+                    self._on_readable(session)
+
+            now = time.monotonic()
+            for session in [session for session in self._sessions.values() if session._active]:
+                if now > session._deadline:
+                    print(f"The server did not respond in time for {session.username}.")
+                    self._fail(session, now)
+
+    def _wake(self) -> None:
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            # The pipe is full, so the loop wakes up anyway, or it was closed
+            pass
+
+    def _drain_wake(self) -> None:
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _schedule_at(self, session: Session, due: float) -> None:
+        session._due = due
+        self._sequence += 1
+        heapq.heappush(self._schedule, (due, self._sequence, session))
+
+    def _next_wait(self, now: float, timeout: float) -> float:
+        """
+        Returns how long select may wait before a poll is due.
+        """
+        wait = timeout
+        if self._schedule and self._in_flight < self.max_in_flight:
+            due = max(0.0, self._schedule[0][0] - now)
+            wait = due if wait is None else min(wait, due)
+        return wait
+
+    def _start_due(self, now: float) -> None:
+        """
+        Starts the poll cycles of due sessions, earliest first, while fewer than max_in_flight are in flight.
+        """
+        while self._schedule and self._in_flight < self.max_in_flight and self._schedule[0][0] <= now:
+            due, _, session = heapq.heappop(self._schedule)
+            if session._removed or session._active or session._due != due:
+                continue
+            session._due = None
+            self._begin(session, now)
+
+    def _begin(self, session: Session, now: float) -> None:
+        """
+        Starts a poll cycle, connecting first if needed.
+        """
+        session._active = True
+        session._deadline = now + self.timeout
+        self._in_flight += 1
+
+        if session._sock is None:
+            try:
+                self._connect(session)
+            except OSError as ex:
+                print(f"Could not connect {session.username} to the server.", ex)
+                self._fail(session, now)
+                return
+
+        if session.token is None or session._rejoin:
+            session._rejoin = False
+            self._write(session, ds_protocol.encode_json("join", session.username, session.password, ''), ("join",))
+        else:
+            self._write_batch(session)
+
+    def _connect(self, session: Session) -> None:
+        if self._address is None:
+            # Resolved once, so connecting hundreds of sessions never blocks the loop on name lookups
+            family, kind, proto, _, address = socket.getaddrinfo(self.dsuserver, self.port, type=socket.SOCK_STREAM)[0]
+            self._address = (family, kind, proto, address)
+
+        family, kind, proto, address = self._address
+        sock = socket.socket(family, kind, proto)
+        sock.setblocking(False)
+        code = sock.connect_ex(address)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            sock.close()
+            raise OSError(code, "Could not connect.")
+
+        session._sock = sock
+        session._connected = False
+        self._selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+
+    def _write_batch(self, session: Session) -> None:
+        """
+        Writes the session's queued messages, up to batch_size of them, followed by a "new" request.
+        """
+        for _ in range(min(self.batch_size, len(session._outgoing))):
+            message_obj, attempt = session._outgoing.popleft()
+            data = ds_protocol.encode_json("directmessage", token=session.token, directmessage={
+                "entry": message_obj.message, "recipient": message_obj.recipient, "timestamp": message_obj.timestamp})
+            self._write(session, data, ("send", message_obj, attempt))
+
+        self._write(session, ds_protocol.encode_json("directmessage", token=session.token, directmessage="new"),
+                    ("new",))
+
+    def _write(self, session: Session, data: str, request: tuple) -> None:
+        session._out += (data + "\r\n").encode()
+        session._expected.append(request)
+        if session._connected:
+            self._selector.modify(session._sock, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+
+    def _on_writable(self, session: Session) -> None:
+        if not session._connected:
+            code = session._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code:
+                print(f"Could not connect {session.username} to the server.", OSError(code, "Could not connect."))
+                self._fail(session, time.monotonic())
+                return
+            session._connected = True
+
+        if session._out:
+            try:
+                written = session._sock.send(session._out)
+            except BlockingIOError:
+                return
+            except OSError:
+                self._fail(session, time.monotonic())
+                return
+            del session._out[:written]
+
+        if not session._out:
+            self._selector.modify(session._sock, selectors.EVENT_READ, session)
+
+    def _on_readable(self, session: Session) -> None:
+        try:
+            data = session._sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._fail(session, time.monotonic())
+            return
+
+        # An empty read means the server closed the connection, which is only expected between poll cycles
+        if not data:
+            if session._active:
+                self._fail(session, time.monotonic())
+            else:
+                self._close(session)
+            return
+
+        session._in += data
+        session._deadline = time.monotonic() + self.timeout
+        while session._sock is not None:
+            end = session._in.find(b"\n")
+            if end < 0:
+                if len(session._in) > self.max_line:
+                    print(f"The server response for {session.username} is too large.")
+                    self._fail(session, time.monotonic())
+                return
+
+            line = bytes(session._in[:end + 1])
+            del session._in[:end + 1]
+            if not session._expected:
+                # A reply nobody asked for, the connection is out of step
+                self._fail(session, time.monotonic())
+                return
+            self._on_reply(session, session._expected.popleft(), line)
+
+    def _on_reply(self, session: Session, request: tuple, line: bytes) -> None:
+        srv_data = ds_protocol.extract_json(line)
+        ok = bool(srv_data) and srv_data.response_type != "error"
+
+        if request[0] == "join":
+            if not ok or not srv_data.token:
+                print(f"Invalid password or username already taken for {session.username}.")
+                self._fail(session, time.monotonic())
+                return
+            session.token = srv_data.token
+            if self._token_cache is not None:
+                self._token_cache.set(self.dsuserver, self.port, session.username, session.password, session.token)
+            self._write_batch(session)
+            return
+
+        if request[0] == "send":
+            _, message_obj, attempt = request
+            if ok:
+                session.sent += 1
+                if session.profile is not None:
+                    session.profile.add_message(our_message=message_obj)
+                self._callback(session.on_sent, session, message_obj, True)
+            elif srv_data and attempt == 0:
+                # The token may have expired, the message is sent again after joining again
+                session._outgoing.appendleft((message_obj, 1))
+                session._rejoin = True
+            else:
+                session.errors += 1
+                self._callback(session.on_sent, session, message_obj, False)
+        elif ok:
+            messages = srv_data.response_message
+            if messages:
+                session.received += len(messages)
+                session.interval = self.min_interval
+                if session.profile is not None:
+                    session.profile.add_message(new_messages=messages)
+                self._callback(session.on_messages, session, messages)
+        else:
+            session.errors += 1
+            session._rejoin = True
+
+        if not session._expected:
+            self._finish(session)
+
+    def _finish(self, session: Session) -> None:
+        """
+        Ends a poll cycle and schedules the next one.
+        """
+        now = time.monotonic()
+        session._active = False
+        self._in_flight -= 1
+
+        if session._rejoin:
+            if self._token_cache is not None:
+                self._token_cache.invalidate(self.dsuserver, self.port, session.username, session.token)
+            # Joins again right away the first time, backing off if the server keeps rejecting the session
+            self._schedule_at(session, now + session._retry_delay)
+            session._retry_delay = min(max(session._retry_delay * 2, self.min_interval), self.max_interval)
+            return
+
+        session._retry_delay = 0.0
+        if session._outgoing:
+            self._schedule_at(session, now)
+        else:
+            self._schedule_at(session, now + session.interval)
+            session.interval = min(session.interval * self.backoff, self.max_interval)
+
+    def _fail(self, session: Session, now: float) -> None:
+        """
+        Closes a failed connection, queues the messages that were in flight again and schedules a retry.
+        """
+        session.errors += 1
+        for request in reversed(session._expected):
+            if request[0] == "send":
+                session._outgoing.appendleft(request[1:])
+        session._expected.clear()
+        self._close(session)
+
+        if session._active:
+            session._active = False
+            self._in_flight -= 1
+
+        if not session._removed:
+            session._retry_delay = min(max(session._retry_delay * 2, self.min_interval), self.max_interval)
+            self._schedule_at(session, now + session._retry_delay)
+
+    def _close(self, session: Session) -> None:
+        if session._sock is not None:
+            try:
+                self._selector.unregister(session._sock)
+            except (KeyError, ValueError):
+                pass
+            session._sock.close()
+        session._sock = None
+        session._connected = False
+        session._out.clear()
+        session._in.clear()
+
+    def _callback(self, callback, *args) -> None:
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as ex:
+            print("A session callback failed.", ex)
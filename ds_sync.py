@@ -0,0 +1,263 @@
+# ds_sync.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import base64
+import hashlib
+import json
+import os
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from ds_messenger import IncompleteStreamError
+
+
+
+def parse_timestamp(value):
+    """
+    Returns a message timestamp as a float, or None if it is not a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def message_hash(message: dict) -> int:
+    """
+    Returns a 64 bit hash of a received message's sender, timestamp and text.
+
+    :param message: message dict in the format {"message": x, "from": y, "timestamp": z}
+    """
+    # Timestamps arrive as strings, normalize them so "1.50" and 1.5 hash the same. Ones that are not a number are
+    # hashed as they are
+    timestamp = parse_timestamp(message["timestamp"])
+    key = "%s\0%r\0%s" % (message["from"], str(message["timestamp"]) if timestamp is None else timestamp,
+                           message["message"])
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+class DedupIndex:
+    """
+    Compact set of message hashes. Hashes are kept in a sorted array of 8 byte integers with their timestamps, new
+    hashes collect in a small dict that is merged into the arrays once it grows.
+    """
+    def __init__(self):
+        self._hashes = array('Q')
+        self._times = array('d')
+        self._recent = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes) + len(self._recent)
+
+    def __contains__(self, h: int) -> bool:
+        if h in self._recent:
+            return True
+        i = bisect_left(self._hashes, h)
+        return i < len(self._hashes) and self._hashes[i] == h
+
+    def add(self, h: int, timestamp: float) -> None:
+        self._recent[h] = timestamp
+
+        # Merging costs a sort, so only merge once the new hashes are a fair share of the index
+        if len(self._recent) > max(4096, len(self._hashes) // 4):
+            self._merge()
+
+    def _merge(self) -> None:
+        pairs = sorted(list(zip(self._hashes, self._times)) + list(self._recent.items()))
+        self._hashes = array('Q', [h for h, _ in pairs])
+        self._times = array('d', [t for _, t in pairs])
+        self._recent = {}
+
+    def prune(self, cutoff: float) -> None:
+        """
+        Drops hashes of messages older than cutoff.
+        """
+        self._merge()
+        keep = [i for i, t in enumerate(self._times) if t >= cutoff]
+        self._hashes = array('Q', [self._hashes[i] for i in keep])
+        self._times = array('d', [self._times[i] for i in keep])
+
+    def to_json(self) -> dict:
+        self._merge()
+        return {"hashes": base64.b64encode(self._hashes.tobytes()).decode(),
+                "times": base64.b64encode(self._times.tobytes()).decode()}
+
+    @classmethod
+    def from_json(cls, obj: dict):
+        index = cls()
+        index._hashes.frombytes(base64.b64decode(obj["hashes"]))
+        index._times.frombytes(base64.b64decode(obj["times"]))
+        return index
+
+
+class SyncState:
+    """
+    What a profile has already received from the server: the high-water mark, which is the latest timestamp of any
+    ingested message, and a dedup index of the messages ingested within window seconds of it.
+
+    Every ingested message is at or below the high-water mark, so a message above it is new without a lookup.
+    Messages older than the window are assumed to have been ingested already. Messages whose timestamp is not a
+    number are always looked up, and kept in the index as if they arrived at the high-water mark.
+
+    synced is True once a whole "all" stream was ingested. Until then the history may be incomplete, and the next
+    sync asks for "all" again.
+    """
+    def __init__(self, window: float = 30 * 24 * 60 * 60):
+        self.high_water = None
+        self.window = window
+        self.index = DedupIndex()
+        self.synced = False
+
+    def is_new(self, h: int, timestamp: float) -> bool:
+        if timestamp is None:
+            return h not in self.index
+        if self.high_water is None or timestamp > self.high_water:
+            return True
+        if timestamp < self.high_water - self.window:
+            return False
+        return h not in self.index
+
+    def add(self, h: int, timestamp: float) -> None:
+        if timestamp is None:
+            self.index.add(h, 0.0 if self.high_water is None else self.high_water)
+            return
+
+        self.index.add(h, timestamp)
+        if self.high_water is None or timestamp > self.high_water:
+            self.high_water = timestamp
+
+    def filter(self, messages) -> list:
+        """
+        Returns the messages that were not ingested before and records them as ingested. Duplicates within
+        messages are dropped as well.
+        """
+        fresh = []
+        for message in messages:
+            h = message_hash(message)
+            timestamp = parse_timestamp(message["timestamp"])
+            if self.is_new(h, timestamp):
+                self.add(h, timestamp)
+                fresh.append(message)
+
+        return fresh
+
+    def save(self, path: str) -> None:
+        """
+        Writes the state to a file, replacing the old one atomically.
+        """
+        if self.high_water is not None:
+            self.index.prune(self.high_water - self.window)
+
+        p = Path(path)
+        tmp_path = Path(str(p) + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({"high_water": self.high_water, "window": self.window, "synced": self.synced,
+                       "index": self.index.to_json()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, p)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Reads a state written by save.
+
+        :return: the state, or None if the file does not exist or cannot be read
+        """
+        try:
+            with open(path, 'r') as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        state = cls(obj["window"])
+        state.high_water = obj["high_water"]
+        state.synced = obj.get("synced", True)
+        state.index = DedupIndex.from_json(obj["index"])
+        return state
+
+
+class SyncEngine:
+    """
+    Keeps a profile in sync with the server without duplicating messages. The first sync, and any sync with
+    recover=True, streams the whole history with "all"; later syncs only ask for "new". Either way only messages
+    that were not ingested before are added to the profile. An "all" stream that is cut off keeps the messages it
+    delivered, but the state is not marked synced or saved, so the next sync streams the whole history again.
+
+    The state is saved to state_path, by convention the profile path with '.sync' appended, so a restarted client
+    resyncs cheaply instead of rebuilding its profile. With autosave=False it is only saved by save_state, for callers
+    that save the profile later and must not let the state get ahead of it.
+    """
+    def __init__(self, messenger, profile, state_path: str = None, chunk_size: int = 1000, autosave: bool = True):
+        self.messenger = messenger
+        self.profile = profile
+        self.state_path = state_path
+        self.chunk_size = chunk_size
+        self.autosave = autosave
+
+        self.state = SyncState.load(state_path) if state_path else None
+        if self.state is None:
+            self.state = SyncState()
+            self.seed(profile)
+
+    def seed(self, profile) -> None:
+        """
+        Records every received message already in the profile as ingested, so the first "all" sync of an existing
+        profile does not add them again.
+        """
+        for user in profile.get_users():
+            for message in user.get_messages():
+                if not message["sent by user"]:
+                    received = {"from": user.name, "timestamp": message["timestamp"], "message": message["message"]}
+                    self.state.add(message_hash(received), parse_timestamp(message["timestamp"]))
+
+    def sync(self, recover: bool = False) -> list:
+        """
+        Retrieves messages from the server and adds the ones not seen before into the profile.
+
+        :param recover: retrieves the whole history with "all" even if the profile was synced before
+
+        :return: list of the messages that were added
+        """
+        stream_all = recover or not self.state.synced
+        if stream_all:
+            source = self.messenger.iter_all(strict=True)
+        else:
+            source = self.messenger.retrieve_new() or []
+
+        added = []
+        chunk = []
+        try:
+            for message in source:
+                chunk.append(message)
+                if len(chunk) >= self.chunk_size:
+                    added += self._ingest(chunk)
+                    chunk = []
+        except IncompleteStreamError as ex:
+            print(ex)
+            added += self._ingest(chunk)
+            return added
+        added += self._ingest(chunk)
+
+        if stream_all:
+            self.state.synced = True
+        if self.autosave and (added or stream_all or not (self.state_path and os.path.exists(self.state_path))):
+            self.save_state()
+
+        return added
+
+    def save_state(self) -> None:
+        """
+        Writes the state to state_path, if there is one.
+        """
+        if self.state_path:
+            self.state.save(self.state_path)
+
+    def _ingest(self, messages: list) -> list:
+        fresh = self.state.filter(messages)
+        if fresh:
+            self.profile.add_message(new_messages=fresh)
+        return fresh
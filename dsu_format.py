@@ -0,0 +1,157 @@
+# dsu_format.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+"""
+Version 2 of the DSU file format, a compressed binary container for a profile.
+
+    magic b"\\x89DSU" | version u16 | compression u16 | header length u32 | header json | blocks
+
+Integers are little endian. The header is json holding the profile attributes, the sha1 that identifies this
+version of the file and a block index, [name, offset, length, message count] for every user, where offset is
+counted from the start of the file. Profile stores the [earliest, latest] timestamp of every user as the "bounds"
+attribute. Each block is the json list of one user's messages, compressed on its own, so a
+single conversation is read by inflating only its block.
+
+Version 1 files are the plain json dump of the profile. They always start with "{", never with the magic.
+"""
+
+import hashlib
+import json
+import lzma
+import struct
+import zlib
+
+
+
+MAGIC = b"\x89DSU"
+VERSION = 2
+_PREFIX = struct.Struct("<4sHHI")
+
+# Compression name -> (id stored in the file, compress, decompress)
+COMPRESSIONS = {
+    "zlib": (1, lambda data: zlib.compress(data, 1), zlib.decompress),
+    "lzma": (2, lambda data: lzma.compress(data, preset=0), lzma.decompress),
+}
+_COMPRESSION_NAMES = {code: name for name, (code, _, _) in COMPRESSIONS.items()}
+
+
+class DsuFormatError(Exception):
+    pass
+
+
+def detect_version(path) -> int:
+    """
+    Returns the format version of a DSU file, 1 for plain json.
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+
+    if prefix[:len(MAGIC)] != MAGIC:
+        return 1
+    if len(prefix) < _PREFIX.size:
+        raise DsuFormatError("Truncated DSU file header.")
+    return _PREFIX.unpack(prefix)[1]
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    return COMPRESSIONS[compression][1](data)
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    return COMPRESSIONS[compression][2](data)
+
+
+def encode(attributes: dict, blocks: list, compression: str) -> tuple:
+    """
+    Builds a version 2 file.
+
+    :param attributes: profile attributes stored in the header
+    :param blocks: list of (user name, compressed message block, message count)
+    :param compression: name of the compression the blocks were compressed with
+
+    :return: the file contents, its sha1 and the block index
+    """
+    if compression not in COMPRESSIONS:
+        raise DsuFormatError(f"Unknown compression {compression}.")
+
+    # The sha1 covers the attributes and every block, so it changes whenever the profile does
+    digest = hashlib.sha1(json.dumps(attributes, sort_keys=True).encode())
+    for name, block, count in blocks:
+        digest.update(json.dumps([name, count]).encode())
+        digest.update(block)
+    sha1 = digest.hexdigest()
+
+    # Block offsets depend on the header length, which depends on the offsets. Offsets relative to the end of the
+    # header are fixed, so lay the blocks out first and shift them once the header size is known
+    relative = []
+    offset = 0
+    for name, block, count in blocks:
+        relative.append([name, offset, len(block), count])
+        offset += len(block)
+
+    header_size = 0
+    while True:
+        start = _PREFIX.size + header_size
+        index = [[name, start + offset, length, count] for name, offset, length, count in relative]
+        header = json.dumps(dict(attributes, sha1=sha1, users=index)).encode()
+        if len(header) == header_size:
+            break
+        header_size = len(header)
+
+    prefix = _PREFIX.pack(MAGIC, VERSION, COMPRESSIONS[compression][0], len(header))
+    return b"".join([prefix, header] + [block for _, block, _ in blocks]), sha1, index
+
+
+def read_header(path) -> tuple:
+    """
+    Reads the header of a version 2 file without reading any blocks.
+
+    :return: the header dict, with the profile attributes, "sha1" and "users", and the compression name
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise DsuFormatError("Truncated DSU file header.")
+
+        magic, version, code, length = _PREFIX.unpack(prefix)
+        if magic != MAGIC or version != VERSION:
+            raise DsuFormatError(f"Not a version {VERSION} DSU file.")
+        if code not in _COMPRESSION_NAMES:
+            raise DsuFormatError(f"Unknown compression {code}.")
+
+        header = f.read(length)
+        if len(header) < length:
+            raise DsuFormatError("Truncated DSU file header.")
+
+    return json.loads(header), _COMPRESSION_NAMES[code]
+
+
+class BlockLoader:
+    """
+    Reads one user's message block from a version 2 DSU file.
+    """
+    def __init__(self, path, offset: int, length: int, compression: str):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.compression = compression
+
+    def read_block(self) -> bytes:
+        """
+        Returns the compressed block.
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def read(self) -> bytes:
+        """
+        Returns the json list of messages.
+        """
+        return decompress(self.read_block(), self.compression)
+
+    def __call__(self) -> list:
+        return json.loads(self.read())
@@ -20,29 +20,116 @@
 USERNAME = "3245"
 PASSWORD = "mypass"
 
-from audioop import add
-from ctypes import alignment
+import time
+_STARTED = time.perf_counter()
+
+import argparse
+import json
+import queue
+import threading
 import tkinter as tk
-from tkinter import END, ttk, filedialog
-from turtle import bgcolor, fillcolor
+from pathlib import Path
+from tkinter import ttk
 from Profile import Profile
-from ds_messenger import User, DirectMessage, DirectMessenger
+from ds_messenger import User
 
 
 is_dark_mode = False
 
+# The profile that was open last time, opened again at startup
+SETTINGS_PATH = Path.home() / ".ds_gui.json"
+
+# Number of messages loaded into the conversation view at a time, and the most pages it holds at once
+PAGE_SIZE = 200
+MAX_PAGES = 3
+
+
+def _count_lines(messages: list) -> int:
+    """
+    Returns the number of text lines the messages take up in the conversation view.
+    """
+    return sum(message["message"].count("\n") + 1 for message in messages)
+
+
+def _last_profile() -> str:
+    """
+    Returns the path of the profile that was open last time, or None.
+    """
+    try:
+        with open(SETTINGS_PATH) as f:
+            path = json.load(f).get("last_profile")
+    except (OSError, ValueError, AttributeError):
+        return None
+    return path if path and Path(path).exists() else None
+
+
+def _remember_profile(path: str) -> None:
+    """
+    Stores the path of the open profile so it is opened again at the next start.
+    """
+    try:
+        with open(SETTINGS_PATH, 'w') as f:
+            json.dump({"last_profile": str(Path(path).resolve())}, f)
+    except OSError as ex:
+        print("Could not save the settings.", ex)
+
+
+class StartupTimer:
+    """
+    Measures the startup phases of the GUI for --profile-startup. Each mark records the time since the previous
+    one, report prints the breakdown once.
+    """
+    def __init__(self, started: float):
+        self.started = self._last = started
+        self.phases = []
+        self._reported = False
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> None:
+        if self._reported:
+            return
+        self._reported = True
+        print("startup phase          ms")
+        for phase, seconds in self.phases:
+            print(f"{phase:<20} {seconds * 1000:>6.1f}")
+        print(f"{'total':<20} {(self._last - self.started) * 1000:>6.1f}")
+
+
 class Body(tk.Frame):
     """
     A subclass of tk.Frame that is responsible for drawing all of the widgets
     in the body portion of the root frame.
+
+    The conversation view only holds a window of at most MAX_PAGES pages of messages. It starts at the latest
+    PAGE_SIZE messages, loads older pages when scrolled to the top and newer ones when scrolled back to the bottom,
+    dropping the pages at the other end of the window.
     """
-    def __init__(self, root, select_callback=None):
+    def __init__(self, root, select_callback=None, search_callback=None):
         tk.Frame.__init__(self, root)
         self.root = root
         self._select_callback = select_callback
+        self._search_callback = search_callback
 
         # a list of the User objects available in the active DSU file
         self._users = [User]
+
+        # The user whose messages are shown, the window [start, end) of their messages in the view, and the
+        # number of messages, reorder count and pending count they had when the view was last refreshed
+        self._rendered_user = None
+        self._window_start = 0
+        self._window_end = 0
+        self._rendered_count = 0
+        self._rendered_reorders = 0
+        self._rendered_pending = 0
+        self._paging = False
+
+        # Held while reading messages, MainApp shares the sync worker's lock so lazily loaded messages are never
+        # read while the worker rewrites the DSU file
+        self.lock = threading.RLock()
         
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the Body instance 
@@ -51,12 +138,176 @@ class Body(tk.Frame):
     def node_select(self, event=None):
         """
         Update the entry_editor with the full user entry when the corresponding node in the users_tree
-        is selected.
+        is selected. If the selected user is already displayed, only its new messages are added, unless
+        a new message belongs before messages already shown or a pending message was delivered.
         """
+        # Nothing is selected after the selection was cleared to show search results
+        if not self.users_tree.selection():
+            return
+
+        # Only a selection made by the user counts as activity, not a refresh of the shown conversation
+        if event is not None:
+            self.activity()
+
         index = int(self.users_tree.selection()[0])
-        self.selected_user = self._users[index].name
-        entry = self._users[index].get_messages()
-        self.set_text_entry(entry, self.message_display_frame)
+        user = self._users[index]
+        self.selected_user = user.name
+        frame = self.message_display_frame
+
+        # get_messages is a live view of the user's messages, so it is only read while holding the lock, or the
+        # worker could add, reload or release messages halfway through
+        with self.lock:
+            entry = user.get_messages()
+            count = len(entry)
+            reorders = user.reorder_count()
+            pending = user.pending_count()
+
+            if (user is self._rendered_user and count >= self._rendered_count
+                    and reorders == self._rendered_reorders
+                    # Any other change to the pending count means a message shown as pending was delivered
+                    and pending == self._rendered_pending + sum(1 for message in entry[self._rendered_count:]
+                                                                if message.get("pending"))):
+                # New messages only show up right away if the view is at the latest messages
+                if self._window_end == self._rendered_count:
+                    at_bottom = frame.yview()[1] >= 1.0
+                    self.append_messages(entry[self._window_end:count], frame)
+                    self._window_end = count
+                    self._trim_top(entry)
+                    if at_bottom:
+                        frame.see('end')
+            else:
+                self._window_start = max(0, count - PAGE_SIZE)
+                self._window_end = count
+                self.set_text_entry(entry[self._window_start:count], frame)
+                frame.see('end')
+        self._rendered_user = user
+        self._rendered_count = count
+        self._rendered_reorders = reorders
+        self._rendered_pending = pending
+
+    def activity(self, event=None):
+        """
+        Calls the callback function specified in the select_callback class attribute, if available, when a
+        conversation is selected or a message is typed.
+        """
+        if self._select_callback is not None:
+            self._select_callback()
+
+    def _on_scroll(self, first: str, last: str):
+        """
+        Called by the conversation view whenever it scrolls. Schedules loading the next page when the top or
+        the bottom of the window is reached.
+        """
+        if self._paging or self._rendered_user is None:
+            return
+
+        if float(first) <= 0.0 and self._window_start > 0:
+            self._paging = True
+            self.after_idle(self._load_older)
+        elif float(last) >= 1.0 and self._window_end < self._rendered_count:
+            self._paging = True
+            self.after_idle(self._load_newer)
+
+    def _load_older(self):
+        """
+        Inserts the page before the window at the top of the view, keeping the same message at the top of the screen.
+        """
+        try:
+            frame = self.message_display_frame
+            top = int(frame.index('@0,0').split('.')[0])
+
+            with self.lock:
+                messages = self._rendered_user.get_messages()
+                start = max(0, self._window_start - PAGE_SIZE)
+                page = messages[start:self._window_start]
+                self._window_start = start
+                frame.insert('1.0', *self._chunks(page))
+                self._trim_bottom(messages)
+
+            frame.yview(f"{top + _count_lines(page)}.0")
+        finally:
+            self._paging = False
+
+    def _load_newer(self):
+        """
+        Appends the page after the window at the bottom of the view.
+        """
+        try:
+            frame = self.message_display_frame
+            top = int(frame.index('@0,0').split('.')[0])
+
+            with self.lock:
+                messages = self._rendered_user.get_messages()
+                end = min(self._rendered_count, self._window_end + PAGE_SIZE)
+                self.append_messages(messages[self._window_end:end], frame)
+                self._window_end = end
+                removed = self._trim_top(messages)
+
+            frame.yview(f"{max(1, top - removed)}.0")
+        finally:
+            self._paging = False
+
+    def _trim_top(self, messages: list) -> int:
+        """
+        Drops messages from the top of the view until the window holds at most MAX_PAGES pages. Called while
+        holding the lock.
+
+        :return: the number of text lines removed
+        """
+        drop = self._window_end - self._window_start - PAGE_SIZE * MAX_PAGES
+        if drop <= 0:
+            return 0
+
+        lines = _count_lines(messages[self._window_start:self._window_start + drop])
+        self.message_display_frame.delete('1.0', f"{lines + 1}.0")
+        self._window_start += drop
+        return lines
+
+    def _trim_bottom(self, messages: list) -> int:
+        """
+        Drops messages from the bottom of the view until the window holds at most MAX_PAGES pages. Called while
+        holding the lock.
+
+        :return: the number of text lines removed
+        """
+        drop = self._window_end - self._window_start - PAGE_SIZE * MAX_PAGES
+        if drop <= 0:
+            return 0
+
+        frame = self.message_display_frame
+        lines = _count_lines(messages[self._window_end - drop:self._window_end])
+        last = int(frame.index('end - 1c').split('.')[0])
+        frame.delete(f"{last - lines}.0", 'end - 1c')
+        self._window_end -= drop
+        return lines
+
+    def search_click(self, event=None):
+        """
+        Calls the callback function specified in the search_callback class attribute, if
+        available, with the text of the search box.
+        """
+        query = self.search_editor.get().strip()
+        if self._search_callback is not None and query:
+            self._search_callback(query)
+
+    def show_search_results(self, hits: list):
+        """
+        Displays search hits in the conversation view, most recent first. Selecting a user afterwards shows
+        their conversation again.
+
+        :param hits: list of (user name, message, timestamp) tuples
+        """
+        frame = self.message_display_frame
+        if hits:
+            self.set_text_entry("".join(f"{name}: {message}\n" for name, message, _ in hits), frame)
+        else:
+            self.set_text_entry("No messages found.", frame)
+        frame.see('1.0')
+
+        # The next selection redraws the whole conversation
+        self._rendered_user = None
+        self._window_start = self._window_end = self._rendered_count = 0
+        self.users_tree.selection_set(())
 
     def get_selected_user(self):
         return self.selected_user
@@ -80,25 +331,51 @@ class Body(tk.Frame):
         # If list, only enter the actual messages and not timestamps, etc.
         elif type(messages) == list:
             entry.delete(0.0, 'end')
+            self.append_messages(messages, entry)
 
-            for message in messages[::-1]:
-                # Make the background black if the message was sent by the local user
-                if message["sent by user"]:
-                    entry.tag_config('user', background="black", foreground="white")
-                    entry.insert(0.0, f"{message['message']}\n",'user')
-                # Messages sent by remote users are in white background
-                else:
-                    entry.insert(0.0, f"{message['message']}\n")
+    def append_messages(self, messages: list, entry: tk.Text):
+        """
+        Adds messages below the ones already displayed in a widget, in a single insert.
+        """
+        if messages:
+            entry.insert('end - 1c', *self._chunks(messages))
+
+    def _chunks(self, messages: list) -> list:
+        """
+        Returns the text and tag arguments that insert messages into a text widget in one call.
+        """
+        # Messages sent by the local user use the 'user' tag for a black background, the 'pending' tag while they
+        # wait in the outbox
+        chunks = []
+        for message in messages:
+            if message.get("pending"):
+                chunks += [f"{message['message']}\n", ('user', 'pending')]
+            else:
+                chunks += [f"{message['message']}\n", ('user',) if message["sent by user"] else ()]
+        return chunks
     
-    def set_users(self, users:list):
+    def set_users(self, users:list, only_new: bool = False, chunk_size: int = None, done=None):
         """
         Populates the self._users attribute with users from the active DSU file.
+
+        :param only_new: only inserts the users that are not in the user tree yet
+        :param chunk_size: inserts at most chunk_size users now and the rest in later chunks from the event loop,
+        so a profile with many contacts does not freeze the window
+        :param done: called once every user is in the user tree
         """
         self._users = users
+        first = len(self.users_tree.get_children()) if only_new else 0
+        last = len(users) if chunk_size is None else min(len(users), first + chunk_size)
         # Inserts each user in the user tree from the users list along with its user id
-        for user_id in range(len(self._users)):
+        for user_id in range(first, last):
             self._insert_user_tree(user_id, self._users[user_id])
 
+        if last < len(users):
+            # The next chunk starts after whatever is in the tree by then, users may be inserted in between
+            self.after(1, lambda: self.set_users(self._users, True, chunk_size, done))
+        elif done is not None:
+            done()
+
     def insert_user(self, user: User):
         """
         Inserts a single user to the user_tree widget.
@@ -113,6 +390,8 @@ class Body(tk.Frame):
         as when a new DSU file is loaded, for example.
         """
         self.set_text_entry("", self.message_display_frame)
+        self._rendered_user = None
+        self._window_start = self._window_end = self._rendered_count = 0
         self.entry_editor.configure(state=tk.NORMAL)
         self._users = []
         for item in self.users_tree.get_children():
@@ -143,6 +422,10 @@ class Body(tk.Frame):
         users_frame = tk.Frame(master=self, width=250)
         users_frame.pack(fill=tk.BOTH, side=tk.LEFT)
 
+        self.search_editor = tk.Entry(users_frame, bg=bg_gray)
+        self.search_editor.bind("<Return>", self.search_click)
+        self.search_editor.pack(fill=tk.X, side=tk.TOP, padx=5, pady=5)
+
         self.users_tree = ttk.Treeview(users_frame, style="Treeview")
         # self.users_tree.tag_configure("a", background=bg_gray)
         self.users_tree.bind("<<TreeviewSelect>>", self.node_select)
@@ -155,9 +438,13 @@ class Body(tk.Frame):
         editor_frame.pack(fill=tk.X, side=tk.BOTTOM, expand=False, padx=5, pady=5)
         
         self.entry_editor = tk.Text(editor_frame, height=5, width=0, bg=bg_gray)
+        self.entry_editor.bind("<Key>", self.activity)
         self.entry_editor.pack(fill=tk.X, side=tk.LEFT, expand=True, padx=5, pady=5)
 
         self.message_display_frame = tk.Text(master=entry_frame, bg=bg_gray)
+        self.message_display_frame.tag_config('user', background="black", foreground="white")
+        self.message_display_frame.tag_config('pending', foreground="gray60")
+        self.message_display_frame.configure(yscrollcommand=self._on_scroll)
         self.message_display_frame.pack(fill=tk.BOTH, side=tk.BOTTOM, expand=True, padx=5, pady=5)
 
 
@@ -223,12 +510,18 @@ class MainApp(tk.Frame):
     in the main portion of the root frame. Also manages all method calls for
     the NaClProfile class.
     """
-    def __init__(self, root):
+    def __init__(self, root, timer: StartupTimer = None):
         tk.Frame.__init__(self, root)
         self.root = root
         self._is_dark_mode = False
         # Initialize a new NaClProfile and assign it to a class attribute.
-        self._current_profile = Profile()
+        self._current_profile = Profile(journal=True, search=True, persist_search=True)
+        # Background worker that does the network and disk work for the current profile
+        self._sync_worker = None
+        # Profiles loaded and searches run on a background thread, applied by check_new_messages
+        self._opened = queue.Queue()
+        self._searches = queue.Queue()
+        self._timer = timer
 
         # After all initialization is complete, call the _draw method to pack the widgets
         # into the root frame
@@ -238,34 +531,90 @@ class MainApp(tk.Frame):
         """
         Creates a new DSU file when the 'New' menu item is clicked.
         """
-        filename = tk.filedialog.asksaveasfile(filetypes=[('Distributed Social Profile', '*.dsu')])
+        from tkinter import filedialog
+
+        filename = filedialog.asksaveasfile(filetypes=[('Distributed Social Profile', '*.dsu')])
         self._profile_filename = filename.name
 
-        self._current_profile = Profile()
+        self._current_profile = Profile(journal=True, search=True, persist_search=True)
         self.body.reset_ui()
+        _remember_profile(self._profile_filename)
+        self._start_sync()
     
     def open_profile(self):
         """
         Opens an existing DSU file when the 'Open' menu item is clicked and loads the profile
         data into the UI.
         """
-        filename = tk.filedialog.askopenfile(filetypes=[('Distributed Social Profile', '*.dsu')])
+        from tkinter import filedialog
 
-        self._profile_filename = filename.name
-        self._current_profile = Profile()
+        filename = filedialog.askopenfile(filetypes=[('Distributed Social Profile', '*.dsu'), ('Profile Database', '*.sqlite *.db')])
+        self.load_in_background(filename.name)
+
+    def open_last_profile(self) -> bool:
+        """
+        Opens the profile that was open last time, if there is one, without blocking the window.
+        """
+        path = _last_profile()
+        if path is None:
+            return False
+        self.load_in_background(path)
+        return True
 
-        # Load the profile and import the path
-        self._current_profile.load_profile(self._profile_filename)
+    def load_in_background(self, path: str):
+        """
+        Loads a profile on a background thread. check_new_messages shows it once it is loaded, so the window stays
+        responsive while a large profile and its search index are read.
+        """
+        def load():
+            try:
+                # Messages are only read once their conversation is opened
+                profile = Profile(journal=True, search=True, persist_search=True)
+                profile.load_profile(path, lazy=True)
+                self._opened.put((path, profile, None))
+            except Exception as ex:
+                self._opened.put((path, None, ex))
+
+        threading.Thread(target=load, daemon=True).start()
 
+    def _show_profile(self, path: str, profile: Profile):
+        """
+        Makes a loaded profile the current one, populates the GUI with its users and starts syncing it.
+        """
+        self._profile_filename = path
+        self._current_profile = profile
         self.body.reset_ui()
+        _remember_profile(path)
+        if self._timer is not None:
+            self._timer.mark("profile loaded")
+
+        # Populate the GUI with loaded users a chunk at a time
+        self.body.set_users(profile.get_users(), chunk_size=200, done=self._users_shown)
+        self._start_sync()
 
-        # Populate the GUI with loaded users
-        self.body.set_users(self._current_profile.get_users())
+    def _users_shown(self):
+        if self._timer is not None:
+            self._timer.mark("users shown")
+
+    def _start_sync(self):
+        """
+        Starts a background sync worker for the current profile, stopping the previous one first.
+        """
+        from sync_worker import SyncWorker
+
+        if self._sync_worker is not None:
+            self._sync_worker.stop()
+
+        self._sync_worker = SyncWorker(self._current_profile, self._profile_filename, USERNAME, PASSWORD)
+        self._sync_worker.start()
+        self.body.lock = self._sync_worker.lock
     
     def close(self):
         """
         Closes the program when the 'Close' menu item is clicked.
         """
+        if self._sync_worker is not None:
+            self._sync_worker.stop(timeout=5)
         self.root.destroy()
 
     def dark_changed(self, value:bool):
@@ -300,9 +649,12 @@ class MainApp(tk.Frame):
         """
         Saves the new username. Also destroys the add_user popup window.
         """
-        self.body.insert_user(User(user_name))
-        self._current_profile._users = self.body._users
-        self._current_profile.save_profile(self._profile_filename)
+        with self.body.lock:
+            self._current_profile.add_user(user_name)
+            self.body.set_users(self._current_profile.get_users(), only_new=True)
+        # A profile that was never opened has no file to save to
+        if self._sync_worker is not None:
+            self._sync_worker.saver.request()
 
         # Destroy window
         to_destroy.destroy()
@@ -325,18 +677,35 @@ class MainApp(tk.Frame):
                 # Clear the text box
                 self.body.set_text_entry("", self.body.entry_editor)
 
-                # Create the messenger object to send the message
-                messenger_obj = DirectMessenger(username=USERNAME, password=PASSWORD)
-                messenger_obj.send(selected_user, message_to_send, self._current_profile)
-                
-                # Update the GUI's users with the profile's after sending
-                self.body._users = self._current_profile.get_users()
+                # The sync worker queues the message and delivers it in the background, it shows up as pending
+                # until then
+                if self._sync_worker is not None:
+                    self._sync_worker.send(selected_user, message_to_send)
+                    with self._sync_worker.lock:
+                        self.body.node_select()
+
+    def conversation_active(self):
+        """
+        Makes the sync worker poll at its fastest rate while the user selects conversations or types.
+        """
+        if self._sync_worker is not None:
+            self._sync_worker.notify_activity()
+
+    def search_messages(self, query: str):
+        """
+        Shows the most recent messages of every conversation containing the text of the search box. The search
+        runs on a background thread, since the first one after a profile is opened builds the index, and
+        check_new_messages shows the hits.
+        """
+        profile = self._current_profile
+        lock = self.body.lock
 
-                self._current_profile._users = self.body._users
-                self._current_profile.save_profile(self._profile_filename)
+        def search():
+            with lock:
+                hits = profile.search(query, limit=200)
+            self._searches.put((profile, hits))
 
-                # Update the node containing messages
-                self.body.node_select()
+        threading.Thread(target=search, daemon=True).start()
 
     def _draw(self):
         """
@@ -352,36 +721,82 @@ class MainApp(tk.Frame):
         menu_file.add_command(label='Close', command=self.close)
 
         # The Body and Footer classes must be initialized and packed into the root window.
-        self.body = Body(self.root, self._current_profile)
+        self.body = Body(self.root, self.conversation_active, self.search_messages)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
+        if self._sync_worker is not None:
+            self.body.lock = self._sync_worker.lock
         
         self.footer = Footer(self.root, self.send_message, self.add_user, self.dark_changed)
         self.footer.pack(fill=tk.BOTH, side=tk.BOTTOM)
 
     def check_new_messages(self):
         """
-        Checks new messages from the remote server. Will run every 1 second in the main loop.
+        Applies the results reported by the sync worker to the GUI. Runs every 100 ms in the main loop and never
+        blocks, the network and disk work happens on the worker thread.
         """
         try:
-            # Create messenger object
-            messenger_obj = DirectMessenger(username=USERNAME, password=PASSWORD)
-            new_messages = messenger_obj.retrieve_new()
-
-            # If new messages isn't blank (there are messages)
-            if new_messages:
-                # Add the messages into the current profile
-                self._current_profile.add_message(new_messages=new_messages)
-                self._current_profile.save_profile(self._profile_filename)
-
-                # Refresh the node with new messages
-                self.body.node_select()
-        except:
-            print("Could not load new messages.")
+            while not self._opened.empty():
+                path, profile, error = self._opened.get_nowait()
+                if error is None:
+                    self._show_profile(path, profile)
+                else:
+                    print("Could not open the profile.", error)
+                    self._startup_done()
+
+            while not self._searches.empty():
+                profile, hits = self._searches.get_nowait()
+                # Hits for a profile that was closed in the meantime are dropped
+                if profile is self._current_profile:
+                    self.body.show_search_results(hits)
+
+            refresh = False
+            while self._sync_worker is not None:
+                try:
+                    result = self._sync_worker.results.get_nowait()
+                except queue.Empty:
+                    break
+
+                if result[0] in ("messages", "sent"):
+                    refresh = True
+                elif result[0] == "synced":
+                    if self._timer is not None:
+                        self._timer.mark("first sync")
+                    self._startup_done()
+                elif result[0] == "error":
+                    print("Could not load new messages.", result[1])
+                    self._startup_done()
+
+            if refresh:
+                with self._sync_worker.lock:
+                    # Show users the worker created for messages from new contacts
+                    self.body.set_users(self._current_profile.get_users(), only_new=True)
+
+                    # Refresh the node with new messages
+                    if self.body.users_tree.selection():
+                        self.body.node_select()
+        except Exception as ex:
+            print("Could not load new messages.", ex)
         finally:
-            self.root.after(1000, self.check_new_messages)
+            self.root.after(100, self.check_new_messages)
+
+    def _startup_done(self):
+        """
+        Prints the startup breakdown for --profile-startup once the first profile is synced or failed to open.
+        """
+        if self._timer is not None:
+            self._timer.report()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ICS 32 Distributed Social Demo")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long each phase of the startup took")
+    args = parser.parse_args()
+
+    timer = StartupTimer(_STARTED) if args.profile_startup else None
+    if timer is not None:
+        timer.mark("imports")
+
     # All Tkinter programs start with a root window. We will name ours 'main'.
     main = tk.Tk()
     style = ttk.Style(main)
@@ -401,7 +816,7 @@ if __name__ == "__main__":
     # Initialize the MainApp class, which is the starting point for the widgets used in the program.
     # All of the classes that we use, subclass Tk.Frame, since our root frame is main, we initialize 
     # the class with it.
-    app = MainApp(main)
+    app = MainApp(main, timer)
 
     # When update is called, we finalize the states of all widgets that have been configured within the root frame.
     # Here, Update ensures that we get an accurate width and height reading based on the types of widgets
@@ -411,8 +826,14 @@ if __name__ == "__main__":
     main.update()
     main.minsize(main.winfo_width(), main.winfo_height())
 
-    # Timer event to get new messages automatically
-    main.after(1000, app.check_new_messages)
+    # The window is shown before the last profile is read, it is loaded in the background and shown once ready
+    if timer is not None:
+        main.after_idle(timer.mark, "window shown")
+    if not app.open_last_profile() and timer is not None:
+        main.after_idle(timer.report)
+
+    # Timer event to apply new messages from the sync worker and the profile loaded at startup
+    main.after(100, app.check_new_messages)
 
     # And finally, start up the event loop for the program (more on this in lecture).
     main.mainloop()
\ No newline at end of file
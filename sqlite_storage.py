@@ -0,0 +1,186 @@
+# sqlite_storage.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+
+
+# timestamp holds every timestamp as a number, so the index serves range queries. timestamp_raw keeps the json of
+# the original timestamp when it was not a float, for example the strings the server sends, so it reads back as is
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profile (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    message TEXT,
+    timestamp REAL NOT NULL,
+    timestamp_raw TEXT,
+    sent_by_user INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_user_timestamp ON messages(user_id, timestamp);
+"""
+
+_INSERT_MESSAGE = ("INSERT INTO messages (user_id, message, timestamp, timestamp_raw, sent_by_user) "
+                   "VALUES (?, ?, ?, ?, ?)")
+
+
+def _timestamp_columns(timestamp) -> tuple:
+    """
+    Returns the timestamp and timestamp_raw column values of a timestamp. Timestamps that cannot be read as a
+    number are stored as 0.
+    """
+    if timestamp.__class__ is float:
+        return timestamp, None
+    try:
+        value = float(timestamp)
+    except (TypeError, ValueError):
+        value = 0.0
+    return value, json.dumps(timestamp)
+
+
+def _timestamp(value: float, raw: str):
+    return value if raw is None else json.loads(raw)
+
+
+class SqliteStorage:
+    """
+    Profile storage backend that keeps users and messages in a SQLite database.
+
+    The first save of a profile to a database rewrites it completely, later saves only insert the users and messages
+    added since, in one transaction. The database runs in WAL mode so other processes can read it while the GUI
+    is writing to it.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def save(self, profile) -> None:
+        """
+        Writes the profile's users and messages into the database.
+        """
+        with self._lock:
+            db = self._connect()
+            full = profile._snapshot is None or profile._snapshot[0] != str(self.path)
+
+            with db:
+                if full:
+                    db.execute("DELETE FROM messages")
+                    db.execute("DELETE FROM users")
+                db.executemany("INSERT OR REPLACE INTO profile (key, value) VALUES (?, ?)",
+                               [("dsuserver", profile.dsuserver), ("username", profile.username),
+                                ("password", profile.password)])
+
+                if full:
+                    for user in profile.get_users():
+                        user_id = self._user_id(db, user.name)
+                        db.executemany(_INSERT_MESSAGE, [(user_id, message) + _timestamp_columns(timestamp) + (sent,)
+                                                         for message, timestamp, sent in user._rows()])
+                else:
+                    for record in profile._pending_records():
+                        user_id = self._user_id(db, record["user"])
+                        if "message" in record:
+                            db.execute(_INSERT_MESSAGE, (user_id, record["message"]) +
+                                       _timestamp_columns(record["timestamp"]) + (record["sent by user"],))
+
+            self._bind_loaders(db, profile)
+
+        profile._snapshot = (str(self.path), None)
+        profile._pending = []
+
+    def load(self, profile, lazy: bool = False) -> None:
+        """
+        Populates the profile from the database.
+
+        :param lazy: only reads the user names, each user's messages are read when first accessed
+        """
+        with self._lock:
+            db = self._connect()
+            values = dict(db.execute("SELECT key, value FROM profile"))
+            profile.username = values.get("username")
+            profile.password = values.get("password")
+            profile.dsuserver = values.get("dsuserver")
+
+            for user_id, name in db.execute("SELECT id, name FROM users ORDER BY id").fetchall():
+                user = profile.add_user(name)
+                if not lazy:
+                    for message, timestamp, raw, sent_by_user in db.execute(
+                            "SELECT message, timestamp, timestamp_raw, sent_by_user FROM messages WHERE user_id = ? "
+                            "ORDER BY id", (user_id,)):
+                        user.add_message(message, _timestamp(timestamp, raw), bool(sent_by_user))
+
+            self._bind_loaders(db, profile, loaded=not lazy)
+
+        profile._snapshot = (str(self.path), None)
+        profile._pending = []
+
+    def _bind_loaders(self, db: sqlite3.Connection, profile, loaded: bool = True) -> None:
+        """
+        Lets every user read its messages back from the database.
+        """
+        stats = {user_id: (count, [first, last]) for user_id, count, first, last in db.execute(
+            "SELECT user_id, COUNT(*), MIN(timestamp), MAX(timestamp) FROM messages GROUP BY user_id")}
+        for user_id, name in db.execute("SELECT id, name FROM users"):
+            user = profile.get_user(name)
+            if user is not None:
+                count, bounds = stats.get(user_id, (0, None))
+                user._bind_loader(_SqliteLoader(self, user_id), count, loaded and user.is_loaded(), bounds)
+
+    def _user_id(self, db: sqlite3.Connection, name: str) -> int:
+        db.execute("INSERT OR IGNORE INTO users (name) VALUES (?)", (name,))
+        return db.execute("SELECT id FROM users WHERE name = ?", (name,)).fetchone()[0]
+
+    def read_messages(self, user_id: int) -> list:
+        """
+        Returns one user's messages as the message dicts User stores.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT message, timestamp, timestamp_raw, sent_by_user FROM messages WHERE user_id = ? ORDER BY id",
+                (user_id,)).fetchall()
+
+        return [{"message": message, "timestamp": _timestamp(timestamp, raw), "sent by user": bool(sent_by_user)}
+                for message, timestamp, raw, sent_by_user in rows]
+
+
+class _SqliteLoader:
+    """
+    Reads one user's messages from the database, the counterpart of the DSU file loader.
+    """
+    def __init__(self, storage: SqliteStorage, user_id: int):
+        self.storage = storage
+        self.user_id = user_id
+
+    def read(self) -> bytes:
+        return json.dumps(self()).encode()
+
+    def __call__(self) -> list:
+        return self.storage.read_messages(self.user_id)
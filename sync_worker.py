@@ -0,0 +1,283 @@
+# sync_worker.py
+
+# Ryan Zhang, Yash Pathak
+# ryanyz@uci.edu, pathaky@uci.edu
+# 20907746, 51317074
+
+import os
+import queue
+import threading
+import time
+from ds_messenger import DirectMessenger, DirectMessage
+from ds_outbox import Outbox
+from ds_sync import SyncEngine
+from Profile import SaveScheduler
+
+
+
+class _LockedProfile:
+    """
+    Wraps a profile so messages recorded by the messenger are added while holding the worker's lock, without holding
+    it for the whole network round trip.
+    """
+    def __init__(self, profile, lock):
+        self._profile = profile
+        self._lock = lock
+
+    def add_message(self, **kwargs) -> None:
+        with self._lock:
+            self._profile.add_message(**kwargs)
+
+    def get_users(self) -> list:
+        return self._profile.get_users()
+
+
+class SyncWorker(threading.Thread):
+    """
+    Background thread that does all network and disk work for the GUI. It polls the server for new messages, delivers
+    the messages waiting in the outbox and saves the profile, then reports back through the results queue, which the
+    Tk main loop drains without blocking.
+
+    Sent messages are written to an outbox next to the profile (path + '.outbox') and shown in the profile as pending
+    right away. The worker delivers them in the order they were queued, with the time they were written as their
+    timestamp, so the recipient sees them in order even if some had to be retried. After a failed delivery the
+    remaining messages are retried after a delay that doubles with every failure, from retry_min up to retry_max
+    seconds. Messages still waiting when the program exits are delivered after the next start.
+
+    Polling is adaptive: the interval is reset to min_interval whenever messages arrive or are sent, and grows by
+    backoff each idle poll until it reaches max_interval.
+
+    Conversations that have not been looked at for release_after seconds are released from memory after each poll.
+
+    Saves go through a SaveScheduler, so the changes of a busy conversation are written once every save_delay
+    seconds at most instead of after every poll. stop saves whatever is left. Failed saves are reported as errors
+    and retried.
+
+    Results are tuples of the form ("messages", list), ("sent", recipient, success), ("error", str) or
+    ("synced", count), which is reported once after the first poll completes.
+    """
+    def __init__(self, profile, path: str, username: str, password: str, dsuserver: str = "168.235.86.101",
+                 port: int = 3021, min_interval: float = 1.0, max_interval: float = 15.0, backoff: float = 1.5,
+                 release_after: float = 300.0, retry_min: float = 1.0, retry_max: float = 300.0,
+                 save_delay: float = 1.0, save_max_delay: float = 5.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.profile = profile
+        self.path = path
+        self.username = username
+        self.password = password
+        self.dsuserver = dsuserver
+        self.port = port
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.release_after = release_after
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+
+        # Held while the profile is modified or saved, the GUI takes it before changing the profile itself
+        self.lock = threading.RLock()
+        self.results = queue.Queue()
+        self.saver = SaveScheduler(profile, path, save_delay, save_max_delay, self.lock, self._save_sync_state,
+                                   self._save_failed)
+
+        self.outbox = Outbox(path + '.outbox')
+        with self.lock:
+            self.outbox.restore(profile)
+        # Delay before the next delivery attempt after a failure, and when it is due
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        # Ids of delivered messages that stay in the outbox until the profile is saved
+        self._delivered = []
+
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._messenger = None
+        self._engine = None
+        self._synced = False
+
+    def notify_activity(self) -> None:
+        """
+        Tells the worker that the conversation is active, so it polls at the fastest rate. The worker is only woken
+        up if it had backed off, so a burst of activity does not poll on every call.
+        """
+        if self.interval > self.min_interval:
+            self.interval = self.min_interval
+            self._wake.set()
+
+    def send(self, recipient: str, message: str) -> DirectMessage:
+        """
+        Queues a message in the outbox and adds it to the profile as pending. Every delivery attempt is reported as
+        ("sent", recipient, success).
+
+        :return: the queued message
+        """
+        # Queued and added under the lock, so the worker never delivers a message the profile does not have yet
+        with self.lock:
+            message_obj = self.outbox.put(recipient, message)
+            self.profile.add_message(our_message=message_obj, pending=True)
+        self.saver.request()
+        self.interval = self.min_interval
+        self._wake.set()
+        return message_obj
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stops the worker, waits for it to finish the request in progress and saves the profile if it changed.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+        self.saver.close()
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                active = self._deliver()
+                active = self._poll() or active
+
+                with self.lock:
+                    self.profile.release_idle(self.release_after)
+            except Exception as ex:
+                self.results.put(("error", str(ex)))
+                active = False
+
+            # Speed up while the conversation is active, back off while it is idle
+            if active:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+
+            self._wake.wait(self._wait_time())
+            self._wake.clear()
+
+        if self._messenger is not None:
+            self._messenger.close()
+
+    def _save_sync_state(self) -> None:
+        """
+        Saves the sync state right after the profile, so it never records messages the saved profile does not have.
+        """
+        if self._engine is not None:
+            self._engine.save_state()
+
+    def _save_failed(self, ex: Exception) -> None:
+        """
+        Reports a failed save of the profile or the sync state, which is retried with the next save.
+        """
+        self.results.put(("error", "Could not save the profile. %s" % ex))
+
+    def _get_messenger(self) -> DirectMessenger:
+        """
+        Returns the worker's messenger, which keeps one connection open between polls.
+        """
+        if self._messenger is None or self._messenger.token is None:
+            if self._messenger is not None:
+                self._messenger.close()
+            self._messenger = DirectMessenger(self.dsuserver, self.port, self.username, self.password, persistent=True)
+
+        return self._messenger
+
+    def _wait_time(self) -> float:
+        """
+        Returns the seconds until the next poll, or until the next delivery attempt if that comes first.
+        """
+        if self._retry_at and len(self.outbox):
+            return max(0.0, min(self.interval, self._retry_at - time.monotonic()))
+        return self.interval
+
+    def _deliver(self) -> bool:
+        """
+        Sends the messages waiting in the outbox over one connection, in waves that pipeline the next message to every
+        recipient. A recipient whose message failed gets nothing more this round, so its messages are never
+        delivered out of order. Delivered messages are marked in the profile,
+        which is saved, and only then removed from the outbox, so a crash in between sends a message twice rather
+        than never. If the save fails they are not sent again, and are removed from the outbox after the next
+        successful save.
+
+        :return: True if any message was delivered
+        """
+        if self._delivered:
+            self._save_delivered()
+
+        entries = [entry for entry in self.outbox.pending() if entry[0] not in self._delivered]
+        if not entries or time.monotonic() < self._retry_at:
+            return False
+
+        # The messages to each recipient, the next one to send last
+        queues = {}
+        for entry in entries:
+            queues.setdefault(entry[1].recipient, []).append(entry)
+        queues = [queue[::-1] for queue in queues.values()]
+
+        delivered = []
+        failed = False
+        while queues:
+            wave = [queue.pop() for queue in queues]
+            try:
+                results = self._get_messenger().send_many([(message_obj.recipient, message_obj.message,
+                                                            message_obj.timestamp) for _, message_obj in wave])
+            except Exception as ex:
+                self.results.put(("error", str(ex)))
+                results = [False] * len(wave)
+
+            for (message_id, message_obj), success in zip(wave, results):
+                self.results.put(("sent", message_obj.recipient, success))
+                if success:
+                    delivered.append((message_id, message_obj))
+            failed = failed or not all(results)
+            queues = [queue for queue, success in zip(queues, results) if success and queue]
+
+        if not failed:
+            self._retry_delay = 0.0
+            self._retry_at = 0.0
+        else:
+            self._retry_delay = min(max(self._retry_delay * 2, self.retry_min), self.retry_max)
+            self._retry_at = time.monotonic() + self._retry_delay
+
+        if not delivered:
+            return False
+
+        with self.lock:
+            for _, message_obj in delivered:
+                self.profile.set_pending(message_obj, False)
+        self._delivered.extend(message_id for message_id, _ in delivered)
+        self._save_delivered()
+
+        return True
+
+    def _save_delivered(self) -> None:
+        """
+        Removes the delivered messages from the outbox once the profile is saved.
+        """
+        # Queued messages were added to the profile, which has to be saved before they leave the outbox
+        if self.saver.flush():
+            self.outbox.mark_delivered(self._delivered)
+            self._delivered = []
+
+    def _poll(self) -> bool:
+        """
+        Retrieves new messages, adds the ones not seen before into the profile and schedules a save. The sync state
+        is kept next to the profile (path + '.sync') and saved along with it, so a restart never adds messages twice.
+
+        :return: True if any message was received
+        """
+        if self._engine is None:
+            with self.lock:
+                self._engine = SyncEngine(self._get_messenger(), _LockedProfile(self.profile, self.lock),
+                                          self.path + '.sync', autosave=False)
+        self._engine.messenger = self._get_messenger()
+
+        new_messages = self._engine.sync()
+        if not self._synced:
+            self._synced = True
+            self.results.put(("synced", len(new_messages)))
+        if new_messages or not os.path.exists(self.path + '.sync'):
+            self.saver.request()
+        if not new_messages:
+            return False
+
+        self.results.put(("messages", new_messages))
+        return True
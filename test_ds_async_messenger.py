@@ -0,0 +1,119 @@
+import asyncio
+from ds_server import DsuServer
+from ds_async_messenger import AsyncDirectMessenger
+from ds_messenger import TokenCache
+from Profile import Profile
+
+
+server = DsuServer(port=0)
+PORT = server.start_in_thread()
+
+
+def messenger(username, **kwargs):
+    return AsyncDirectMessenger("127.0.0.1", PORT, username, "pass_test", token_cache=TokenCache(), **kwargs)
+
+def test_send_and_retrieve():
+    async def run():
+        profile = Profile()
+        async with messenger("async_alice") as alice, messenger("async_bob") as bob:
+            results = await asyncio.gather(*(alice.send("async_bob", f"message {i}", profile) for i in range(10)))
+            assert all(results)
+            # Requests share the one open stream
+            assert alice._writer is not None
+
+            assert [m["message"] for m in await bob.retrieve_new()] == [f"message {i}" for i in range(10)]
+            assert await bob.retrieve_new() == []
+            assert len(await bob.retrieve_all()) == 10
+        assert alice._writer is None
+        assert len(profile.get_user("async_bob").get_messages()) == 10
+
+    asyncio.run(run())
+
+def test_timeout():
+    async def run():
+        async with messenger("async_carol", timeout=2.0) as carol:
+            assert await carol.join()
+
+            server.latency = 0.5
+            try:
+                assert not await carol.send("async_dave", "too slow", timeout=0.1)
+                # The late reply must never be read as the answer to the next request
+                assert carol._writer is None
+            finally:
+                server.latency = 0.0
+
+            assert await carol.send("async_dave", "in time")
+
+        # The timed out message may still be delivered once the server gets to it
+        async with messenger("async_dave") as dave:
+            assert "in time" in [m["message"] for m in await dave.retrieve_all()]
+
+    asyncio.run(run())
+
+def test_cancellation():
+    async def run():
+        async with messenger("async_erin") as erin:
+            assert await erin.join()
+
+            server.latency = 0.5
+            try:
+                task = asyncio.create_task(erin.send("async_frank", "cancelled"))
+                await asyncio.sleep(0.1)
+                task.cancel()
+                try:
+                    await task
+                    assert False, "send was not cancelled"
+                except asyncio.CancelledError:
+                    pass
+                assert erin._writer is None
+                assert not erin._lock.locked()
+            finally:
+                server.latency = 0.0
+
+            assert await erin.send("async_frank", "after cancel")
+            assert await erin.retrieve_new() == []
+
+    asyncio.run(run())
+
+def test_dropped_connection():
+    dropping = DsuServer(port=0, idle_timeout=0.5)
+    port = dropping.start_in_thread()
+
+    async def run():
+        async with AsyncDirectMessenger("127.0.0.1", port, "async_gail", "pass_test", token_cache=TokenCache()) as gail:
+            assert await gail.send("async_hugo", "before")
+
+            # A connection the server closed while it sat idle is replaced before the next request is written
+            reader = gail._reader
+            for _ in range(100):
+                if reader.at_eof():
+                    break
+                await asyncio.sleep(0.05)
+            assert await gail.send("async_hugo", "after")
+
+            # A request that reached the server is never sent again, even over a reused connection
+            dropping.drop_rate = 1.0
+            assert not await gail.send("async_hugo", "dropped")
+            dropping.drop_rate = 0.0
+
+        async with AsyncDirectMessenger("127.0.0.1", port, "async_hugo", "pass_test", token_cache=TokenCache()) as hugo:
+            assert [m["message"] for m in await hugo.retrieve_all()] == ["before", "after", "dropped"]
+
+    asyncio.run(run())
+    dropping.stop()
+
+def test_unreachable_server():
+    async def run():
+        nobody = AsyncDirectMessenger("127.0.0.1", 1, "nobody", "pass_test", token_cache=TokenCache())
+        assert not await nobody.send("async_alice", "lost")
+        assert await nobody.retrieve_new() is None
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    test_send_and_retrieve()
+    test_timeout()
+    test_cancellation()
+    test_dropped_connection()
+    test_unreachable_server()
+    server.stop()
@@ -1,7 +1,132 @@
-from ds_messenger import DirectMessenger
+import select
+from ds_messenger import DirectMessenger, ConnectionPool, TokenCache
+from ds_metrics import Metrics
+from ds_server import DsuServer
+from Profile import Profile
 
-messenger = DirectMessenger(username="3245", password="mypass")
 
-messenger.send("3245", "this is a test message")
-print(messenger.retrieve_new())
-print(messenger.retrieve_all())
\ No newline at end of file
+server = DsuServer(port=0)
+PORT = server.start_in_thread()
+
+
+def messenger(username, **kwargs):
+    return DirectMessenger("127.0.0.1", PORT, username, "pass_test", token_cache=TokenCache(), **kwargs)
+
+def test_send_and_retrieve():
+    alice = messenger("alice")
+    bob = messenger("bob")
+
+    assert alice.send("bob", "hello bob")
+    assert [m["message"] for m in bob.retrieve_new()] == ["hello bob"]
+    assert bob.retrieve_new() == []
+    assert len(bob.retrieve_all()) == 1
+
+def test_non_ascii_message():
+    text = "h\u00e9llo \U0001F44B \u4f60\u597d"
+    assert messenger("uma", persistent=True).send("vera", text)
+    assert messenger("uma").send_many([("vera", text + " batched")]) == [True]
+    assert [m["message"] for m in messenger("vera").retrieve_new()] == [text, text + " batched"]
+
+def test_persistent_connection():
+    with messenger("carol", persistent=True) as carol:
+        for i in range(10):
+            assert carol.send("dave", f"message {i}")
+        assert carol._connection.is_open()
+
+    assert not carol._connection.is_open()
+    assert len(messenger("dave").retrieve_all()) == 10
+
+def test_connection_pool_reuse():
+    with ConnectionPool("127.0.0.1", PORT, max_size=2) as pool:
+        assert messenger("olga", pool=pool).send("pete", "first")
+        connection = pool._idle[0]
+
+        # Other messengers on the pool send over the same open socket instead of connecting again
+        assert messenger("pete", pool=pool).send("olga", "second")
+        assert messenger("olga", pool=pool).send("pete", "third")
+        assert pool._idle == [connection]
+        assert connection.is_open()
+
+        # Connections checked out at the same time are never shared
+        first = pool.acquire()
+        second = pool.acquire()
+        assert first is connection and second is not connection
+        pool.release(first)
+        pool.release(second, discard=True)
+        assert pool._idle == [connection]
+
+    assert not connection.is_open()
+    assert [m["message"] for m in messenger("pete").retrieve_all()] == ["first", "third"]
+
+def test_dropped_connection():
+    dropping = DsuServer(port=0, idle_timeout=0.5)
+    port = dropping.start_in_thread()
+
+    with DirectMessenger("127.0.0.1", port, "sara", "pass_test", persistent=True, token_cache=TokenCache()) as sara:
+        assert sara.send("tina", "before")
+
+        # A connection the server closed while it sat idle is replaced before the next request is written
+        select.select([sara._connection._client], [], [], 5.0)
+        assert sara.send("tina", "after")
+
+        # Requests that reached the server are never sent again, even over a reused connection, and the messages
+        # without a reply count as failed
+        dropping.drop_rate = 1.0
+        assert not sara.send("tina", "dropped")
+        assert sara.send_many([("tina", f"dropped batch {i}") for i in range(3)]) == [False] * 3
+        dropping.drop_rate = 0.0
+
+    received = DirectMessenger("127.0.0.1", port, "tina", "pass_test", token_cache=TokenCache()).retrieve_all()
+    assert [m["message"] for m in received] == ["before", "after", "dropped", "dropped batch 0"]
+    dropping.stop()
+
+def test_token_cache():
+    cache = TokenCache()
+    quinn = DirectMessenger("127.0.0.1", PORT, "quinn", "pass_test", token_cache=cache)
+    assert quinn.send("rosa", "joined")
+    assert cache.get("127.0.0.1", PORT, "quinn", "pass_test") == quinn.token
+
+    # A new messenger for the same account reuses the cached token instead of joining again
+    metrics = Metrics(enabled=True)
+    again = DirectMessenger("127.0.0.1", PORT, "quinn", "pass_test", token_cache=cache, metrics=metrics)
+    assert again.send("rosa", "cached")
+    assert "join" not in metrics.stats()["timings"]
+
+    # A stale token is rejected by the server, the messenger joins again and caches the new one
+    cache.set("127.0.0.1", PORT, "quinn", "pass_test", "stale")
+    stale = DirectMessenger("127.0.0.1", PORT, "quinn", "pass_test", token_cache=cache, metrics=metrics)
+    assert stale.send("rosa", "rejoined")
+    assert metrics.stats()["timings"]["join"]["total"]["count"] == 1
+    assert cache.get("127.0.0.1", PORT, "quinn", "pass_test") == quinn.token
+    assert cache.get("127.0.0.1", PORT, "quinn", "wrong password") is None
+    assert [m["message"] for m in messenger("rosa").retrieve_all()] == ["joined", "cached", "rejoined"]
+
+def test_send_many():
+    profile = Profile()
+    results = messenger("gina", persistent=True).send_many([("hank", f"batch {i}") for i in range(100)], profile)
+
+    assert all(results)
+    assert len(profile.get_user("hank").get_messages()) == 100
+    assert len(messenger("hank").retrieve_new()) == 100
+
+def test_send_many_order():
+    # The server rejects messages without a recipient, results line up with the messages they belong to
+    messages = [("" if i % 4 == 3 else "ian", f"ordered {i}") for i in range(40)]
+    profile = Profile()
+    results = messenger("hugo", persistent=True).send_many(messages, profile)
+
+    assert results == [i % 4 != 3 for i in range(40)]
+    received = messenger("ian").retrieve_new()
+    assert [m["message"] for m in received] == [f"ordered {i}" for i in range(40) if i % 4 != 3]
+    assert [m["message"] for m in profile.get_user("ian").get_messages()] == [m["message"] for m in received]
+
+if __name__ == "__main__":
+    test_send_and_retrieve()
+    test_non_ascii_message()
+    test_persistent_connection()
+    test_connection_pool_reuse()
+    test_dropped_connection()
+    test_token_cache()
+    test_send_many()
+    test_send_many_order()
+    server.stop()
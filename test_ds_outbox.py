@@ -0,0 +1,151 @@
+import os
+import tempfile
+from ds_outbox import Outbox
+from ds_server import DsuServer
+from ds_messenger import DirectMessenger, TokenCache
+from sync_worker import SyncWorker
+from Profile import Profile, DsuFileError
+
+
+server = DsuServer(port=0)
+PORT = server.start_in_thread()
+
+
+def test_outbox_survives_restart():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu.outbox")
+        outbox = Outbox(path)
+        for i in range(3):
+            outbox.put("bob", f"message {i}", 1000.0 + i)
+        outbox.mark_delivered([1])
+
+        # A crash while appending leaves a partial line behind
+        with open(path, 'a') as f:
+            f.write('{"id": 4, "recipient": "bob"')
+
+        outbox = Outbox(path)
+        assert [(message_id, m.message, m.timestamp) for message_id, m in outbox.pending()] == [
+            (2, "message 1", 1001.0), (3, "message 2", 1002.0)]
+        assert outbox.put("carol", "message 3").recipient == "carol"
+        assert len(Outbox(path)) == 3
+
+        outbox.mark_delivered([2, 3, 4])
+        assert not os.path.exists(path)
+
+def test_worker_delivers_after_failures():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        profile = Profile(journal=True)
+        profile.save_profile(path)
+
+        server.error_rate = 1.0
+        worker = SyncWorker(profile, path, "outbox_alice", "pass_test", "127.0.0.1", PORT, retry_min=0.5)
+        for i in range(5):
+            worker.send("outbox_bob", f"queued {i}")
+
+        assert not worker._deliver()
+        assert worker._retry_delay == 0.5
+        assert len(worker.outbox) == 5
+        assert profile.get_user("outbox_bob").pending_count() == 5
+        assert all(m["pending"] for m in profile.get_user("outbox_bob").get_messages())
+        worker.stop()
+
+        # A restarted worker shows the queued messages as pending again
+        restarted = Profile(journal=True)
+        restarted.load_profile(path)
+        worker = SyncWorker(restarted, path, "outbox_alice", "pass_test", "127.0.0.1", PORT)
+        assert restarted.get_user("outbox_bob").pending_count() == 5
+
+        server.error_rate = 0.0
+        assert worker._deliver()
+        worker.stop()
+
+        assert len(worker.outbox) == 0
+        assert restarted.get_user("outbox_bob").pending_count() == 0
+        assert "pending" not in restarted.get_user("outbox_bob").get_messages()[0]
+
+        bob = DirectMessenger("127.0.0.1", PORT, "outbox_bob", "pass_test", token_cache=TokenCache())
+        assert [m["message"] for m in bob.retrieve_new()] == [f"queued {i}" for i in range(5)]
+
+def test_worker_keeps_messages_until_saved():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        profile = Profile(journal=True)
+        profile.save_profile(path)
+        worker = SyncWorker(profile, path, "outbox_carol", "pass_test", "127.0.0.1", PORT)
+        for i in range(3):
+            worker.send("outbox_dave", f"unsaved {i}")
+
+        def fail(path):
+            raise DsuFileError("disk full")
+        profile.save_profile = fail
+
+        # Delivered, but the profile could not be saved, so the messages stay in the outbox without being sent again
+        assert worker._deliver()
+        assert len(worker.outbox) == 3
+        assert not worker._deliver()
+        assert len(worker.outbox) == 3
+
+        del profile.save_profile
+        assert not worker._deliver()
+        assert len(worker.outbox) == 0
+        worker.stop()
+
+        dave = DirectMessenger("127.0.0.1", PORT, "outbox_dave", "pass_test", token_cache=TokenCache())
+        assert [m["message"] for m in dave.retrieve_new()] == [f"unsaved {i}" for i in range(3)]
+
+        loaded = Profile()
+        loaded.load_profile(path)
+        messages = loaded.get_user("outbox_dave").get_messages()
+        assert [m["message"] for m in messages] == [f"unsaved {i}" for i in range(3)]
+
+def test_worker_activity_wakes_once():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        profile = Profile()
+        profile.save_profile(path)
+        worker = SyncWorker(profile, path, "outbox_hank", "pass_test", "127.0.0.1", PORT, max_interval=8.0)
+
+        # Already polling at the fastest rate, typing does not wake the worker
+        worker.notify_activity()
+        assert not worker._wake.is_set()
+
+        worker.interval = 8.0
+        worker.notify_activity()
+        assert worker.interval == worker.min_interval
+        assert worker._wake.is_set()
+        worker.stop()
+
+def test_worker_keeps_order_per_recipient():
+    flaky = DsuServer(port=0, error_rate=0.3, seed=3)
+    port = flaky.start_in_thread()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        profile = Profile(journal=True)
+        profile.save_profile(path)
+        worker = SyncWorker(profile, path, "outbox_erin", "pass_test", "127.0.0.1", port, retry_min=0.0)
+        for i in range(20):
+            worker.send("outbox_fred", f"fred {i}")
+            worker.send("outbox_gina", f"gina {i}")
+
+        # Requests fail at random, the messages after a failed one wait for the next round
+        rounds = 0
+        while len(worker.outbox) and rounds < 100:
+            worker._deliver()
+            worker._retry_at = 0.0
+            rounds += 1
+        assert len(worker.outbox) == 0 and rounds > 1
+        worker.stop()
+
+    flaky.error_rate = 0.0
+    for name in ("fred", "gina"):
+        recipient = DirectMessenger("127.0.0.1", port, f"outbox_{name}", "pass_test", token_cache=TokenCache())
+        assert [m["message"] for m in recipient.retrieve_all()] == [f"{name} {i}" for i in range(20)]
+    flaky.stop()
+
+if __name__ == "__main__":
+    test_outbox_survives_restart()
+    test_worker_delivers_after_failures()
+    test_worker_keeps_messages_until_saved()
+    test_worker_activity_wakes_once()
+    test_worker_keeps_order_per_recipient()
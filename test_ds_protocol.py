@@ -11,4 +11,24 @@ print(ds_protocol.encode_json(command="directmessage", token="user_token", direc
 print(ds_protocol.encode_json(command="directmessage", token="user_token", directmessage="new"))
 print(ds_protocol.encode_json(command="directmessage", token="user_token", directmessage="all"))
 print(ds_protocol.extract_json(server_response_1))
-print(ds_protocol.extract_json(server_response_2))
\ No newline at end of file
+print(ds_protocol.extract_json(server_response_2))
+
+def test_non_ascii():
+    # Every backend escapes non-ascii text like json.dumps, so the request encodes the same in any locale
+    entry = "héllo \U0001F44B 你好"
+    data = ds_protocol.encode_json(command="directmessage", token="user_token", directmessage={
+        "entry": entry, "recipient": "ohhimark", "timestamp": "1603167689.3928561"})
+
+    assert data.isascii()
+    assert json.loads(data)["directmessage"]["entry"] == entry
+    assert ds_protocol._dumps(entry) == json.dumps(entry)
+    response_obj = {"response": {"type": "ok", "messages": [{"message": entry, "from": "markb",
+                                                             "timestamp": "1603167689.3928561"}]}}
+    assert ds_protocol._dumps(response_obj) == json.dumps(response_obj)
+    response = json.dumps(response_obj)
+    assert ds_protocol.extract_json(response.encode()).response_message[0]["message"] == entry
+    assert ds_protocol.extract_json(json.dumps(json.loads(response), ensure_ascii=False).encode("utf-8")
+                                    ).response_message[0]["message"] == entry
+
+if __name__ == "__main__":
+    test_non_ascii()
@@ -0,0 +1,104 @@
+import os
+import random
+import tempfile
+import ds_search
+from ds_messenger import DirectMessage
+from ds_search import tokenize
+from Profile import Profile
+
+
+WORDS = "i the a to see you lunch".split()
+
+
+def sample_messages(count: int, offset: float = 0.0) -> list:
+    rng = random.Random(count)
+    return [{"message": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 8))), "from": f"user{i % 5}",
+             "timestamp": str(1000.0 + offset + i)} for i in range(count)]
+
+def scan(messages: list, query: str, limit: int, user_name: str = None) -> list:
+    # What search should return, found by checking every message
+    phrase = " %s " % " ".join(tokenize(query))
+    hits = [(m["from"], m["message"], m["timestamp"]) for m in messages
+            if phrase in " %s " % " ".join(tokenize(m["message"])) and user_name in (None, m["from"])]
+    return sorted(hits, key=lambda hit: float(hit[2]), reverse=True)[:limit]
+
+def test_profile_search():
+    profile = Profile(search=True)
+    profile.add_message(new_messages=[{"message": f"Lunch at {i} tomorrow?", "from": f"user{i % 3}",
+                                       "timestamp": str(1000.0 + i)} for i in range(30)])
+    profile.add_message(our_message=DirectMessage("user0", "lunch AT noon works", 1100.0))
+
+    assert profile.search("lunch at noon") == [("user0", "lunch AT noon works", 1100.0)]
+    assert [hit[1] for hit in profile.search("LUNCH", limit=3)] == ["lunch AT noon works", "Lunch at 29 tomorrow?",
+                                                                     "Lunch at 28 tomorrow?"]
+    assert [hit[1] for hit in profile.search("tomorrow", limit=2, user_name="user1")] == ["Lunch at 28 tomorrow?",
+                                                                                           "Lunch at 25 tomorrow?"]
+    assert profile.search("at lunch") == []
+    assert profile.search("dinner") == []
+
+def test_profile_search_load():
+    profile = Profile(journal=True, persist_search=True)
+    profile.add_message(new_messages=[{"message": f"message {i}", "from": f"user{i % 3}", "timestamp": str(1000.0 + i)}
+                                      for i in range(30)])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "search.dsu")
+        profile.save_profile(path)
+        profile.compact(path)
+        assert os.path.exists(path + ".search")
+        # Saved to the journal after the index file was written
+        profile.add_message(new_messages=[{"message": "message 7 again", "from": "user4", "timestamp": "2000.0"}])
+        profile.save_profile(path)
+
+        persisted = Profile(persist_search=True)
+        persisted.load_profile(path, lazy=True)
+        rebuilt = Profile()
+        rebuilt.load_profile(path)
+
+        # Without a saved index a lazy load only reads the conversations in the journal, the first search builds
+        # the index
+        lazy = Profile(search=True)
+        lazy.load_profile(path, lazy=True)
+        assert lazy._search is None
+        assert [user.name for user in lazy.get_users() if user.is_loaded()] == ["user4"]
+
+        expected = [("user4", "message 7 again", "2000.0"), ("user1", "message 7", "1007.0")]
+        assert persisted.search("message 7") == expected
+        assert rebuilt.search("message 7") == expected
+        assert lazy.search("message 7") == expected
+
+def test_phrases():
+    # Messages indexed late, with older timestamps, are merged into the lists in timestamp order
+    messages = sample_messages(3000) + sample_messages(500, offset=0.5)
+    queries = ["the", "see you", "the a", "a the a", "i the a to", "you you you", "lunch to see", "dinner", "to dinner"]
+
+    buckets = ds_search.PAIR_BUCKETS
+    try:
+        for ds_search.PAIR_BUCKETS in (buckets, 1):
+            # With a single bucket every pair collides with every other one
+            profile = Profile(search=True)
+            profile.add_message(new_messages=messages[:3000])
+            profile.add_message(new_messages=messages[3000:])
+            for query in queries:
+                assert profile.search(query, limit=20) == scan(messages, query, 20)
+                assert profile.search(query, limit=5, user_name="user3") == scan(messages, query, 5, "user3")
+    finally:
+        ds_search.PAIR_BUCKETS = buckets
+
+    # Every word and every pair of the phrase is there, the phrase is not
+    profile = Profile(search=True)
+    profile.add_message(new_messages=[{"message": "see you", "from": "user0", "timestamp": "1.0"},
+                                      {"message": "you at lunch", "from": "user0", "timestamp": "2.0"},
+                                      {"message": "you at the lunch", "from": "user1", "timestamp": "3.0"}])
+    assert profile.search("see you at lunch") == []
+    assert profile.search("you at lunch") == [("user0", "you at lunch", "2.0")]
+
+    # Messages with the same timestamp are found in every list
+    profile.add_message(new_messages=[{"message": "see you at lunch", "from": f"user{i}", "timestamp": "4.0"}
+                                      for i in range(3)])
+    assert [hit[0] for hit in profile.search("see you at lunch")] == ["user2", "user1", "user0"]
+
+if __name__ == "__main__":
+    test_profile_search()
+    test_profile_search_load()
+    test_phrases()
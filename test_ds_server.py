@@ -0,0 +1,148 @@
+import os
+import tempfile
+from ds_server import DsuServer, run_load
+from ds_messenger import DirectMessenger, ConnectionPool, TokenCache
+from ds_sync import SyncEngine
+from ds_metrics import Metrics
+from Profile import Profile
+
+
+server = DsuServer(port=0)
+PORT = server.start_in_thread()
+
+
+def messenger(username, **kwargs):
+    return DirectMessenger("127.0.0.1", PORT, username, "pass_test", token_cache=TokenCache(), **kwargs)
+
+def test_send_and_retrieve():
+    alice = messenger("alice")
+    bob = messenger("bob")
+
+    assert alice.send("bob", "hello bob")
+    new_messages = bob.retrieve_new()
+    print(new_messages)
+
+    assert [m["message"] for m in new_messages] == ["hello bob"]
+    assert bob.retrieve_new() == []
+    assert len(bob.retrieve_all()) == 1
+
+def test_persistent_connection():
+    with messenger("carol", persistent=True) as carol:
+        for i in range(10):
+            assert carol.send("dave", f"message {i}")
+        assert carol._connection.is_open()
+
+    assert not carol._connection.is_open()
+    assert len(messenger("dave").retrieve_all()) == 10
+
+def test_connection_pool():
+    with ConnectionPool("127.0.0.1", PORT, max_size=2) as pool:
+        erin = messenger("erin", pool=pool)
+        assert erin.send("frank", "pooled")
+        assert len(pool._idle) == 1
+
+def test_send_many():
+    profile = Profile()
+    results = messenger("gina", persistent=True).send_many([("hank", f"batch {i}") for i in range(100)], profile)
+
+    assert all(results)
+    assert len(profile.get_user("hank").get_messages()) == 100
+    assert len(messenger("hank").retrieve_new()) == 100
+
+def test_iter_all():
+    ivan = messenger("ivan")
+    for i in range(50):
+        ivan.send("judy", f"stream {i}")
+
+    judy = messenger("judy", persistent=True)
+    messages = list(judy.iter_all(chunk_size=64))
+
+    assert [m["message"] for m in messages] == [f"stream {i}" for i in range(50)]
+    assert len(judy.retrieve_all()) == 50
+
+def test_sync_engine_dedup():
+    kim = messenger("kim")
+    for i in range(20):
+        kim.send("leo", f"sync {i}")
+
+    profile = Profile()
+    engine = SyncEngine(messenger("leo"), profile)
+
+    assert len(engine.sync()) == 20
+    assert engine.sync(recover=True) == []
+    assert len(profile.get_user("kim").get_messages()) == 20
+
+    # Timestamps that are not a number are looked up instead of compared with the high-water mark
+    odd = {"message": "odd", "from": "kim", "timestamp": "soon"}
+    assert engine.state.filter([odd, dict(odd)]) == [odd]
+    assert engine.state.filter([odd]) == []
+
+def test_sync_engine_dropped_connection():
+    dropping = DsuServer(port=0)
+    port = dropping.start_in_thread()
+    sender = DirectMessenger("127.0.0.1", port, "owen", "pass_test", token_cache=TokenCache())
+    for i in range(40):
+        sender.send("pia", f"history {i}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        state_path = os.path.join(directory, "pia.dsu.sync")
+        profile = Profile()
+        engine = SyncEngine(DirectMessenger("127.0.0.1", port, "pia", "pass_test", token_cache=TokenCache()), profile,
+                            state_path)
+
+        # The server goes away halfway through the first "all", the messages read so far are kept but the history
+        # does not count as synced
+        dropping.drop_rate = 1.0
+        partial = engine.sync()
+        assert 0 < len(partial) < 40
+        assert not engine.state.synced
+        assert not os.path.exists(state_path)
+
+        dropping.drop_rate = 0.0
+        rest = engine.sync()
+        assert len(partial) + len(rest) == 40
+        assert engine.state.synced and os.path.exists(state_path)
+        assert [m["message"] for m in profile.get_user("owen").get_messages()] == [f"history {i}" for i in range(40)]
+
+    dropping.stop()
+
+def test_load_generator():
+    results = run_load("127.0.0.1", PORT, clients=4, messages=25)
+    print(results)
+
+    assert results["messages"] == 100
+    assert results["errors"] == 0
+
+def test_metrics():
+    events = []
+    metrics = Metrics(enabled=True)
+    metrics.add_hook(lambda *event: events.append(event))
+
+    mike = messenger("mike", persistent=True, metrics=metrics)
+    assert mike.send("nina", "timed")
+    mike.retrieve_new()
+    stats = mike.stats()
+    print(stats)
+
+    assert stats["timings"]["join"]["connect"]["count"] == 1
+    assert stats["timings"]["send"]["write"]["count"] == 1
+    assert stats["timings"]["send"]["reply"]["count"] == 1
+    assert stats["timings"]["retrieve_new"]["total"]["count"] == 1
+    assert "connect" not in stats["timings"]["send"]
+    assert ("timing", "send", "total", stats["timings"]["send"]["total"]["sum"]) in events
+
+    closed = DirectMessenger("127.0.0.1", 1, "nobody", "pass_test", token_cache=TokenCache(), metrics=metrics)
+    assert not closed.send("mike", "lost")
+    assert metrics.stats()["errors"]["join"]["connect"] >= 1
+
+if __name__ == "__main__":
+    test_send_and_retrieve()
+    test_persistent_connection()
+    test_connection_pool()
+    test_send_many()
+    test_iter_all()
+    test_sync_engine_dedup()
+    test_sync_engine_dropped_connection()
+    test_load_generator()
+    test_metrics()
+    server.stop()
@@ -0,0 +1,55 @@
+import time
+from ds_server import DsuServer
+from ds_sessions import SessionManager
+from ds_messenger import TokenCache
+from Profile import Profile
+
+
+server = DsuServer(port=0)
+PORT = server.start_in_thread()
+
+
+def wait_for(condition, seconds=20):
+    deadline = time.monotonic() + seconds
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+def test_many_accounts():
+    received = {}
+    results = []
+    manager = SessionManager("127.0.0.1", PORT, min_interval=0.1, max_interval=0.5, max_in_flight=16,
+                             token_cache=TokenCache())
+    profiles = [Profile() for _ in range(100)]
+    for i, profile in enumerate(profiles):
+        manager.add_account(f"session{i}", "pass_test", profile,
+                            lambda session, messages: received.setdefault(session.username, []).extend(messages),
+                            lambda session, message, success: results.append(success))
+    manager.start()
+
+    for i in range(100):
+        for j in range(3):
+            manager.send(f"session{i}", f"session{(i + 1) % 100}", f"message {j} from {i}")
+
+    assert wait_for(lambda: len(results) == 300 and sum(map(len, received.values())) == 300)
+    manager.close()
+
+    assert all(results)
+    assert [m["message"] for m in received["session5"]] == [f"message {j} from 4" for j in range(3)]
+    assert len(profiles[5].get_user("session4").get_messages()) == 3
+    assert len(profiles[5].get_user("session6").get_messages()) == 3
+    assert manager.stats()["errors"] == 0
+
+def test_unreachable_server():
+    manager = SessionManager("127.0.0.1", 1, min_interval=0.05, max_interval=0.2, token_cache=TokenCache())
+    manager.add_account("nobody", "pass_test")
+    manager.send("nobody", "session0", "never sent")
+    manager.start()
+
+    assert wait_for(lambda: manager.get_session("nobody").errors >= 3)
+    manager.close()
+    assert manager.get_session("nobody").pending() == 1
+
+if __name__ == "__main__":
+    test_many_accounts()
+    test_unreachable_server()
@@ -1,45 +1,154 @@
+import os
+import tempfile
 from Profile import Profile
-from ds_messenger import DirectMessenger
+from ds_messenger import DirectMessenger, DirectMessage, TokenCache
+from ds_server import DsuServer
 
 
-PATH = "C:\\Users\\zyrat\\Documents\\Desktop\\college\\classes\\ics32\\programs\\final project\\testing\\test.dsu"
-current_profile = Profile("dsu_test", "username_test", "pass_test")
+server = DsuServer(port=0)
+PORT = server.start_in_thread()
+
+NEW_MESSAGES = [{'message': 'Hello World!', 'from': 'bob5896', 'timestamp': '1647149883.77518'},
+                {'message': 'second', 'from': 'bob5896', 'timestamp': '1647149908.18672'},
+                {'message': 'hi there', 'from': 'tom', 'timestamp': '1647149908.22928'},
+                {'message': 'hi again :)', 'from': 'tom', 'timestamp': '1647149929.78163'},
+                {'message': 'spaghetti', 'from': 'joe', 'timestamp': '1647149996.79552'}]
 
 def test_new_file():
-    global current_profile
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        current_profile = Profile("dsu_test", "username_test", "pass_test")
+        current_profile.add_message(NEW_MESSAGES)
+        current_profile.save_profile(path)
 
-    new_messages = [{'message': 'Hello World!', 'from': 'bob5896', 'timestamp': '1647149883.77518'}, 
-                    {'message': 'second', 'from': 'bob5896', 'timestamp': '1647149908.18672'}, 
-                    {'message': 'hi there', 'from': 'tom', 'timestamp': '1647149908.22928'}, 
-                    {'message': 'hi again :)', 'from': 'tom', 'timestamp': '1647149929.78163'}, 
-                    {'message': 'spaghetti', 'from': 'joe', 'timestamp': '1647149996.79552'}]
+        assert os.path.exists(path)
+        assert [user.name for user in current_profile.get_users()] == ["bob5896", "tom", "joe"]
 
-    current_profile.add_message(new_messages)
+def test_send_message():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        current_profile = Profile("127.0.0.1", "3245", "mypass")
 
-    for user in current_profile.get_users():
-        print(user.get_messages())
+        messenger = DirectMessenger("127.0.0.1", PORT, "3245", "mypass", token_cache=TokenCache())
+        assert messenger.send("bob5896", "this is a test message", current_profile)
+        current_profile.save_profile(path)
 
-    current_profile.save_profile(PATH)
+        loaded = Profile()
+        loaded.load_profile(path)
+        assert [m["message"] for m in loaded.get_user("bob5896").get_messages()] == ["this is a test message"]
 
-def test_send_message():
-    global current_profile
+def test_open_file():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        saved = Profile("dsu_test", "username_test", "pass_test")
+        saved.add_message(NEW_MESSAGES)
+        saved.save_profile(path)
 
-    messenger = DirectMessenger(username="3245", password="mypass")
-    messenger.send("bob5896", "this is a test message", current_profile)
+        current_profile = Profile()
+        current_profile.load_profile(path)
+        assert (current_profile.dsuserver, current_profile.username) == ("dsu_test", "username_test")
+        for user in current_profile.get_users():
+            assert user.get_messages() == saved.get_user(user.name).get_messages()
 
-    current_profile.save_profile(PATH)
+def test_journal_torn_write():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        profile = Profile(journal=True)
+        profile.add_message(our_message=DirectMessage("bob", "compacted", 1000.0))
+        profile.save_profile(path)
+        profile.add_message(our_message=DirectMessage("bob", "appended", 1001.0))
+        profile.save_profile(path)
 
-def test_open_file():
-    global current_profile
+        # A crash in the middle of an append leaves a partial last line behind
+        with open(path + '.journal', 'a') as f:
+            f.write('{"user": "bob", "message": "torn", "timest')
+
+        profile.add_message(our_message=DirectMessage("bob", "after the crash", 1002.0))
+        profile.add_message(new_messages=[{"message": "hi", "from": "carol", "timestamp": "1003.0"}])
+        profile.save_profile(path)
+
+        loaded = Profile()
+        loaded.load_profile(path)
+        assert [m["message"] for m in loaded.get_user("bob").get_messages()] == ["compacted", "appended",
+                                                                                 "after the crash"]
+        assert [m["message"] for m in loaded.get_user("carol").get_messages()] == ["hi"]
+
+        # A journal torn before its header was complete is started over
+        os.remove(path + '.journal')
+        with open(path + '.journal', 'w') as f:
+            f.write('{"snapshot": "12')
+        profile.add_message(our_message=DirectMessage("carol", "new journal", 1004.0))
+        profile.save_profile(path)
+
+        loaded = Profile()
+        loaded.load_profile(path)
+        assert [m["message"] for m in loaded.get_user("carol").get_messages()] == ["new journal"]
+
+def test_lazy_index_has_no_credentials():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.dsu")
+        for messages in (NEW_MESSAGES, []):
+            profile = Profile("127.0.0.1", "zoe", 'p\u00e4ss, "_users": [')
+            profile.add_message(messages)
+            profile.compact(path)
+
+            with open(path + ".index") as f:
+                index = f.read()
+            assert "zoe" not in index and "p\\u00e4ss" not in index and "dsuserver" not in index
+
+            loaded = Profile()
+            loaded.load_profile(path, lazy=True)
+            assert (loaded.dsuserver, loaded.username, loaded.password) == ("127.0.0.1", "zoe", 'p\u00e4ss, "_users": [')
+            assert [user.name for user in loaded.get_users()] == [user.name for user in profile.get_users()]
+            assert not any(user.is_loaded() for user in loaded.get_users())
+
+def test_range_queries_skip_conversations():
+    with tempfile.TemporaryDirectory() as directory:
+        # Each user's messages cover their own hour, apart from user9 whose messages are spread out, so every range
+        # has to read user9
+        profile = Profile(dsu_version=2)
+        profile.add_message(new_messages=[{"message": f"message {i} from user{i // 10}", "from": f"user{i // 10}",
+                                           "timestamp": str(3600.0 * (i // 10) + i)} for i in range(90)])
+        profile.add_message(new_messages=[{"message": f"spread {i}", "from": "user9",
+                                           "timestamp": str(3600.0 * i + 1800)} for i in range(9)])
+
+        for name, dsu_version in (("v1.dsu", 1), ("v2.dsu", 2), ("profile.sqlite", None)):
+            path = os.path.join(directory, name)
+            if dsu_version is not None:
+                profile.dsu_version = dsu_version
+            profile.save_profile(path)
+
+            loaded = Profile()
+            loaded.load_profile(path, lazy=True)
+            messages = loaded.messages_between(3600.0 * 4, 3600.0 * 4 + 1800)
+            assert [m["message"] for m in messages] == [f"message {i} from user4" for i in range(40, 50)]
+            assert [user.name for user in loaded.get_users() if user.is_loaded()] == ["user4", "user9"]
+
+            assert [m["message"] for m in loaded.latest(3)] == ["message 88 from user8", "message 89 from user8",
+                                                                "spread 8"]
+            assert [user.name for user in loaded.get_users() if user.is_loaded()] == ["user4", "user8", "user9"]
+            assert loaded.latest(3) == profile.latest(3)
+            assert loaded.messages_between(0, 10 ** 6) == profile.messages_between(0, 10 ** 6)
 
-    current_profile = Profile()
-    current_profile.load_profile(PATH)
+            # Released conversations keep their bounds
+            for user in loaded.get_users():
+                user.release()
+            assert len(loaded.messages_between(7220, 7225)) == 5
+            assert loaded.messages_between(7200, 7205) == []
+            assert [user.name for user in loaded.get_users() if user.is_loaded()] == ["user2", "user9"]
 
-    for user in current_profile.get_users():
-        print(user.get_messages())
+            for storage in loaded._storages.values():
+                if hasattr(storage, "close"):
+                    storage.close()
+            for storage in profile._storages.values():
+                if hasattr(storage, "close"):
+                    storage.close()
 
 if __name__ == "__main__":
     test_new_file()
     test_send_message()
-    print()
     test_open_file()
+    test_journal_torn_write()
+    test_lazy_index_has_no_credentials()
+    test_range_queries_skip_conversations()
+    server.stop()
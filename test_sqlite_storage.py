@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import tempfile
+from Profile import Profile, migrate_profile
+from ds_messenger import DirectMessage
+
+
+# Timestamps as the server sends them, as we send them, and ones that do not round trip through float
+MESSAGES = [{"message": f"message {i}", "from": f"user{i % 3}", "timestamp": str(1000.0 + i)} for i in range(12)]
+ODD_TIMESTAMPS = ["not a time", "1.50", 5, None]
+
+
+def sample_profile() -> Profile:
+    profile = Profile(username="sqlite_user", password="sqlite_pass")
+    profile.add_message(new_messages=MESSAGES)
+    profile.add_message(our_messages=[DirectMessage("user0", f"sent {i}", 2000.0 + i) for i in range(3)])
+    odd = profile.add_user("odd")
+    for i, timestamp in enumerate(ODD_TIMESTAMPS):
+        odd.add_message(f"odd {i}", timestamp, False)
+    return profile
+
+def assert_same(profile: Profile, loaded: Profile):
+    assert (loaded.username, loaded.password) == (profile.username, profile.password)
+    assert [user.name for user in loaded.get_users()] == [user.name for user in profile.get_users()]
+    for user in profile.get_users():
+        assert list(loaded.get_user(user.name).get_messages()) == list(user.get_messages())
+
+def close(*profiles):
+    # Open databases keep the temporary directory from being removed on Windows
+    for profile in profiles:
+        for storage in profile._storages.values():
+            if hasattr(storage, "close"):
+                storage.close()
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.sqlite")
+        profile = sample_profile()
+        profile.save_profile(path)
+
+        for lazy in (False, True):
+            loaded = Profile()
+            loaded.load_profile(path, lazy=lazy)
+            assert_same(profile, loaded)
+
+        # Later saves only insert what was added since
+        profile.add_message(new_messages=[{"message": "late", "from": "user9", "timestamp": "3000.0"}])
+        profile.add_message(our_message=DirectMessage("user1", "sent later", 3001.0))
+        profile.save_profile(path)
+
+        loaded = Profile()
+        loaded.load_profile(path, lazy=True)
+        assert_same(profile, loaded)
+        close(profile, loaded)
+
+def test_timestamps_are_numbers():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.sqlite")
+        sample_profile().save_profile(path)
+
+        db = sqlite3.connect(path)
+        assert db.execute("SELECT DISTINCT typeof(timestamp) FROM messages").fetchall() == [("real",)]
+        rows = db.execute("SELECT message FROM messages WHERE timestamp BETWEEN 1003 AND 1005 ORDER BY timestamp")
+        assert [message for message, in rows] == ["message 3", "message 4", "message 5"]
+        plan = " ".join(row[-1] for row in db.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM messages WHERE user_id = 1 AND timestamp BETWEEN 1003 AND 1005"))
+        assert "messages_user_timestamp" in plan
+        db.close()
+
+def test_migrate_profile():
+    with tempfile.TemporaryDirectory() as directory:
+        dsu_path = os.path.join(directory, "test.dsu")
+        sqlite_path = os.path.join(directory, "test.sqlite")
+        back_path = os.path.join(directory, "back.dsu")
+        profile = sample_profile()
+        profile.save_profile(dsu_path)
+
+        migrated = migrate_profile(dsu_path, sqlite_path)
+        assert_same(profile, migrated)
+        back = migrate_profile(sqlite_path, back_path)
+        assert_same(profile, back)
+
+        loaded = Profile()
+        loaded.load_profile(back_path)
+        assert_same(profile, loaded)
+        close(migrated, back)
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_timestamps_are_numbers()
+    test_migrate_profile()
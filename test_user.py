@@ -0,0 +1,203 @@
+import gc
+import json
+import os
+import tempfile
+import threading
+import tracemalloc
+import weakref
+from ds_messenger import User, DirectMessage
+from Profile import Profile, SaveScheduler, convert_profile
+import dsu_format
+
+
+def test_messages_round_trip():
+    # Timestamps that cannot be read as a number sort as 0
+    timestamps = ['not a time', '1.50', 5, '1647149883.77518', 1647149883.77518]
+    user = User("bob5896")
+    for i, timestamp in enumerate(timestamps):
+        user.add_message(f"message {i}", timestamp, i % 2 == 0)
+
+    messages = user.get_messages()
+    assert [m["timestamp"] for m in messages] == timestamps
+    assert [m["sent by user"] for m in messages] == [True, False, True, False, True]
+    assert messages[2] == {"message": "message 2", "timestamp": 5, "sent by user": True}
+    assert user._to_json() == json.dumps(list(messages)).encode()
+
+def test_messages_between():
+    user = User("bob5896")
+    user.add_messages([{"message": f"message {i}", "timestamp": str(1000.0 + i)} for i in range(0, 100, 2)])
+    # Messages sent while offline arrive late
+    user.add_messages([{"message": f"message {i}", "timestamp": 1000.0 + i} for i in range(1, 100, 2)], True)
+
+    assert user.reorder_count() == 1
+    assert [m["message"] for m in user.messages_between(1010, "1014")] == [f"message {i}" for i in range(10, 14)]
+    assert [m["message"] for m in user.latest(3)] == ["message 97", "message 98", "message 99"]
+    assert [m["timestamp"] for m in user.latest(2)] == ["1098.0", 1099.0]
+
+def test_profile_messages_between():
+    profile = Profile()
+    profile.add_message(new_messages=[{"message": f"message {i}", "from": f"user{i % 3}", "timestamp": str(1000.0 + i)}
+                                      for i in range(30)])
+
+    messages = profile.messages_between(1005, 1008)
+    assert [(m["user"], m["message"]) for m in messages] == [("user2", "message 5"), ("user0", "message 6"),
+                                                             ("user1", "message 7")]
+    assert [m["message"] for m in profile.latest(2)] == ["message 28", "message 29"]
+    assert [m["message"] for m in profile.latest(2, "user0")] == ["message 24", "message 27"]
+
+def test_save_scheduler():
+    profile = Profile(journal=True)
+    # The scheduler's clock only moves when the test moves it, so no save is ever due by accident
+    now = [0.0]
+    saved = threading.Event()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "saves.dsu")
+        saver = SaveScheduler(profile, path, delay=0.05, max_delay=0.2, on_save=saved.set, clock=lambda: now[0])
+        for i in range(20):
+            now[0] += 0.001
+            profile.add_message(new_messages=[{"message": f"burst {i}", "from": "user0", "timestamp": str(1000.0 + i)}])
+            saver.request()
+        assert saver.saves == 0
+
+        now[0] += 1.0
+        assert saved.wait(5)
+        with saver.lock:
+            assert saver.saves == 1
+            assert not profile.is_dirty()
+
+        profile.add_message(new_messages=[{"message": "last", "from": "user0", "timestamp": "2000.0"}])
+        saver.request()
+        saver.close()
+        stats = saver.stats()
+        assert (stats["requests"], stats["saves"]) == (21, 2)
+        assert stats["profile_compactions"] == 1 and stats["profile_journal_appends"] == 1
+        assert stats["profile_bytes_written"] == os.path.getsize(path) + os.path.getsize(path + ".index") + \
+            os.path.getsize(path + ".journal")
+
+        loaded = Profile()
+        loaded.load_profile(path)
+        assert len(loaded.get_user("user0").get_messages()) == 21
+
+def test_save_scheduler_errors():
+    profile = Profile(journal=True)
+    now = [0.0]
+    errors = []
+    failures = [OSError("sync state not written")]
+    saved = threading.Event()
+    failed = threading.Event()
+
+    def on_save():
+        if failures:
+            raise failures.pop()
+        saved.set()
+
+    def on_error(ex):
+        errors.append(ex)
+        failed.set()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "errors.dsu")
+        saver = SaveScheduler(profile, path, delay=0.05, max_delay=0.2, on_save=on_save, on_error=on_error,
+                              clock=lambda: now[0])
+        profile.add_message(new_messages=[{"message": "first", "from": "user0", "timestamp": "1000.0"}])
+        saver.request()
+        now[0] += 1.0
+        assert failed.wait(5)
+
+        # The failed save is reported and retried, and the thread keeps saving later requests
+        now[0] += 1.0
+        assert saved.wait(5)
+        with saver.lock:
+            assert [str(ex) for ex in errors] == ["sync state not written"]
+            assert (saver.errors, saver.saves) == (1, 1)
+        saved.clear()
+        profile.add_message(new_messages=[{"message": "second", "from": "user0", "timestamp": "1001.0"}])
+        saver.request()
+        now[0] += 1.0
+        assert saved.wait(5)
+        with saver.lock:
+            assert saver.saves == 2 and not profile.is_dirty()
+
+        failures.append(OSError("disk full"))
+        profile.add_message(new_messages=[{"message": "third", "from": "user0", "timestamp": "1002.0"}])
+        assert not saver.flush()
+        assert saver.flush()
+        saver.close()
+        assert saver.errors == 2
+
+        loaded = Profile()
+        loaded.load_profile(path)
+        assert len(loaded.get_user("user0").get_messages()) == 3
+
+def test_save_scheduler_close():
+    profile = Profile(journal=True)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "closed.dsu")
+        saver = SaveScheduler(profile, path)
+        saver.close()
+        profile.add_message(new_messages=[{"message": "after close", "from": "user0", "timestamp": "1000.0"}])
+        saver.close()
+        assert saver.saves == 1
+
+        # A closed scheduler is no longer held by the exit handler
+        closed = weakref.ref(saver)
+        del saver
+        gc.collect()
+        assert closed() is None
+
+def test_dsu_v2():
+    profile = Profile(journal=True)
+    profile.add_message(new_messages=[{"message": f"message {i}", "from": f"user{i % 3}", "timestamp": str(1000.0 + i)}
+                                      for i in range(30)])
+    profile.add_message(our_message=DirectMessage("user1", "sent by us", 1100.0))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "profile.dsu")
+        profile.save_profile(path)
+        assert dsu_format.detect_version(path) == 1
+
+        convert_profile(path, compression="lzma")
+        assert dsu_format.detect_version(path) == 2
+        assert not os.path.exists(path + ".index")
+
+        lazy = Profile(journal=True)
+        lazy.load_profile(path, lazy=True)
+        assert lazy.dsu_version == 2 and not lazy.get_user("user1").is_loaded()
+        assert lazy.get_user("user1").get_messages() == list(profile.get_user("user1").get_messages())
+
+        # New messages go to the journal and compaction keeps the format and the blocks of unloaded users
+        lazy.add_message(new_messages=[{"message": "later", "from": "user2", "timestamp": "2000.0"}])
+        lazy.save_profile(path)
+        lazy.compact(path)
+        assert dsu_format.detect_version(path) == 2
+
+        loaded = Profile()
+        loaded.load_profile(path)
+        assert [user.name for user in loaded.get_users()] == ["user0", "user1", "user2"]
+        assert loaded.get_user("user0").get_messages() == list(profile.get_user("user0").get_messages())
+        assert loaded.get_user("user2").latest(1)[0]["message"] == "later"
+        assert loaded.get_user("user1").get_messages()[-1] == {"message": "sent by us", "timestamp": 1100.0,
+                                                               "sent by user": True}
+
+def test_memory_at_a_million_messages():
+    tracemalloc.start()
+    user = User("bob5896")
+    user.add_messages([{"message": f"message number {i}", "timestamp": str(1647149883.77518 + i)}
+                       for i in range(1000000)])
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(current / 1000000, "bytes per message")
+
+    # The text itself takes about 65 bytes, a dict per message took over 300
+    assert current / 1000000 < 120
+    assert len(user.get_messages()) == 1000000
+
+if __name__ == "__main__":
+    test_messages_round_trip()
+    test_messages_between()
+    test_profile_messages_between()
+    test_save_scheduler()
+    test_save_scheduler_errors()
+    test_save_scheduler_close()
+    test_dsu_v2()
+    test_memory_at_a_million_messages()